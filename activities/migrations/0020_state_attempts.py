@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-16 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("activities", "0019_alter_postattachment_focal_x_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emoji",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="fanout",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="hashtag",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="postattachment",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="postinteraction",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -115,6 +115,7 @@ class Emoji(StatorModel):
 
     # State of this Emoji
     state = StateField(EmojiStates)
+    stator_lane = StatorModel.LANE_BULK
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -1,14 +1,38 @@
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import threading
+from collections.abc import Callable, Iterable
+
 import httpx
+from cachetools import TTLCache
 from django.db import models
 
 from activities.models.timeline_event import TimelineEvent
 from core.ld import canonicalise
-from stator.models import State, StateField, StateGraph, StatorModel
-from users.models import Block, FollowStates
+from core.signatures import RateLimited
+from stator.exceptions import TryAgainLater
+from stator.models import State, StateField, StateGraph, StatorModel, run_sync
+from users.models import Block, Domain, FollowStates, Identity
+
+logger = logging.getLogger(__name__)
+
+# Encoded bodies of recently-sent activities, keyed by fan-out type and the
+# version of their subject, so each is only built once for all its inboxes
+body_cache: TTLCache = TTLCache(maxsize=1000, ttl=3600)
+body_cache_lock = threading.Lock()
 
 
 class FanOutStates(StateGraph):
-    new = State(try_interval=600)
+    new = State(
+        try_interval=600,
+        batch_size=50,
+        backoff_factor=2,
+        backoff_max=3600 * 6,
+        backoff_jitter=0.2,
+    )
     sent = State(delete_after=86400)
     skipped = State(delete_after=86400)
     failed = State(delete_after=86400)
@@ -17,6 +41,261 @@ class FanOutStates(StateGraph):
     new.transitions_to(skipped)
     new.times_out_to(failed, seconds=86400 * 3)
 
+    @classmethod
+    def handle_new_batch(cls, instances: list["FanOut"]):
+        """
+        Sends a batch of fan-outs, fetching everything they refer to up front
+        rather than one instance at a time.
+
+        Fan-outs going to the same inbox are sent one after the other, so
+        they reuse the same pooled connection, and if that server turns out
+        to be down, the rest of them are put off without trying it again.
+        """
+        results = {}
+        for pk, fan_out in cls.load_batch(instances):
+            # One bad fan-out should not hold up the rest of the batch
+            try:
+                results[pk] = cls.handle_new(fan_out)
+            except (TryAgainLater, Exception) as e:
+                results[pk] = cls.batch_error_result(e)
+        return results
+
+    @classmethod
+    async def ahandle_new_batch(cls, instances: list["FanOut"]):
+        """
+        Async version of handle_new_batch, for the async runner.
+
+        Each server's fan-outs are still sent one after the other, but all
+        the servers in the batch are sent to at once, waiting on them on the
+        event loop rather than in a thread; everything that touches the
+        database runs in the executor.
+        """
+        by_domain: dict[str | None, list[tuple[int, FanOut]]] = {}
+        for pk, fan_out in await run_sync(cls.load_batch, instances):
+            by_domain.setdefault(fan_out.identity.domain_id, []).append((pk, fan_out))
+        results = {}
+
+        async def send(fan_outs: list[tuple[int, FanOut]]):
+            for pk, fan_out in fan_outs:
+                try:
+                    results[pk] = await cls.ahandle_new(fan_out)
+                except (TryAgainLater, Exception) as e:
+                    results[pk] = cls.batch_error_result(e)
+
+        await asyncio.gather(*[send(fan_outs) for fan_outs in by_domain.values()])
+        return results
+
+    @classmethod
+    def load_batch(cls, instances: list["FanOut"]) -> list[tuple[int, "FanOut"]]:
+        """
+        Fetches a batch of fan-outs along with everything they refer to, as
+        (pk, fan-out) pairs in the order they should be sent in.
+        """
+        fan_outs = FanOut.objects.select_related(
+            "identity",
+            "identity__domain",
+            "subject_post",
+            "subject_post__author",
+            "subject_post_interaction",
+            "subject_post_interaction__identity",
+            "subject_identity",
+        ).in_bulk([instance.pk for instance in instances])
+        # Share one Domain per server, so the whole batch sees its circuit
+        domains: dict[str, Domain] = {}
+        for fan_out in fan_outs.values():
+            domain = fan_out.identity.domain
+            if domain is not None:
+                fan_out.identity.domain = domains.setdefault(domain.pk, domain)
+        return sorted(
+            fan_outs.items(),
+            key=lambda item: (cls.destination(item[1]) or "", item[0]),
+        )
+
+    @classmethod
+    def batch_error_result(cls, error: BaseException) -> BaseException:
+        """
+        Returns what to give as the result of a fan-out in a batch that
+        raised `error`.
+        """
+        if isinstance(error, RateLimited):
+            # Come back when they asked us to, if they said
+            return TryAgainLater(retry_after=error.retry_after)
+        if not isinstance(error, TryAgainLater):
+            logger.exception(error)
+        return error
+
+    @classmethod
+    def destination(cls, instance: "FanOut") -> str | None:
+        """
+        Returns the inbox URI a fan-out will be delivered to, if it's remote.
+        """
+        if instance.identity.local:
+            return None
+        return instance.identity.shared_inbox_uri or instance.identity.inbox_uri
+
+    @classmethod
+    def outbound_body(
+        cls, instance: "FanOut", subject: models.Model, make_body: Callable[[], dict]
+    ) -> bytes:
+        """
+        Returns the canonicalised and encoded activity from `make_body`.
+
+        That's the same for every inbox, and canonicalising is slow, so we
+        only do it once per fan-out type and version (last save) of the
+        subject, and send all the others the same bytes.
+        """
+        key = (
+            instance.type,
+            subject._meta.label_lower,
+            subject.pk,
+            getattr(subject, "updated", None),
+        )
+        with body_cache_lock:
+            body = body_cache.get(key)
+        if body is None:
+            body = json.dumps(canonicalise(make_body())).encode("utf8")
+            with body_cache_lock:
+                body_cache[key] = body
+        return body
+
+    @classmethod
+    def outbound(cls, instance: "FanOut") -> tuple[Identity, bytes]:
+        """
+        Returns who a remote fan-out should be sent as, and the encoded
+        activity to send.
+        """
+        match instance.type:
+            case FanOut.Types.post:
+                post = instance.subject_post
+                return post.author, cls.outbound_body(instance, post, post.to_create_ap)
+            case FanOut.Types.post_edited:
+                post = instance.subject_post
+                return post.author, cls.outbound_body(instance, post, post.to_update_ap)
+            case FanOut.Types.post_deleted:
+                post = instance.subject_post
+                return post.author, cls.outbound_body(instance, post, post.to_delete_ap)
+            # Boosts/likes/votes/pins
+            case FanOut.Types.interaction:
+                interaction = instance.subject_post_interaction
+                if interaction.type == interaction.Types.vote:
+                    make_body = interaction.to_create_ap
+                elif interaction.type == interaction.Types.pin:
+                    make_body = interaction.to_add_ap
+                else:
+                    make_body = interaction.to_ap
+                return interaction.identity, cls.outbound_body(
+                    instance, interaction, make_body
+                )
+            # Undoing boosts/likes/pins
+            case FanOut.Types.undo_interaction:
+                interaction = instance.subject_post_interaction
+                if interaction.type == interaction.Types.pin:
+                    make_body = interaction.to_remove_ap
+                else:
+                    make_body = interaction.to_undo_ap
+                return interaction.identity, cls.outbound_body(
+                    instance, interaction, make_body
+                )
+            case FanOut.Types.identity_edited:
+                identity = instance.subject_identity
+                return identity, cls.outbound_body(
+                    instance, identity, identity.to_update_ap
+                )
+            case FanOut.Types.identity_deleted:
+                identity = instance.subject_identity
+                return identity, cls.outbound_body(
+                    instance, identity, identity.to_delete_ap
+                )
+            case FanOut.Types.identity_moved:
+                raise NotImplementedError()
+            case _:
+                raise ValueError(
+                    f"Cannot fan out with type {instance.type} local={instance.identity.local}"
+                )
+
+    @classmethod
+    def deliver(cls, instance: "FanOut", sender, body: bytes) -> bool:
+        """
+        Signs and POSTs the body to the fan-out's inbox as `sender`,
+        returning False if we couldn't get through to the server (which
+        counts against its domain's circuit).
+        """
+        domain = instance.identity.domain
+        try:
+            sender.signed_request(
+                method="post", uri=cls.destination(instance), body=body
+            )
+        except httpx.RequestError:
+            if domain:
+                domain.circuit_record_failure()
+            return False
+        except ValueError:
+            # It answered, even if it didn't like what we sent
+            if domain:
+                domain.circuit_record_success()
+            raise
+        if domain:
+            domain.circuit_record_success()
+        return True
+
+    @classmethod
+    async def adeliver(cls, instance: "FanOut", sender, body: bytes) -> bool:
+        """
+        Async version of deliver.
+        """
+        domain = instance.identity.domain
+        try:
+            await sender.asigned_request(
+                method="post", uri=cls.destination(instance), body=body
+            )
+        except httpx.PoolTimeout:
+            # We've too many requests in flight, which isn't their fault
+            raise TryAgainLater()
+        except httpx.RequestError:
+            if domain:
+                await run_sync(domain.circuit_record_failure)
+            return False
+        except ValueError:
+            # It answered, even if it didn't like what we sent
+            if domain:
+                await run_sync(domain.circuit_record_success)
+            raise
+        if domain:
+            await run_sync(domain.circuit_record_success)
+        return True
+
+    @classmethod
+    def check_circuit(cls, instance: "FanOut") -> State | None:
+        """
+        Doesn't let us try servers that are down until their circuit does,
+        raising TryAgainLater; if they've been down for days, returns failed
+        to give up on this one entirely.
+        """
+        domain = instance.identity.domain
+        if not instance.identity.local and domain:
+            retry_after = domain.circuit_retry_after()
+            if retry_after:
+                if domain.circuit_dead:
+                    return cls.failed
+                raise TryAgainLater(retry_after=retry_after)
+        return None
+
+    @classmethod
+    async def ahandle_new(cls, instance: "FanOut"):
+        """
+        Async version of handle_new, which only does remote deliveries on
+        the event loop; everything else is handle_new in the executor.
+        """
+        if instance.identity.local or not instance.identity.inbox_uri:
+            return await run_sync(cls.handle_new, instance)
+        gave_up = await run_sync(cls.check_circuit, instance)
+        if gave_up:
+            return gave_up
+        sender, body = await run_sync(cls.outbound, instance)
+        if not await cls.adeliver(instance, sender, body):
+            return
+        return cls.sent
+
     @classmethod
     def handle_new(cls, instance: "FanOut"):
         """
@@ -27,9 +306,20 @@ class FanOutStates(StateGraph):
         if not (instance.identity.local or instance.identity.inbox_uri):
             return
 
-        match (instance.type, instance.identity.local):
+        gave_up = cls.check_circuit(instance)
+        if gave_up:
+            return gave_up
+
+        # Everything remote is just an activity to sign and send
+        if not instance.identity.local:
+            sender, body = cls.outbound(instance)
+            if not cls.deliver(instance, sender, body):
+                return
+            return cls.sent
+
+        match instance.type:
             # Handle creating/updating local posts
-            case ((FanOut.Types.post | FanOut.Types.post_edited), True):
+            case FanOut.Types.post | FanOut.Types.post_edited:
                 post = instance.subject_post
                 # If the author of the post is blocked or muted, skip out
                 if (
@@ -71,40 +361,8 @@ class FanOutStates(StateGraph):
                         post=post,
                     )
 
-            # Handle sending remote posts create
-            case (FanOut.Types.post, False):
-                post = instance.subject_post
-                # Sign it and send it
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_create_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending remote posts update
-            case (FanOut.Types.post_edited, False):
-                post = instance.subject_post
-                # Sign it and send it
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_update_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle deleting local posts
-            case (FanOut.Types.post_deleted, True):
+            case FanOut.Types.post_deleted:
                 post = instance.subject_post
                 if instance.identity.local:
                     # Remove all timeline events mentioning it
@@ -113,24 +371,8 @@ class FanOutStates(StateGraph):
                         subject_post=post,
                     ).delete()
 
-            # Handle sending remote post deletes
-            case (FanOut.Types.post_deleted, False):
-                post = instance.subject_post
-                # Send it to the remote inbox
-                try:
-                    post.author.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(post.to_delete_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle local boosts/likes
-            case (FanOut.Types.interaction, True):
+            case FanOut.Types.interaction:
                 interaction = instance.subject_post_interaction
                 # If the author of the interaction is blocked or their notifications
                 # are muted, skip out
@@ -160,30 +402,8 @@ class FanOutStates(StateGraph):
                     interaction=interaction,
                 )
 
-            # Handle sending remote boosts/likes/votes/pins
-            case (FanOut.Types.interaction, False):
-                interaction = instance.subject_post_interaction
-                # Send it to the remote inbox
-                try:
-                    if interaction.type == interaction.Types.vote:
-                        body = interaction.to_create_ap()
-                    elif interaction.type == interaction.Types.pin:
-                        body = interaction.to_add_ap()
-                    else:
-                        body = interaction.to_ap()
-                    interaction.identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(body),
-                    )
-                except httpx.RequestError:
-                    return
-
             # Handle undoing local boosts/likes
-            case (FanOut.Types.undo_interaction, True):  # noqa:F841
+            case FanOut.Types.undo_interaction:  # noqa:F841
                 interaction = instance.subject_post_interaction
 
                 # Delete any local timeline events
@@ -192,68 +412,14 @@ class FanOutStates(StateGraph):
                     interaction=interaction,
                 )
 
-            # Handle sending remote undoing boosts/likes/pins
-            case (FanOut.Types.undo_interaction, False):  # noqa:F841
-                interaction = instance.subject_post_interaction
-                # Send an undo to the remote inbox
-                try:
-                    if interaction.type == interaction.Types.pin:
-                        body = interaction.to_remove_ap()
-                    else:
-                        body = interaction.to_undo_ap()
-                    interaction.identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(body),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity edited to remote
-            case (FanOut.Types.identity_edited, False):
-                identity = instance.subject_identity
-                try:
-                    identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(instance.subject_identity.to_update_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity deleted to remote
-            case (FanOut.Types.identity_deleted, False):
-                identity = instance.subject_identity
-                try:
-                    identity.signed_request(
-                        method="post",
-                        uri=(
-                            instance.identity.shared_inbox_uri
-                            or instance.identity.inbox_uri
-                        ),
-                        body=canonicalise(instance.subject_identity.to_delete_ap()),
-                    )
-                except httpx.RequestError:
-                    return
-
-            # Handle sending identity moved to remote
-            case (FanOut.Types.identity_moved, False):
-                raise NotImplementedError()
-
             # Sending identity edited/deleted to local is a no-op
-            case (FanOut.Types.identity_edited, True):
+            case FanOut.Types.identity_edited:
                 pass
-            case (FanOut.Types.identity_deleted, True):
+            case FanOut.Types.identity_deleted:
                 pass
 
             # Created identities make a timeline event
-            case (FanOut.Types.identity_created, True):
+            case FanOut.Types.identity_created:
                 TimelineEvent.add_identity_created(
                     identity=instance.identity,
                     new_identity=instance.subject_identity,
@@ -272,6 +438,9 @@ class FanOut(StatorModel):
     An activity that needs to get to an inbox somewhere.
     """
 
+    # How many fan-outs to INSERT per query when creating them in bulk
+    CREATE_CHUNK_SIZE = 1000
+
     class Types(models.TextChoices):
         post = "post"
         post_edited = "post_edited"
@@ -323,3 +492,70 @@ class FanOut(StatorModel):
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def transition_claim_order(cls, queryset: models.QuerySet) -> models.QuerySet:
+        """
+        Claims the fan-outs going to the same server as the oldest due one
+        ahead of the rest, so each batch goes to as few servers as it can -
+        otherwise a batch is a random handful of rows, and hardly any of them
+        get to share a connection.
+        """
+        domain_id = (
+            queryset.order_by("pk")
+            .values_list("identity__domain_id", flat=True)
+            .first()
+        )
+        if domain_id is None:
+            return queryset
+        # A subquery rather than a join, so the claim only locks fan-outs
+        same_server = models.ExpressionWrapper(
+            models.Q(identity__in=Identity.objects.filter(domain_id=domain_id)),
+            output_field=models.BooleanField(),
+        )
+        return queryset.order_by(same_server.desc(), "pk")
+
+    @classmethod
+    def create_for_targets(
+        cls,
+        identity_ids: Iterable[int],
+        type: str,
+        since: datetime.datetime | None = None,
+        **subjects,
+    ) -> int:
+        """
+        Creates a fan-out of `type` about `subjects` (subject_post=..., etc.)
+        for each identity ID, CREATE_CHUNK_SIZE rows at a time, without
+        reading more than one chunk of IDs from `identity_ids` at once.
+
+        Each chunk is committed as it goes, so if `since` is passed (the time
+        the subject entered its current state), identities that already have
+        this fan-out from after then are skipped. That lets an interrupted
+        handler run again without sending anything twice.
+        Returns how many fan-outs were created.
+        """
+        existing = cls.objects.none()
+        if since is not None:
+            existing = cls.objects.filter(type=type, created__gte=since, **subjects)
+            # Nearly always a first run, so don't check every chunk for nothing
+            if not existing.exists():
+                existing = cls.objects.none()
+        created = 0
+        identity_ids = iter(identity_ids)
+        while chunk := list(itertools.islice(identity_ids, cls.CREATE_CHUNK_SIZE)):
+            skip = set(
+                existing.filter(identity_id__in=chunk).values_list(
+                    "identity_id", flat=True
+                )
+            )
+            fan_outs = [
+                cls(identity_id=identity_id, type=type, **subjects)
+                for identity_id in dict.fromkeys(chunk)
+                if identity_id not in skip
+            ]
+            if fan_outs:
+                cls.objects.bulk_create(fan_outs)
+                # bulk_create doesn't send post_save, so wake runners ourselves
+                cls.transition_notify()
+                created += len(fan_outs)
+        return created
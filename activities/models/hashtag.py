@@ -1,3 +1,4 @@
+import logging
 import re
 from datetime import date, timedelta
 
@@ -6,16 +7,37 @@ from django.db import models
 from django.utils import timezone
 
 from core.models import Config
+from stator.exceptions import TryAgainLater
 from stator.models import State, StateField, StateGraph, StatorModel
 
+logger = logging.getLogger(__name__)
+
 
 class HashtagStates(StateGraph):
-    outdated = State(try_interval=300, force_initial=True)
+    outdated = State(try_interval=300, force_initial=True, batch_size=20)
     updated = State(externally_progressed=True)
 
     outdated.transitions_to(updated)
     updated.transitions_to(outdated)
 
+    @classmethod
+    def handle_outdated_batch(cls, instances: list["Hashtag"]):
+        """
+        Computes stats for a batch of Hashtags; they all move to updated
+        together in one query afterwards.
+        """
+        results = {}
+        for instance in instances:
+            # One bad hashtag should not hold up the rest of the batch
+            try:
+                results[instance.pk] = cls.handle_outdated(instance)
+            except TryAgainLater as e:
+                results[instance.pk] = e
+            except Exception as e:
+                logger.exception(e)
+                results[instance.pk] = e
+        return results
+
     @classmethod
     def handle_outdated(cls, instance: "Hashtag"):
         """
@@ -93,6 +115,7 @@ class Hashtag(StatorModel):
 
     # State of this Hashtag
     state = StateField(HashtagStates)
+    stator_lane = StatorModel.LANE_BULK
 
     # Metrics for this Hashtag
     stats = models.JSONField(null=True, blank=True)
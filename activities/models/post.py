@@ -12,7 +12,7 @@ import urlman
 from django.conf import settings
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVector
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.db.utils import IntegrityError
 from django.template import loader
 from django.template.defaultfilters import linebreaks_filter
@@ -28,6 +28,7 @@ from activities.models.post_types import (
     PostTypeDataEncoder,
     QuestionData,
 )
+from activities.models.timeline_event import TimelineEvent
 from core.exceptions import ActivityPubFormatError
 from core.html import ContentRenderer, FediverseHtmlParser
 from core.ld import (
@@ -70,13 +71,26 @@ class PostStates(StateGraph):
 
     @classmethod
     def targets_fan_out(cls, post: "Post", type_: str) -> None:
-        # Fan out to each target
-        for follow in post.get_targets():
-            FanOut.objects.create(
-                identity=follow,
-                type=type_,
-                subject_post=post,
-            )
+        targets = post.get_target_locality()
+        # Local identities' timelines are updated directly, a chunk at a time,
+        # rather than with a fan-out each
+        local_ids = [pk for pk, local in targets.items() if local]
+        for start in range(0, len(local_ids), FanOut.CREATE_CHUNK_SIZE):
+            chunk = local_ids[start : start + FanOut.CREATE_CHUNK_SIZE]
+            if type_ == FanOut.Types.post_deleted:
+                TimelineEvent.objects.filter(
+                    identity_id__in=chunk, subject_post=post
+                ).delete()
+            else:
+                TimelineEvent.add_post_for_identities(chunk, post)
+        # Fan out to each remote target; skipping any we already did, in case
+        # we were interrupted last time
+        FanOut.create_for_targets(
+            [pk for pk, local in targets.items() if not local],
+            type_,
+            since=post.state_changed,
+            subject_post=post,
+        )
 
     @classmethod
     def handle_new(cls, instance: "Post"):
@@ -762,67 +776,92 @@ class Post(StatorModel):
         """
         Returns a list of Identities that need to see posts and their changes
         """
-        targets = set()
-        for mention in self.mentions.all():
-            targets.add(mention)
+        return set(Identity.objects.filter(pk__in=self.get_target_ids()))
+
+    def get_target_ids(self) -> list[int]:
+        """
+        Returns the IDs of the Identities that need to see posts and their
+        changes (see get_target_locality)
+        """
+        return list(self.get_target_locality())
+
+    def get_target_locality(self) -> dict[int, bool]:
+        """
+        Returns the IDs of the Identities that need to see posts and their
+        changes, mapped to whether each is local, worked out in a single query:
+
+        - Mentions, and for public/unlisted posts everyone who interacted
+        - Unless it's mentions-only, active followers and hashtag followers
+        - If it's a reply, the original author, plus their followers if
+          they're one of ours
+        - The author themselves, if it's local
+        - Minus anyone the author has fully blocked, and only locals if it's
+          a remote or local-only post
+        - Only one identity per remote shared inbox
+        """
+        sources = [self.mentions.through.objects.filter(post=self).values("identity")]
         if self.visibility in [Post.Visibilities.public, Post.Visibilities.unlisted]:
-            for interaction in self.interactions.all():
-                targets.add(interaction.identity)
+            sources.append(self.interactions.values("identity"))
         # Then, if it's not mentions only, also deliver to followers and all hashtag followers
         if self.visibility != Post.Visibilities.mentioned:
-            for follower in self.author.inbound_follows.filter(
-                state__in=FollowStates.group_active()
-            ).select_related("source"):
-                targets.add(follower.source)
+            sources.append(
+                self.author.inbound_follows.filter(
+                    state__in=FollowStates.group_active()
+                ).values("source")
+            )
             if self.hashtags:
-                for follow in HashtagFollow.objects.by_hashtags(
-                    self.hashtags
-                ).prefetch_related("identity"):
-                    targets.add(follow.identity)
-
+                sources.append(
+                    HashtagFollow.objects.by_hashtags(self.hashtags).values("identity")
+                )
         # If it's a reply, always include the original author if we know them
         reply_post = self.in_reply_to_post()
         if reply_post:
-            targets.add(reply_post.author)
+            sources.append(
+                Identity.objects.filter(pk=reply_post.author_id).values("pk")
+            )
             # And if it's a reply to one of our own, we have to re-fan-out to
             # the original author's followers
             if reply_post.author.local:
-                for follower in reply_post.author.inbound_follows.filter(
-                    state__in=FollowStates.group_active()
-                ).select_related("source"):
-                    targets.add(follower.source)
-        # If this is a remote post or local-only, filter to only include
-        # local identities
-        if not self.local or self.visibility == Post.Visibilities.local_only:
-            targets = {target for target in targets if target.local}
+                sources.append(
+                    reply_post.author.inbound_follows.filter(
+                        state__in=FollowStates.group_active()
+                    ).values("source")
+                )
         # If it's a local post, include the author
         if self.local:
-            targets.add(self.author)
-        # Fetch the author's full blocks and remove them as targets
-        blocks = (
-            self.author.outbound_blocks.active()
-            .filter(mute=False)
-            .select_related("target")
+            sources.append(Identity.objects.filter(pk=self.author_id).values("pk"))
+        # The author's full blocks are removed from all of those
+        blocked = (
+            self.author.outbound_blocks.active().filter(mute=False).values("target")
         )
-        for block in blocks:
-            try:
-                targets.remove(block.target)
-            except KeyError:
-                pass
-        # Now dedupe the targets based on shared inboxes (we only keep one per
-        # shared inbox)
-        deduped_targets = set()
-        shared_inboxes = set()
-        for target in targets:
-            if target.local or not target.shared_inbox_uri:
-                deduped_targets.add(target)
-            elif target.shared_inbox_uri not in shared_inboxes:
-                shared_inboxes.add(target.shared_inbox_uri)
-                deduped_targets.add(target)
-            else:
-                # Their shared inbox is already being sent to
-                pass
-        return deduped_targets
+        parts = []
+        params: list = []
+        for queryset in sources:
+            sql, query_params = queryset.order_by().query.sql_with_params()
+            parts.append(f"({sql})")
+            params.extend(query_params)
+        sql, query_params = blocked.order_by().query.sql_with_params()
+        candidates = " UNION ".join(parts) + f" EXCEPT ({sql})"
+        params.extend(query_params)
+        # If this is a remote post or local-only, only include local identities
+        local_filter = ""
+        if not self.local or self.visibility == Post.Visibilities.local_only:
+            local_filter = "WHERE target.local"
+        # Dedupe the targets based on shared inboxes (we only keep one, the
+        # lowest ID, per shared inbox)
+        table = connection.ops.quote_name(Identity._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT DISTINCT ON (inbox_key) id, local FROM ("
+                f"SELECT target.id, target.local, CASE WHEN target.local "
+                f"OR target.shared_inbox_uri IS NULL THEN target.id::text "
+                f"ELSE target.shared_inbox_uri END AS inbox_key "
+                f"FROM {table} AS target "
+                f"JOIN ({candidates}) AS candidate(id) ON candidate.id = target.id "
+                f"{local_filter}) AS targets ORDER BY inbox_key, id",
+                params,
+            )
+            return dict(cursor.fetchall())
 
     ### ActivityPub (inbound) ###
 
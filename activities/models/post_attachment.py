@@ -35,6 +35,7 @@ class PostAttachment(StatorModel):
     )
 
     state = StateField(graph=PostAttachmentStates)
+    stator_lane = StatorModel.LANE_BULK
 
     mimetype = models.CharField(max_length=200)
 
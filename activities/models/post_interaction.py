@@ -1,3 +1,4 @@
+import logging
 from collections.abc import Iterable
 
 from django.db import models, transaction
@@ -8,12 +9,15 @@ from activities.models.post import Post
 from activities.models.post_types import QuestionData
 from core.ld import format_ld_date, get_str_or_id, parse_ld_date
 from core.snowflake import Snowflake
+from stator.exceptions import TryAgainLater
 from stator.models import State, StateField, StateGraph, StatorModel
 from users.models.identity import Identity
 
+logger = logging.getLogger(__name__)
+
 
 class PostInteractionStates(StateGraph):
-    new = State(try_interval=300)
+    new = State(try_interval=300, batch_size=20)
     fanned_out = State(externally_progressed=True)
     undone = State(try_interval=300)
     undone_fanned_out = State(delete_after=24 * 60 * 60)
@@ -26,6 +30,28 @@ class PostInteractionStates(StateGraph):
     def group_active(cls):
         return [cls.new, cls.fanned_out]
 
+    @classmethod
+    def handle_new_batch(cls, instances: list["PostInteraction"]):
+        """
+        Creates the fan-outs for a batch of new PostInteractions, fetching
+        their posts and identities up front; they all move to fanned_out
+        together in one query afterwards.
+        """
+        interactions = PostInteraction.objects.select_related(
+            "identity", "post", "post__author"
+        ).in_bulk([instance.pk for instance in instances])
+        results = {}
+        for pk, interaction in interactions.items():
+            # One bad interaction should not hold up the rest of the batch
+            try:
+                results[pk] = cls.handle_new(interaction)
+            except TryAgainLater as e:
+                results[pk] = e
+            except Exception as e:
+                logger.exception(e)
+                results[pk] = e
+        return results
+
     @classmethod
     def handle_new(cls, instance: "PostInteraction"):
         """
@@ -35,13 +61,13 @@ class PostInteractionStates(StateGraph):
         # to just local follows if it's a remote boost)
         # Pin: send Add activity to all people who follow this user
         if instance.type == instance.Types.boost or instance.type == instance.Types.pin:
-            for target in instance.get_targets():
-                FanOut.objects.create(
-                    type=FanOut.Types.interaction,
-                    identity=target,
-                    subject_post=instance.post,
-                    subject_post_interaction=instance,
-                )
+            FanOut.create_for_targets(
+                (target.id for target in instance.get_targets()),
+                FanOut.Types.interaction,
+                since=instance.state_changed,
+                subject_post=instance.post,
+                subject_post_interaction=instance,
+            )
         # Like: send a copy to the original post author only,
         # if the liker is local or they are
         elif instance.type == instance.Types.like:
@@ -67,9 +93,10 @@ class PostInteractionStates(StateGraph):
             raise ValueError("Cannot fan out unknown type")
         # And one for themselves if they're local and it's a boost
         if instance.type == PostInteraction.Types.boost and instance.identity.local:
-            FanOut.objects.create(
-                identity_id=instance.identity_id,
-                type=FanOut.Types.interaction,
+            FanOut.create_for_targets(
+                [instance.identity_id],
+                FanOut.Types.interaction,
+                since=instance.state_changed,
                 subject_post=instance.post,
                 subject_post_interaction=instance,
             )
@@ -83,16 +110,19 @@ class PostInteractionStates(StateGraph):
         # Undo Boost: send a copy to all people who follow this user
         # Undo Pin: send a Remove activity to all people who follow this user
         if instance.type == instance.Types.boost or instance.type == instance.Types.pin:
-            for follow in instance.identity.inbound_follows.select_related(
-                "source", "target"
-            ):
-                if follow.source.local or follow.target.local:
-                    FanOut.objects.create(
-                        type=FanOut.Types.undo_interaction,
-                        identity_id=follow.source_id,
-                        subject_post=instance.post,
-                        subject_post_interaction=instance,
-                    )
+            # Remote undos only need to reach our own followers
+            follows = instance.identity.inbound_follows.all()
+            if not instance.identity.local:
+                follows = follows.filter(source__local=True)
+            FanOut.create_for_targets(
+                follows.values_list("source_id", flat=True).iterator(
+                    chunk_size=FanOut.CREATE_CHUNK_SIZE
+                ),
+                FanOut.Types.undo_interaction,
+                since=instance.state_changed,
+                subject_post=instance.post,
+                subject_post_interaction=instance,
+            )
         # Undo Like: send a copy to the original post author only
         elif instance.type == instance.Types.like:
             FanOut.objects.create(
@@ -105,9 +135,10 @@ class PostInteractionStates(StateGraph):
             raise ValueError("Cannot fan out unknown type")
         # And one for themselves if they're local and it's a boost
         if instance.type == PostInteraction.Types.boost and instance.identity.local:
-            FanOut.objects.create(
-                identity_id=instance.identity_id,
-                type=FanOut.Types.undo_interaction,
+            FanOut.create_for_targets(
+                [instance.identity_id],
+                FanOut.Types.undo_interaction,
+                since=instance.state_changed,
                 subject_post=instance.post,
                 subject_post_interaction=instance,
             )
@@ -132,6 +163,7 @@ class PostInteraction(StatorModel):
 
     # The state the boost is in
     state = StateField(PostInteractionStates)
+    stator_lane = StatorModel.LANE_INTERACTIVE
 
     # The canonical object ID
     object_uri = models.CharField(max_length=500, blank=True, null=True, unique=True)
@@ -1,7 +1,9 @@
-from django.db import models
+from django.db import connection, models
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 
 from core.ld import format_ld_date
+from users.models import Block, Follow, FollowStates, Identity
 
 
 class TimelineEvent(models.Model):
@@ -124,6 +126,74 @@ class TimelineEvent(models.Model):
             defaults={"published": post.published or post.created},
         )[0]
 
+    @classmethod
+    def add_post_for_identities(cls, identity_ids: list[int], post):
+        """
+        Adds a post (and any mentions in it) to the timelines of many local
+        identities at once, with one INSERT ... SELECT for each, following the
+        same rules as add_post/add_mentioned when fanning out to each one.
+        """
+        published = post.published or post.created
+        # Nobody who has blocked or muted the author gets anything
+        recipients = Identity.objects.filter(pk__in=identity_ids).exclude(
+            Exists(
+                Block.objects.active().filter(
+                    source=OuterRef("pk"), target_id=post.author_id
+                )
+            )
+        )
+        mentions = post.mentions.through.objects.filter(post=post)
+        # If it's a reply, we only add it if they follow the author and at
+        # least one of the people mentioned, or they're mentioned, or it's a
+        # reply to them or the author
+        post_recipients = recipients
+        if post.in_reply_to:
+            follows = Follow.objects.filter(state__in=FollowStates.group_active())
+            post_recipients = post_recipients.filter(
+                Exists(follows.filter(source=OuterRef("pk"), target_id=post.author_id)),
+                Exists(
+                    mentions.filter(
+                        Exists(
+                            follows.filter(
+                                source=OuterRef(OuterRef("pk")),
+                                target=OuterRef("identity"),
+                            )
+                        )
+                        | models.Q(identity_id=post.author_id)
+                        | models.Q(identity=OuterRef("pk"))
+                    )
+                ),
+            )
+        # We might have been mentioned (but not by ourselves)
+        mentioned_recipients = recipients.filter(
+            Exists(mentions.filter(identity=OuterRef("pk")))
+        ).exclude(pk=post.author_id)
+        now = timezone.now()
+        for type, subject_identity_id, queryset in [
+            (cls.Types.post, None, post_recipients),
+            (cls.Types.mentioned, post.author_id, mentioned_recipients),
+        ]:
+            # Skip anyone who already has it, in case we're re-run
+            queryset = queryset.exclude(
+                Exists(
+                    cls.objects.filter(
+                        identity=OuterRef("pk"),
+                        type=type,
+                        subject_post=post,
+                    )
+                )
+            )
+            sql, params = queryset.order_by().values("pk").query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {connection.ops.quote_name(cls._meta.db_table)} "
+                    "(identity_id, type, subject_post_id, subject_identity_id, "
+                    "published, seen, dismissed, created) "
+                    "SELECT recipient.id, %s, %s, %s, %s, false, false, %s "
+                    f"FROM ({sql}) AS recipient(id)",
+                    [type, post.pk, subject_identity_id, published, now, *params],
+                )
+
     @classmethod
     def add_identity_created(cls, identity, new_identity):
         """
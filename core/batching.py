@@ -0,0 +1,100 @@
+import threading
+from collections.abc import Callable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class _Entry(Generic[T]):
+    def __init__(self, item: T):
+        self.item = item
+        self.error: BaseException | None = None
+        # Set once the item's written, or its thread has to write it
+        self.wake = threading.Event()
+        self.flusher = False
+
+
+class GroupCommitBuffer(Generic[T]):
+    """
+    Lets threads that each have an item to write share one write, without
+    any of them returning before their item is written.
+
+    The first thread to add an item becomes the flusher: it waits up to
+    `max_wait` seconds for others to join (or until there are `max_batch`
+    items), then calls `flush` with the batch. If more items piled up in the
+    meantime, it hands being the flusher on to the thread whose item is
+    next, which flushes the next batch straight away, and so on; nobody
+    flushes anything but the batch their own item is in. Everyone else just
+    waits for their batch to be done, and gets any exception `flush` raised.
+
+    With `max_wait` of 0, batches are just whatever piled up during the
+    previous flush, so a lone thread never waits for company.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[list[T]], None],
+        max_batch: int = 100,
+        max_wait: float = 0,
+    ):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets anything pending; for after a fork, when the threads waiting
+        on it (and maybe flushing it) stayed in the parent.
+        """
+        self.condition = threading.Condition()
+        self.pending: list[_Entry[T]] = []
+        self.flushing = False
+
+    def add(self, item: T) -> None:
+        """
+        Adds the item, returning once a flush including it has finished.
+        """
+        entry = _Entry(item)
+        with self.condition:
+            self.pending.append(entry)
+            self.condition.notify()
+            if not self.flushing:
+                self.flushing = entry.flusher = True
+        if entry.flusher:
+            self.flush_pending(wait=bool(self.max_wait))
+        else:
+            entry.wake.wait()
+            # We might have been handed the flush rather than had it done
+            if entry.flusher:
+                self.flush_pending(wait=False)
+        if entry.error is not None:
+            raise entry.error
+
+    def flush_pending(self, wait: bool):
+        """
+        Flushes the first batch of pending items, which the caller's item is
+        at the front of, then hands on being the flusher if there's more.
+        """
+        with self.condition:
+            if wait:
+                self.condition.wait_for(
+                    lambda: len(self.pending) >= self.max_batch,
+                    timeout=self.max_wait,
+                )
+            batch = self.pending[: self.max_batch]
+            del self.pending[: self.max_batch]
+        try:
+            self.flush([entry.item for entry in batch])
+        except BaseException as e:
+            for entry in batch:
+                entry.error = e
+        for entry in batch:
+            entry.wake.set()
+        with self.condition:
+            if self.pending:
+                successor = self.pending[0]
+                successor.flusher = True
+                successor.wake.set()
+            else:
+                self.flushing = False
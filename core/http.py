@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_client: httpx.Client | None = None
+_async_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, httpx.AsyncClient
+] = weakref.WeakKeyDictionary()
+_client_lock = threading.Lock()
+
+
+def client_options() -> dict:
+    """
+    Returns the settings shared by the sync and async clients.
+    """
+    return {
+        "http2": settings.SETUP.REMOTE_HTTP2 and HTTP2_AVAILABLE,
+        "timeout": settings.SETUP.REMOTE_TIMEOUT,
+        "headers": {"User-Agent": settings.TAKAHE_USER_AGENT},
+        "limits": httpx.Limits(
+            max_connections=settings.SETUP.REMOTE_POOL_CONNECTIONS,
+            max_keepalive_connections=settings.SETUP.REMOTE_POOL_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.SETUP.REMOTE_POOL_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def get_client() -> httpx.Client:
+    """
+    Returns the process-wide client for talking to other servers.
+
+    It keeps a pool of connections to each host alive between requests, so
+    sending lots of things to the same server only pays for the TCP and TLS
+    handshakes once. It's safe to share between threads; pass the timeout
+    and any headers with each request.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(**client_options())
+    return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the client for talking to other servers from coroutines, pooled
+    and set up the same way as get_client().
+
+    Its connections belong to the event loop that made them, so each loop
+    (in practice, just the async Stator runner's) gets its own; call this
+    from inside the loop that's going to use it.
+    """
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = httpx.AsyncClient(**client_options())
+    return client
+
+
+async def aclose_async_client():
+    """
+    Closes the running event loop's client, if it has one. Call this before
+    the loop finishes, as its connections can't be closed once it has.
+    """
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def reset_client():
+    """
+    Forgets the current clients, so the next request makes new ones. We
+    don't close them, as after a fork their connections belong to the parent.
+    """
+    global _client, _async_clients, _client_lock
+    _client = None
+    _async_clients = weakref.WeakKeyDictionary()
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_client)
@@ -0,0 +1,39 @@
+import threading
+import time
+
+from cachetools import LRUCache
+
+
+class TokenBuckets:
+    """
+    A token bucket per key (say, per remote server), each refilling at
+    `rate` tokens a second up to `burst`.
+
+    Taking from an empty bucket puts it into debt rather than failing, and
+    says how long until that token would have been there; callers can then
+    put the work off until then, and turn it away if that's too far off.
+    Only the most recently used `max_keys` buckets are kept.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        # key: (tokens, as of when)
+        self.buckets: LRUCache = LRUCache(maxsize=max_keys)
+        self.lock = threading.Lock()
+
+    def take(self, key: str, max_delay: float) -> float:
+        """
+        Takes a token for `key`, returning how many seconds until it's
+        really available (0 if it is now). If that's more than `max_delay`,
+        nothing is taken, and the caller should try again in the difference.
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            delay = max(0.0, (1 - tokens) / self.rate)
+            if delay <= max_delay:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+        return delay
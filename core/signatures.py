@@ -1,11 +1,14 @@
 import base64
+import hashlib
 import json
 import logging
+import threading
 from ssl import SSLCertVerificationError, SSLError
 from typing import Literal, TypedDict, cast
 from urllib.parse import urlparse
 
 import httpx
+from cachetools import LRUCache
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
@@ -17,10 +20,20 @@ from httpx._types import TimeoutTypes
 from idna.core import InvalidCodepoint
 from pyld import jsonld
 
+from core.http import get_async_client, get_client
 from core.ld import format_ld_date
 
 logger = logging.getLogger(__name__)
 
+# Loaded private keys, keyed by key ID and a hash of their PEM, as parsing a
+# PEM costs far more CPU than signing with the key once it's loaded
+private_key_cache: LRUCache = LRUCache(maxsize=1000)
+private_key_cache_lock = threading.Lock()
+
+# The same for remote actors' public keys, which we verify their messages with
+public_key_cache: LRUCache = LRUCache(maxsize=10000)
+public_key_cache_lock = threading.Lock()
+
 
 class VerificationError(BaseException):
     """
@@ -38,6 +51,33 @@ class VerificationFormatError(VerificationError):
     pass
 
 
+class RateLimited(ValueError):
+    """
+    The remote server told us to slow down (HTTP 429). If it said for how
+    long, retry_after is that many seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, uri: str, response: httpx.Response) -> "RateLimited":
+        # Retry-After is either a number of seconds or an HTTP date
+        header = response.headers.get("Retry-After", "").strip()
+        retry_after: float | None = None
+        if header.isdigit():
+            retry_after = int(header)
+        elif header:
+            try:
+                retry_after = max(
+                    parse_http_date(header) - timezone.now().timestamp(), 0
+                )
+            except ValueError:
+                pass
+        return cls(f"POST rate limited by {uri}", retry_after=retry_after)
+
+
 class RsaKeys:
     @classmethod
     def generate_keypair(cls) -> tuple[str, str]:
@@ -63,6 +103,60 @@ class RsaKeys:
         )
         return private_key_serialized, public_key_serialized
 
+    @classmethod
+    def load_private_key(
+        cls, private_key: str, key_id: str | None = None
+    ) -> rsa.RSAPrivateKey:
+        """
+        Returns the loaded key object for a PEM private key, only parsing it
+        the first time we see it.
+        """
+        key = (key_id, hashlib.sha256(private_key.encode("ascii")).digest())
+        with private_key_cache_lock:
+            private_key_instance = private_key_cache.get(key)
+        if private_key_instance is None:
+            private_key_instance = cast(
+                rsa.RSAPrivateKey,
+                serialization.load_pem_private_key(
+                    private_key.encode("ascii"),
+                    password=None,
+                ),
+            )
+            with private_key_cache_lock:
+                private_key_cache[key] = private_key_instance
+        return private_key_instance
+
+    @classmethod
+    def load_public_key(
+        cls, public_key: str, key_id: str | None = None
+    ) -> rsa.RSAPublicKey:
+        """
+        Returns the loaded key object for a PEM public key, only parsing it
+        the first time we see it.
+        """
+        key = (key_id, hashlib.sha256(public_key.encode("ascii")).digest())
+        with public_key_cache_lock:
+            public_key_instance = public_key_cache.get(key)
+        if public_key_instance is None:
+            public_key_instance = cast(
+                rsa.RSAPublicKey,
+                serialization.load_pem_public_key(public_key.encode("ascii")),
+            )
+            with public_key_cache_lock:
+                public_key_cache[key] = public_key_instance
+        return public_key_instance
+
+    @classmethod
+    def forget_private_keys(cls, key_id: str):
+        """
+        Drops any loaded private keys for the key ID, for when it's rotated.
+        (Other processes will still load the new key, as its PEM is
+        different, and their old one will just age out.)
+        """
+        with private_key_cache_lock:
+            for key in [key for key in private_key_cache if key[0] == key_id]:
+                del private_key_cache[key]
+
 
 class HttpSignature:
     """
@@ -135,11 +229,9 @@ class HttpSignature:
         signature: bytes,
         cleartext: str,
         public_key: str,
+        key_id: str | None = None,
     ):
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        public_key_instance = RsaKeys.load_public_key(public_key, key_id)
         try:
             public_key_instance.verify(
                 signature,
@@ -183,22 +275,22 @@ class HttpSignature:
             signature_details["signature"],
             headers_string,
             public_key,
+            signature_details["keyid"],
         )
 
     @classmethod
-    def signed_request(
+    def signed_headers(
         cls,
         uri: str,
-        body: dict | None,
+        body: dict | bytes | None,
         private_key: str,
         key_id: str,
         content_type: str = "application/activity+json",
         method: Literal["get", "post"] = "post",
-        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
-    ):
+    ) -> tuple[dict[str, str], bytes]:
         """
-        Performs an async request to the given path, with a document, signed
-        as an identity.
+        Returns the signed headers and encoded body for a request to the given
+        path, with a document, signed as an identity.
         """
         if "://" not in uri:
             raise ValueError("URI does not contain a scheme")
@@ -212,7 +304,10 @@ class HttpSignature:
         }
         # If we have a body, add a digest and content type
         if body is not None:
-            body_bytes = json.dumps(body).encode("utf8")
+            if isinstance(body, bytes):
+                body_bytes = body
+            else:
+                body_bytes = json.dumps(body).encode("utf8")
             headers["Digest"] = cls.calculate_digest(body_bytes)
             headers["Content-Type"] = content_type
         else:
@@ -224,13 +319,7 @@ class HttpSignature:
         signed_string = "\n".join(
             f"{name.lower()}: {value}" for name, value in headers.items()
         )
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = RsaKeys.load_private_key(private_key, key_id)
         signature = private_key_instance.sign(
             signed_string.encode("utf8"),
             padding.PKCS1v15(),
@@ -248,35 +337,104 @@ class HttpSignature:
         # Announce ourselves with an agent similar to Mastodon
         headers["User-Agent"] = settings.TAKAHE_USER_AGENT
 
-        # Send the request with all those headers except the pseudo one
+        # The pseudo one is only there to be signed, not sent
         del headers["(request-target)"]
-        with httpx.Client(timeout=timeout) as client:
-            try:
-                response = client.request(
-                    method,
-                    uri,
-                    headers=headers,
-                    content=body_bytes,
-                    follow_redirects=method == "get",
-                )
-            except SSLError as invalid_cert:
-                # Not our problem if the other end doesn't have proper SSL
-                logger.info("Invalid cert on %s %s", uri, invalid_cert)
-                raise SSLCertVerificationError(invalid_cert) from invalid_cert
-            except InvalidCodepoint as ex:
-                # Convert to a more generic error we handle
-                raise httpx.HTTPError(f"InvalidCodepoint: {str(ex)}") from None
-
-            if (
-                method == "post"
-                and response.status_code >= 400
-                and response.status_code < 500
-                and response.status_code != 404
-            ):
-                raise ValueError(
-                    f"POST error to {uri}: {response.status_code} {response.content!r}"
-                )
-            return response
+        return cast(dict[str, str], headers), body_bytes
+
+    @classmethod
+    def signed_request(
+        cls,
+        uri: str,
+        body: dict | bytes | None,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+        method: Literal["get", "post"] = "post",
+        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
+    ):
+        """
+        Performs a request to the given path, with a document, signed
+        as an identity. The document may be given already encoded as bytes.
+        """
+        headers, body_bytes = cls.signed_headers(
+            uri, body, private_key, key_id, content_type, method
+        )
+        client = get_client()
+        try:
+            response = client.request(
+                method,
+                uri,
+                headers=headers,
+                content=body_bytes,
+                follow_redirects=method == "get",
+                timeout=timeout,
+            )
+        except SSLError as invalid_cert:
+            # Not our problem if the other end doesn't have proper SSL
+            logger.info("Invalid cert on %s %s", uri, invalid_cert)
+            raise SSLCertVerificationError(invalid_cert) from invalid_cert
+        except InvalidCodepoint as ex:
+            # Convert to a more generic error we handle
+            raise httpx.HTTPError(f"InvalidCodepoint: {str(ex)}") from None
+        return cls.check_response(uri, method, response)
+
+    @classmethod
+    async def asigned_request(
+        cls,
+        uri: str,
+        body: dict | bytes | None,
+        private_key: str,
+        key_id: str,
+        content_type: str = "application/activity+json",
+        method: Literal["get", "post"] = "post",
+        timeout: TimeoutTypes = settings.SETUP.REMOTE_TIMEOUT,
+    ):
+        """
+        Async version of signed_request, which waits for the other server on
+        the running event loop rather than blocking a thread.
+        """
+        headers, body_bytes = cls.signed_headers(
+            uri, body, private_key, key_id, content_type, method
+        )
+        client = get_async_client()
+        try:
+            response = await client.request(
+                method,
+                uri,
+                headers=headers,
+                content=body_bytes,
+                follow_redirects=method == "get",
+                timeout=timeout,
+            )
+        except SSLError as invalid_cert:
+            # Not our problem if the other end doesn't have proper SSL
+            logger.info("Invalid cert on %s %s", uri, invalid_cert)
+            raise SSLCertVerificationError(invalid_cert) from invalid_cert
+        except InvalidCodepoint as ex:
+            # Convert to a more generic error we handle
+            raise httpx.HTTPError(f"InvalidCodepoint: {str(ex)}") from None
+        return cls.check_response(uri, method, response)
+
+    @classmethod
+    def check_response(
+        cls, uri: str, method: Literal["get", "post"], response: httpx.Response
+    ) -> httpx.Response:
+        """
+        Raises if a signed request's response means the other server refused
+        it, otherwise returns it.
+        """
+        if method == "post" and response.status_code == 429:
+            raise RateLimited.from_response(uri, response)
+        if (
+            method == "post"
+            and response.status_code >= 400
+            and response.status_code < 500
+            and response.status_code != 404
+        ):
+            raise ValueError(
+                f"POST error to {uri}: {response.status_code} {response.content!r}"
+            )
+        return response
 
 
 class HttpSignatureDetails(TypedDict):
@@ -314,10 +472,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Verify the signature
-        public_key_instance: rsa.RSAPublicKey = cast(
-            rsa.RSAPublicKey,
-            serialization.load_pem_public_key(public_key.encode("ascii")),
-        )
+        public_key_instance = RsaKeys.load_public_key(public_key, options["creator"])
         try:
             public_key_instance.verify(
                 base64.b64decode(signature["signatureValue"]),
@@ -344,13 +499,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Create the signature
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = RsaKeys.load_private_key(private_key, key_id)
         signature = base64.b64encode(
             private_key_instance.sign(
                 final_hash,
@@ -4,12 +4,19 @@ from stator.models import Stats
 
 
 @admin.register(Stats)
-class DomainAdmin(admin.ModelAdmin):
+class StatsAdmin(admin.ModelAdmin):
     list_display = [
         "model_label",
-        "updated",
+        "granularity",
+        "bucket",
+        "handled",
+        "queued",
+        "queue_age",
+        "duration_p50",
+        "duration_p95",
     ]
-    ordering = ["model_label"]
+    list_filter = ["model_label", "granularity"]
+    ordering = ["model_label", "granularity", "-bucket"]
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -2,4 +2,11 @@ class TryAgainLater(BaseException):
     """
     Special exception that Stator will catch without error,
     leaving a state to have another attempt soon.
+
+    If retry_after (in seconds) is given, that's when the next attempt will
+    be, rather than the state's usual retry delay.
     """
+
+    def __init__(self, *args, retry_after: float | None = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
@@ -1,3 +1,4 @@
+import random
 from collections.abc import Callable
 from typing import Any, ClassVar
 
@@ -13,6 +14,7 @@ class StateGraph:
     initial_state: ClassVar["State"]
     terminal_states: ClassVar[set["State"]]
     automatic_states: ClassVar[set["State"]]
+    batch_states: ClassVar[set["State"]]
     deletion_states: ClassVar[set["State"]]
 
     def __init_subclass__(cls) -> None:
@@ -34,6 +36,7 @@ class StateGraph:
         # Check the graph layout
         terminal_states = set()
         automatic_states = set()
+        batch_states = set()
         deletion_states = set()
         initial_state = None
         for state in cls.states.values():
@@ -67,18 +70,29 @@ class StateGraph:
                         raise ValueError(
                             f"State '{state}' has no try_interval and is not terminal or manual"
                         )
-                    try:
-                        state.handler
-                    except AttributeError:
-                        raise ValueError(
-                            f"State '{state}' does not have a handler method ({state.handler_name})"
-                        )
+                    # Batch states only need their batch handler
+                    if state.batch_size:
+                        try:
+                            state.batch_handler
+                        except AttributeError:
+                            raise ValueError(
+                                f"State '{state}' does not have a batch handler method ({state.batch_handler_name})"
+                            )
+                        batch_states.add(state)
+                    else:
+                        try:
+                            state.handler
+                        except AttributeError:
+                            raise ValueError(
+                                f"State '{state}' does not have a handler method ({state.handler_name})"
+                            )
                     automatic_states.add(state)
         if initial_state is None:
             raise ValueError("The graph has no initial state")
         cls.initial_state = initial_state
         cls.terminal_states = terminal_states
         cls.automatic_states = automatic_states
+        cls.batch_states = batch_states
         cls.deletion_states = deletion_states
         # Generate choices
         cls.choices = [(name, name) for name in cls.states.keys()]
@@ -93,17 +107,37 @@ class State:
         self,
         try_interval: float | None = None,
         handler_name: str | None = None,
+        async_handler_name: str | None = None,
         externally_progressed: bool = False,
         attempt_immediately: bool = True,
         force_initial: bool = False,
         delete_after: int | None = None,
+        batch_size: int | None = None,
+        batch_handler_name: str | None = None,
+        async_batch_handler_name: str | None = None,
+        backoff_factor: float = 1,
+        backoff_max: float | None = None,
+        backoff_jitter: float = 0,
     ):
         self.try_interval = try_interval
         self.handler_name = handler_name
+        # Async runners use a coroutine version of the handler instead, if
+        # the graph has one
+        self.async_handler_name = async_handler_name
         self.externally_progressed = externally_progressed
         self.attempt_immediately = attempt_immediately
         self.force_initial = force_initial
         self.delete_after = delete_after
+        # Batch states are handled up to batch_size instances at a time
+        self.batch_size = batch_size
+        self.batch_handler_name = batch_handler_name
+        self.async_batch_handler_name = async_batch_handler_name
+        # Each failed attempt multiplies the wait by backoff_factor, up to
+        # backoff_max seconds, then it's randomly moved by up to
+        # backoff_jitter (a fraction of it) so retries don't all line up
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.backoff_jitter = backoff_jitter
         # Deletes are also only attempted on try_intervals
         if self.delete_after and not self.try_interval:
             self.try_interval = self.delete_after
@@ -118,6 +152,12 @@ class State:
         self.graph.states[name] = self
         if self.handler_name is None:
             self.handler_name = f"handle_{self.name}"
+        if self.async_handler_name is None:
+            self.async_handler_name = f"ahandle_{self.name}"
+        if self.batch_handler_name is None:
+            self.batch_handler_name = f"handle_{self.name}_batch"
+        if self.async_batch_handler_name is None:
+            self.async_batch_handler_name = f"ahandle_{self.name}_batch"
 
     def __repr__(self):
         return f"<State {self.name}>"
@@ -145,6 +185,19 @@ class State:
         self.children.add(other)
         other.parents.add(other)
 
+    def retry_delay(self, attempts: int) -> float:
+        """
+        Returns how many seconds to wait before trying again, given how many
+        attempts have already failed in this state.
+        """
+        # Past this many doublings, we're way over any sensible backoff_max
+        delay = (self.try_interval or 0) * self.backoff_factor ** min(attempts, 64)
+        if self.backoff_max is not None:
+            delay = min(delay, self.backoff_max)
+        if self.backoff_jitter:
+            delay *= random.uniform(1 - self.backoff_jitter, 1 + self.backoff_jitter)
+        return delay
+
     @property
     def initial(self):
         return self.force_initial or (not self.parents)
@@ -159,3 +212,34 @@ class State:
         if self.handler_name is None:
             raise AttributeError("No handler defined")
         return getattr(self.graph, self.handler_name)
+
+    @property
+    def async_handler(self) -> Callable[[Any], Any] | None:
+        """
+        The coroutine version of the handler, if there is one; it takes and
+        returns the same things.
+        """
+        if self.async_handler_name is None:
+            return None
+        return getattr(self.graph, self.async_handler_name, None)
+
+    @property
+    def batch_handler(self) -> Callable[[list[Any]], dict[Any, str | None]]:
+        """
+        Batch handlers take a list of instances, and return a dict mapping
+        each instance's pk to the state to move it to (or None, to leave it
+        where it is). Instances missing from the dict are left alone.
+        """
+        if self.batch_handler_name is None:
+            raise AttributeError("No batch handler defined")
+        return getattr(self.graph, self.batch_handler_name)
+
+    @property
+    def async_batch_handler(self) -> Callable[[list[Any]], Any] | None:
+        """
+        The coroutine version of the batch handler, if there is one; it takes
+        and returns the same things.
+        """
+        if self.async_batch_handler_name is None:
+            return None
+        return getattr(self.graph, self.async_batch_handler_name, None)
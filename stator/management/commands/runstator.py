@@ -5,8 +5,10 @@ from django.apps import apps
 from django.core.management.base import BaseCommand
 
 from core.models import Config
+from stator.metrics import serve_metrics
 from stator.models import StatorModel
-from stator.runner import StatorRunner
+from stator.runner import AsyncStatorRunner, StatorRunner
+from stator.supervisor import StatorSupervisor
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +21,27 @@ class Command(BaseCommand):
             "--concurrency",
             "-c",
             type=int,
-            default=15,
-            help="How many tasks to run at once",
+            default=None,
+            help="How many tasks to run at once (defaults to 15, or 500 with --async)",
+        )
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            help="Run tasks as coroutines on one event loop rather than in threads",
+        )
+        parser.add_argument(
+            "--database-concurrency",
+            type=int,
+            default=None,
+            help="With --async, how many threads to use for blocking and database work",
+        )
+        parser.add_argument(
+            "--processes",
+            "-p",
+            type=int,
+            default=1,
+            help="How many runner processes to fork, each handling a shard of the rows",
         )
         parser.add_argument(
             "--liveness-file",
@@ -28,6 +49,15 @@ class Command(BaseCommand):
             default=None,
             help="A file to touch at least every 30 seconds to say the runner is alive",
         )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=None,
+            help=(
+                "A port to serve Prometheus metrics on, at /metrics "
+                "(with --processes, each process uses the next port up)"
+            ),
+        )
         parser.add_argument(
             "--schedule-interval",
             "-s",
@@ -54,8 +84,12 @@ class Command(BaseCommand):
     def handle(
         self,
         model_labels: list[str],
-        concurrency: int,
+        concurrency: int | None,
+        use_async: bool,
+        database_concurrency: int | None,
+        processes: int,
         liveness_file: str,
+        metrics_port: int | None,
         schedule_interval: int,
         run_for: int,
         exclude: list[str],
@@ -85,14 +119,46 @@ class Command(BaseCommand):
         logger.info(
             "Running for models: " + " ".join(m._meta.label_lower for m in models)
         )
-        # Run a runner
-        runner = StatorRunner(
-            models,
-            concurrency=concurrency,
-            liveness_file=liveness_file,
-            schedule_interval=schedule_interval,
-            run_for=run_for,
-        )
+
+        def make_runner(
+            shard: tuple[int, int] | None, liveness_file: str | None
+        ) -> StatorRunner:
+            if metrics_port:
+                serve_metrics(metrics_port + (shard[0] if shard else 0))
+            if use_async:
+                async_options = {}
+                if concurrency is not None:
+                    async_options["concurrency"] = concurrency
+                if database_concurrency is not None:
+                    async_options["database_concurrency"] = database_concurrency
+                return AsyncStatorRunner(
+                    models,
+                    liveness_file=liveness_file,
+                    schedule_interval=schedule_interval,
+                    run_for=run_for,
+                    shard=shard,
+                    **async_options,
+                )
+            return StatorRunner(
+                models,
+                concurrency=concurrency or 15,
+                liveness_file=liveness_file,
+                schedule_interval=schedule_interval,
+                run_for=run_for,
+                shard=shard,
+            )
+
+        # Run a runner, or a supervisor that forks several
+        runner: StatorRunner | StatorSupervisor
+        if processes > 1:
+            runner = StatorSupervisor(
+                processes,
+                runner_factory=make_runner,
+                liveness_file=liveness_file,
+                run_for=run_for,
+            )
+        else:
+            runner = make_runner(None, liveness_file)
         try:
             runner.run()
         except KeyboardInterrupt:
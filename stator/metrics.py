@@ -0,0 +1,100 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# What happened when a transition was attempted
+OUTCOME_SUCCESS = "success"
+OUTCOME_UNCHANGED = "unchanged"
+OUTCOME_TRY_AGAIN_LATER = "try_again_later"
+OUTCOME_EXCEPTION = "exception"
+OUTCOME_TIMEOUT = "timeout"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class TransitionMetrics:
+    """
+    In-process histograms of how long transitions take, by model, state and
+    outcome, which can be rendered in the Prometheus text format.
+
+    Each process has its own; Prometheus adds them up across processes.
+    """
+
+    # Upper bounds, in seconds; there's an implicit +Inf after these
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (model, state, outcome) -> [per-bucket counts..., +Inf count, sum]
+        self.histograms: dict[tuple[str, str, str], list[float]] = {}
+
+    def observe(self, model_label: str, state: str, outcome: str, duration: float):
+        key = (model_label, state, outcome)
+        index = bisect.bisect_left(self.BUCKETS, duration)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            histogram = self.histograms[key]
+            histogram[index] += 1
+            histogram[-1] += duration
+
+    def render(self) -> str:
+        """
+        Returns all the histograms in the Prometheus text exposition format.
+        """
+        name = "stator_transition_duration_seconds"
+        lines = [
+            f"# HELP {name} How long Stator transition attempts take, by outcome.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        for (model_label, state, outcome), histogram in sorted(histograms.items()):
+            labels = f'model="{model_label}",state="{state}",outcome="{outcome}"'
+            cumulative: float = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram[-1]}")
+            lines.append(f"{name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+transition_metrics = TransitionMetrics()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = transition_metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are far too frequent to log at info
+        logger.debug(format, *args)
+
+
+def serve_metrics(port: int, host: str = "") -> ThreadingHTTPServer:
+    """
+    Serves /metrics on the given port from a background thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="stator-metrics", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on port {server.server_port}")
+    return server
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.30 on 2026-10-16 09:12
+import datetime
+
+from django.db import migrations, models
+
+
+def stats_copy_buckets(apps, schema_editor):
+    """
+    Copies the handled counts out of the old per-model JSON blobs into
+    time series rows (queue lengths only lasted two hours, so we skip them).
+    """
+    OldStats = apps.get_model("stator", "oldstats")
+    Stats = apps.get_model("stator", "stats")
+    rows = []
+    for old in OldStats.objects.all():
+        statistics = old.statistics or {}
+        for granularity, key in [
+            ("hour", "hourly"),
+            ("day", "daily"),
+            ("month", "monthly"),
+        ]:
+            for timestamp, handled in statistics.get(key, {}).items():
+                rows.append(
+                    Stats(
+                        model_label=old.model_label,
+                        granularity=granularity,
+                        bucket=datetime.datetime.fromtimestamp(
+                            int(timestamp), tz=datetime.timezone.utc
+                        ),
+                        handled=handled,
+                    )
+                )
+    Stats.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stator", "0002_stats_delete_statorerror"),
+    ]
+
+    operations = [
+        migrations.RenameModel(
+            old_name="Stats",
+            new_name="OldStats",
+        ),
+        migrations.CreateModel(
+            name="Stats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("model_label", models.CharField(max_length=200)),
+                (
+                    "granularity",
+                    models.CharField(
+                        choices=[("hour", "Hour"), ("day", "Day"), ("month", "Month")],
+                        max_length=10,
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("handled", models.BigIntegerField(default=0)),
+                ("queued", models.IntegerField(blank=True, null=True)),
+                ("queue_age", models.FloatField(blank=True, null=True)),
+                ("duration_p50", models.FloatField(blank=True, null=True)),
+                ("duration_p95", models.FloatField(blank=True, null=True)),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "Stats",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="stats",
+            constraint=models.UniqueConstraint(
+                fields=("model_label", "granularity", "bucket"),
+                name="stator_stats_unique_bucket",
+            ),
+        ),
+        migrations.RunPython(stats_copy_buckets, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name="OldStats",
+        ),
+    ]
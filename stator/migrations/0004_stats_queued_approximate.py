@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-16 20:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stator", "0003_stats_time_series"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stats",
+            name="queued_approximate",
+            field=models.BooleanField(default=False),
+        ),
+    ]
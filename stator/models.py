@@ -1,18 +1,67 @@
 import datetime
+import json
 import logging
+from collections.abc import Iterable
 from typing import ClassVar
 
-from asgiref.sync import async_to_sync, iscoroutinefunction
-from django.db import models, transaction
-from django.db.models.signals import class_prepared
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, models
+from django.db.models.functions import Abs, Cast, Coalesce, Mod
+from django.db.models.signals import class_prepared, post_save
 from django.utils import timezone
 from django.utils.functional import classproperty
 
 from stator.exceptions import TryAgainLater
 from stator.graph import State, StateGraph
+from stator.metrics import (
+    OUTCOME_EXCEPTION,
+    OUTCOME_SUCCESS,
+    OUTCOME_TIMEOUT,
+    OUTCOME_TRY_AGAIN_LATER,
+    OUTCOME_UNCHANGED,
+)
 
 logger = logging.getLogger(__name__)
 
+# The PostgreSQL LISTEN/NOTIFY channel runners wait on for new work
+NOTIFY_CHANNEL = "stator"
+
+
+async def run_sync(func, *args):
+    """
+    Runs a blocking function (usually one that touches the ORM) in the
+    running loop's default executor, tidying up that thread's database
+    connection afterwards the same way a threaded runner task would.
+    """
+
+    def call_and_close():
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    return await sync_to_async(call_and_close, thread_sensitive=False)()
+
+
+def call_handler(handler, argument):
+    """
+    Calls a state handler from sync code, whether or not it is a coroutine.
+    """
+    if iscoroutinefunction(handler):
+        return async_to_sync(handler)(argument)
+    return handler(argument)
+
+
+async def acall_handler(handler, argument):
+    """
+    Calls a state handler from async code - coroutine handlers run on the
+    current loop, while sync handlers are sent off to the executor.
+    """
+    if iscoroutinefunction(handler):
+        return await handler(argument)
+    return await run_sync(handler, argument)
+
 
 class StateField(models.CharField):
     """
@@ -69,6 +118,26 @@ def add_stator_indexes(sender, **kwargs):
 class_prepared.connect(add_stator_indexes)
 
 
+def notify_created(sender, instance, created, **kwargs):
+    """
+    Wakes up runners when a new instance starts out ready to run.
+    """
+    if created and instance.state_next_attempt is None:
+        state = sender.state_graph.states[
+            getattr(instance.state, "name", instance.state)
+        ]
+        if state in sender.state_graph.automatic_states:
+            sender.transition_notify()
+
+
+def connect_stator_signals(sender, **kwargs):
+    if issubclass(sender, StatorModel) and not sender._meta.abstract:
+        post_save.connect(notify_created, sender=sender)
+
+
+class_prepared.connect(connect_stator_signals)
+
+
 class StatorModel(models.Model):
     """
     A model base class that has a state machine backing it, with tasks to work
@@ -81,14 +150,30 @@ class StatorModel(models.Model):
     CLEAN_BATCH_SIZE = 1000
     DELETE_BATCH_SIZE = 500
 
+    # Priority lanes for the runner; lower lanes get first pick of capacity
+    LANE_INTERACTIVE = 0
+    LANE_DEFAULT = 1
+    LANE_BULK = 2
+
     state: StateField
 
+    # Which lane this model's transitions run in, and its share of capacity
+    # relative to other models in the same lane (see stator.scheduler)
+    stator_lane: ClassVar[int] = LANE_DEFAULT
+    stator_weight: ClassVar[int] = 1
+
+    # Fields to claim ready instances in the order of (by default, any order)
+    stator_claim_order: ClassVar[list[str]] = []
+
     # When the state last actually changed, or the date of instance creation
     state_changed = models.DateTimeField(auto_now_add=True)
 
     # When the next state change should be attempted (null means immediately)
     state_next_attempt = models.DateTimeField(blank=True, null=True)
 
+    # How many attempts have failed to move it out of its current state
+    state_attempts = models.IntegerField(default=0)
+
     # If a lock is out on this row, when it is locked until
     # (we don't identify the lock owner, as there's no heartbeats)
     state_locked_until = models.DateTimeField(null=True, blank=True, db_index=True)
@@ -96,6 +181,9 @@ class StatorModel(models.Model):
     # Collection of subclasses of us
     subclasses: ClassVar[list[type["StatorModel"]]] = []
 
+    # How the last transition attempt on this instance went (for metrics)
+    transition_outcome: str | None = None
+
     class Meta:
         abstract = True
 
@@ -113,29 +201,94 @@ class StatorModel(models.Model):
 
     @classmethod
     def transition_get_with_lock(
-        cls, number: int, lock_expiry: datetime.datetime
+        cls,
+        number: int,
+        lock_expiry: datetime.datetime,
+        states: Iterable[State] | None = None,
+        shard: tuple[int, int] | None = None,
     ) -> list["StatorModel"]:
         """
         Returns up to `number` tasks for execution, having locked them.
+        Only instances in the given `states` are returned, if it is provided
+        (otherwise, any state with a handler), and only those in `shard`
+        (see transition_shard_queryset) if that is.
+
+        Rows are claimed and returned by a single UPDATE ... RETURNING whose
+        selection uses FOR UPDATE SKIP LOCKED, so concurrent runners each
+        grab a different set of rows rather than queueing up behind each
+        other's row locks. The selection is a materialized CTE, as
+        PostgreSQL may re-run a LIMITed subquery in an IN () - which, with
+        SKIP LOCKED, picks different rows and claims more than `number`.
         """
-        with transaction.atomic():
-            # Query for `number` rows that:
-            #  - Have a next_attempt that's either null or in the past
-            #  - Have one of the states we care about
-            # Then, sort them by next_attempt NULLS FIRST, so that we handle the
-            # rows in a roughly FIFO order.
-            selected = list(
-                cls.objects.filter(
-                    models.Q(state_next_attempt__isnull=True)
-                    | models.Q(state_next_attempt__lte=timezone.now()),
-                    state__in=cls.state_graph.automatic_states,
-                    state_locked_until__isnull=True,
-                )[:number].select_for_update()
+        if states is None:
+            states = cls.state_graph.automatic_states
+        states = list(states)
+        if number <= 0 or not states:
+            return []
+        # Query for `number` rows that:
+        #  - Have a next_attempt that's either null or in the past
+        #  - Have one of the states we care about
+        #  - Are not locked by another runner
+        select_query = cls.objects.filter(
+            models.Q(state_next_attempt__isnull=True)
+            | models.Q(state_next_attempt__lte=timezone.now()),
+            state__in=states,
+            state_locked_until__isnull=True,
+        )
+        if shard is not None:
+            select_query = cls.transition_shard_queryset(select_query, shard)
+        select_query = cls.transition_claim_order(select_query)
+        select_query = select_query.values("pk")[:number]
+        select_sql, select_params = select_query.query.sql_with_params()
+        # Django will only compile FOR UPDATE inside a transaction, so we
+        # append it ourselves; it's a single statement, so autocommit is fine.
+        select_sql += " " + connection.ops.for_update_sql(skip_locked=True)
+        table = connection.ops.quote_name(cls._meta.db_table)
+        pk_column = connection.ops.quote_name(cls._meta.pk.column)
+        return list(
+            cls.objects.raw(
+                f"WITH claimed AS MATERIALIZED ({select_sql}) "
+                f"UPDATE {table} SET state_locked_until = %s "
+                f"WHERE {pk_column} IN (SELECT * FROM claimed) RETURNING *",
+                [*select_params, lock_expiry],
             )
-            cls.objects.filter(pk__in=[i.pk for i in selected]).update(
-                state_locked_until=lock_expiry
+        )
+
+    @classmethod
+    def transition_claim_order(cls, queryset: models.QuerySet) -> models.QuerySet:
+        """
+        Orders the due instances a claim picks from: by stator_claim_order,
+        or in whatever order PostgreSQL likes if that's empty.
+        """
+        if cls.stator_claim_order:
+            return queryset.order_by(*cls.stator_claim_order)
+        return queryset
+
+    @classmethod
+    def transition_shard_queryset(
+        cls, queryset: models.QuerySet, shard: tuple[int, int]
+    ) -> models.QuerySet:
+        """
+        Filters the queryset down to one of several disjoint shards, given
+        as (index, count), so that runner processes can split up the rows.
+
+        We hash the primary key rather than using it directly: string keys
+        need hashing anyway, and snowflake IDs keep their type in the low
+        bits, so `pk % count` would put every post in the same shard.
+        """
+        index, count = shard
+        if count <= 1:
+            return queryset
+        pk_hash = models.Func(
+            Cast("pk", output_field=models.TextField()),
+            function="hashtext",
+            output_field=models.IntegerField(),
+        )
+        return queryset.alias(
+            stator_shard=Mod(
+                Abs(Cast(pk_hash, output_field=models.BigIntegerField())), count
             )
-        return selected
+        ).filter(stator_shard=index)
 
     @classmethod
     def transition_delete_due(cls) -> int | None:
@@ -161,16 +314,81 @@ class StatorModel(models.Model):
         return None
 
     @classmethod
-    def transition_ready_count(cls) -> int:
+    def transition_ready_queryset(cls) -> models.QuerySet:
         """
-        Returns how many instances are "queued"
+        Returns a queryset of the instances that are "queued" - ready to run
+        and not already claimed.
         """
         return cls.objects.filter(
             models.Q(state_next_attempt__isnull=True)
             | models.Q(state_next_attempt__lte=timezone.now()),
             state_locked_until__isnull=True,
             state__in=cls.state_graph.automatic_states,
-        ).count()
+        )
+
+    @classmethod
+    def transition_ready_count(cls) -> int:
+        """
+        Returns how many instances are "queued"
+        """
+        return cls.transition_ready_queryset().count()
+
+    @classmethod
+    def transition_ready_estimate(cls, limit: int) -> tuple[int, bool]:
+        """
+        Returns roughly how many instances are "queued", and if that is
+        approximate, without ever counting more than `limit` rows; past that,
+        we ask the query planner how many it thinks there are instead.
+        """
+        queryset = cls.transition_ready_queryset()
+        count = queryset[: limit + 1].count()
+        if count <= limit:
+            return count, False
+        estimate = 0
+        if connection.vendor == "postgresql":
+            plan = json.loads(queryset.explain(format="json"))
+            estimate = int(plan[0]["Plan"]["Plan Rows"])
+        # The planner can't be less right than the rows we just counted
+        return max(estimate, limit), True
+
+    @classmethod
+    def transition_ready_age(cls, limit: int | None = None) -> float:
+        """
+        Returns how long, in seconds, the oldest "queued" instance has been
+        ready to run for.
+
+        If `limit` is given, only that many queued rows are looked at, so the
+        answer may be a little young on huge queues - but it comes back fast.
+        """
+        now = timezone.now()
+        queryset = cls.transition_ready_queryset()
+        if limit:
+            queryset = queryset[:limit]
+        oldest = queryset.aggregate(
+            oldest=models.Min(Coalesce("state_next_attempt", "state_changed"))
+        )["oldest"]
+        if oldest is None:
+            return 0
+        return max((now - oldest).total_seconds(), 0)
+
+    @classmethod
+    def transition_notify(cls):
+        """
+        Tells any listening runners there is new work ready for this model.
+
+        Notifications sent inside a transaction are only delivered when it
+        commits (and duplicates are merged), so this is safe to call often.
+        """
+        if (
+            not getattr(settings, "STATOR_NOTIFY", True)
+            or connection.vendor != "postgresql"
+        ):
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_notify(%s, %s)",
+                [NOTIFY_CHANNEL, cls._meta.label_lower],
+            )
 
     @classmethod
     def transition_clean_locks(cls):
@@ -186,38 +404,230 @@ class StatorModel(models.Model):
         """
         Attempts to transition the current state by running its handler(s).
         """
-        current_state: State = self.state_graph.states[self.state]
+        self.transition_outcome = None
+        current_state = self.transition_current_state()
+        if current_state is None:
+            return None
+        # Batch states can still be handled one instance at a time, as a
+        # batch of one (so per-instance exceptions are handled the same way)
+        if current_state.batch_size:
+            return self.transition_attempt_batch([self]).get(self.pk)
 
-        # If it's a manual progression state don't even try
-        # We shouldn't really be here in this case, but it could be a race condition
-        if current_state.externally_progressed:
-            logger.warning(
-                f"Warning: trying to progress externally progressed state {self.state}!"
-            )
+        # Try running its handler function
+        retry_after = None
+        try:
+            next_state = call_handler(current_state.handler, self)
+        except TryAgainLater as e:
+            self.transition_outcome = OUTCOME_TRY_AGAIN_LATER
+            retry_after = e.retry_after
+            next_state = None
+        except BaseException as e:
+            logger.exception(e)
+            self.transition_outcome = OUTCOME_EXCEPTION
+            next_state = None
+        return self.transition_complete(current_state, next_state, retry_after)
+
+    async def atransition_attempt(self) -> State | None:
+        """
+        Async version of transition_attempt for runners with an event loop.
+
+        Coroutine handlers (including a state's ahandle_<state> version of
+        its handler, if it has one) are awaited directly on the running loop;
+        sync handlers and all database writes are run in the loop's default
+        executor, so they never block it.
+        """
+        self.transition_outcome = None
+        current_state = self.transition_current_state()
+        if current_state is None:
             return None
+        if current_state.batch_size:
+            return (await self.atransition_attempt_batch([self])).get(self.pk)
 
         # Try running its handler function
+        retry_after = None
         try:
-            if iscoroutinefunction(current_state.handler):
-                next_state = async_to_sync(current_state.handler)(self)
-            else:
-                next_state = current_state.handler(self)
-        except TryAgainLater:
-            pass
+            handler = current_state.async_handler or current_state.handler
+            next_state = await acall_handler(handler, self)
+        except TryAgainLater as e:
+            self.transition_outcome = OUTCOME_TRY_AGAIN_LATER
+            retry_after = e.retry_after
+            next_state = None
         except BaseException as e:
             logger.exception(e)
-        else:
-            if next_state:
+            self.transition_outcome = OUTCOME_EXCEPTION
+            next_state = None
+        return await run_sync(
+            self.transition_complete, current_state, next_state, retry_after
+        )
+
+    @classmethod
+    def transition_attempt_batch(
+        cls, instances: list["StatorModel"]
+    ) -> dict[object, State | None]:
+        """
+        Attempts to transition a batch of instances, all in the same batch
+        state, with a single call to that state's batch handler.
+        Returns the new state (or None) for each instance's pk.
+        """
+        cls.set_transition_outcomes(instances, None)
+        current_state = instances[0].transition_current_state()
+        if current_state is None:
+            return {}
+        try:
+            results = call_handler(current_state.batch_handler, instances)
+        except TryAgainLater as e:
+            cls.set_transition_outcomes(instances, OUTCOME_TRY_AGAIN_LATER)
+            results = {instance.pk: e for instance in instances}
+        except BaseException as e:
+            logger.exception(e)
+            cls.set_transition_outcomes(instances, OUTCOME_EXCEPTION)
+            results = {}
+        return cls.transition_complete_batch(current_state, instances, results)
+
+    @classmethod
+    async def atransition_attempt_batch(
+        cls, instances: list["StatorModel"]
+    ) -> dict[object, State | None]:
+        """
+        Async version of transition_attempt_batch, which uses the state's
+        coroutine batch handler if it has one.
+        """
+        cls.set_transition_outcomes(instances, None)
+        current_state = instances[0].transition_current_state()
+        if current_state is None:
+            return {}
+        handler = current_state.async_batch_handler or current_state.batch_handler
+        try:
+            results = await acall_handler(handler, instances)
+        except TryAgainLater as e:
+            cls.set_transition_outcomes(instances, OUTCOME_TRY_AGAIN_LATER)
+            results = {instance.pk: e for instance in instances}
+        except BaseException as e:
+            logger.exception(e)
+            cls.set_transition_outcomes(instances, OUTCOME_EXCEPTION)
+            results = {}
+        return await run_sync(
+            cls.transition_complete_batch, current_state, instances, results
+        )
+
+    @classmethod
+    def transition_complete_batch(
+        cls,
+        current_state: State,
+        instances: list["StatorModel"],
+        results: dict[object, State | str | BaseException | None],
+    ) -> dict[object, State | None]:
+        """
+        Applies the results of a batch handler, with one UPDATE per
+        resulting state rather than one per instance.
+        """
+        outcomes: dict[object, State | None] = {}
+        by_state: dict[State, list] = {}
+        # Instances to retry, by how long to wait
+        by_delay: dict[float, list] = {}
+        attempt_delays: dict[int, float] = {}
+        states: dict[str, State] = cls.state_graph.states
+        for instance in instances:
+            result = results.get(instance.pk)
+            next_state: State | None = None
+            retry_after = None
+            # Handlers can report a failure for just one instance by giving
+            # the exception as its result
+            if isinstance(result, BaseException):
+                if isinstance(result, TryAgainLater):
+                    instance.transition_outcome = OUTCOME_TRY_AGAIN_LATER
+                    retry_after = result.retry_after
+                else:
+                    instance.transition_outcome = OUTCOME_EXCEPTION
+            elif isinstance(result, str):
                 # Ensure it's a State object
-                if isinstance(next_state, str):
-                    next_state = self.state_graph.states[next_state]
+                next_state = states[result]
+            else:
+                next_state = result
+            if next_state:
                 # Ensure it's a child
                 if next_state not in current_state.children:
                     raise ValueError(
                         f"Cannot transition from {current_state} to {next_state} - not a declared transition"
                     )
-                self.transition_perform(next_state)
-                return next_state
+                outcome = OUTCOME_SUCCESS
+            elif (
+                current_state.timeout_value
+                and current_state.timeout_value <= instance.state_age
+            ):
+                next_state = current_state.timeout_state
+                outcome = OUTCOME_TIMEOUT
+            else:
+                outcome = OUTCOME_UNCHANGED
+            if next_state:
+                by_state.setdefault(next_state, []).append(instance.pk)
+            else:
+                # Instances on the same attempt share a (jittered) delay, so
+                # we need an UPDATE per attempt count, not per instance
+                if retry_after is None:
+                    if instance.state_attempts not in attempt_delays:
+                        attempt_delays[
+                            instance.state_attempts
+                        ] = current_state.retry_delay(instance.state_attempts)
+                    retry_after = attempt_delays[instance.state_attempts]
+                by_delay.setdefault(retry_after, []).append(instance.pk)
+            outcomes[instance.pk] = next_state
+            # Handler errors are more interesting than what happened after
+            if instance.transition_outcome is None:
+                instance.transition_outcome = outcome
+        for state, pks in by_state.items():
+            cls.transition_perform_queryset(cls.objects.filter(pk__in=pks), state)
+        # Set next execution and unlock everything that did not change
+        for delay, pks in by_delay.items():
+            cls.transition_reschedule_queryset(cls.objects.filter(pk__in=pks), delay)
+        return outcomes
+
+    @classmethod
+    def set_transition_outcomes(
+        cls, instances: list["StatorModel"], outcome: str | None
+    ):
+        for instance in instances:
+            instance.transition_outcome = outcome
+
+    def transition_current_state(self) -> State | None:
+        """
+        Returns the current state if it is one we should run a handler for.
+        """
+        current_state: State = self.state_graph.states[self.state]
+
+        # If it's a manual progression state don't even try
+        # We shouldn't really be here in this case, but it could be a race condition
+        if current_state.externally_progressed:
+            logger.warning(
+                f"Warning: trying to progress externally progressed state {self.state}!"
+            )
+            return None
+        return current_state
+
+    def transition_complete(
+        self,
+        current_state: State,
+        next_state: State | str | None,
+        retry_after: float | None = None,
+    ) -> State | None:
+        """
+        Applies the result of running a state's handler - either moving to the
+        new state, timing out, or scheduling the next attempt (after
+        `retry_after` seconds, if the handler asked for it).
+        """
+        if next_state:
+            # Ensure it's a State object
+            if isinstance(next_state, str):
+                states: dict[str, State] = self.state_graph.states
+                next_state = states[next_state]
+            # Ensure it's a child
+            if next_state not in current_state.children:
+                raise ValueError(
+                    f"Cannot transition from {current_state} to {next_state} - not a declared transition"
+                )
+            self.transition_perform(next_state)
+            self.transition_outcome = self.transition_outcome or OUTCOME_SUCCESS
+            return next_state
 
         # See if it timed out since its last state change
         if (
@@ -226,14 +636,15 @@ class StatorModel(models.Model):
             <= (timezone.now() - self.state_changed).total_seconds()
         ):
             self.transition_perform(current_state.timeout_state)  # type: ignore
+            self.transition_outcome = self.transition_outcome or OUTCOME_TIMEOUT
             return current_state.timeout_state
 
         # Nothing happened, set next execution and unlock it
-        self.__class__.objects.filter(pk=self.pk).update(
-            state_next_attempt=(
-                timezone.now() + datetime.timedelta(seconds=current_state.try_interval)  # type: ignore
-            ),
-            state_locked_until=None,
+        self.transition_outcome = self.transition_outcome or OUTCOME_UNCHANGED
+        if retry_after is None:
+            retry_after = current_state.retry_delay(self.state_attempts)
+        self.transition_reschedule_queryset(
+            self.__class__.objects.filter(pk=self.pk), retry_after
         )
         return None
 
@@ -246,6 +657,18 @@ class StatorModel(models.Model):
             state,
         )
 
+    @classmethod
+    def transition_reschedule_queryset(cls, queryset: models.QuerySet, delay: float):
+        """
+        Counts a failed attempt for every instance in the queryset, and
+        unlocks them to be tried again in `delay` seconds.
+        """
+        queryset.update(
+            state_next_attempt=timezone.now() + datetime.timedelta(seconds=delay),
+            state_locked_until=None,
+            state_attempts=models.F("state_attempts") + 1,
+        )
+
     @classmethod
     def transition_perform_queryset(
         cls,
@@ -262,12 +685,15 @@ class StatorModel(models.Model):
             state_obj = cls.state_graph.states[state]
         # See if it's ready immediately (if not, delay until first try_interval)
         if state_obj.attempt_immediately or state_obj.try_interval is None:
-            queryset.update(
+            updated = queryset.update(
                 state=state_obj,
                 state_changed=timezone.now(),
                 state_next_attempt=None,
                 state_locked_until=None,
+                state_attempts=0,
             )
+            if updated and state_obj in cls.state_graph.automatic_states:
+                cls.transition_notify()
         else:
             queryset.update(
                 state=state_obj,
@@ -276,125 +702,170 @@ class StatorModel(models.Model):
                     timezone.now() + datetime.timedelta(seconds=state_obj.try_interval)
                 ),
                 state_locked_until=None,
+                state_attempts=0,
             )
 
 
 class Stats(models.Model):
     """
-    Tracks summary statistics of each model over time.
+    Summary statistics of each model over time, as a row per model per
+    hour/day/month bucket.
+
+    Runners add to these with a single upsert each, so any number of them
+    can report at once without losing each other's counts.
     """
 
+    class Granularity(models.TextChoices):
+        hour = "hour"
+        day = "day"
+        month = "month"
+
+    # How long we keep each granularity for
+    HORIZONS = {
+        Granularity.hour: datetime.timedelta(hours=50),
+        Granularity.day: datetime.timedelta(days=62),
+        Granularity.month: datetime.timedelta(days=3653),
+    }
+
     # appname.modelname (lowercased) label for the model this represents
-    model_label = models.CharField(max_length=200, primary_key=True)
+    model_label = models.CharField(max_length=200)
 
-    statistics = models.JSONField()
+    granularity = models.CharField(max_length=10, choices=Granularity.choices)
+
+    # The start of the time period this row covers
+    bucket = models.DateTimeField()
+
+    # How many instances were picked up to run (a counter)
+    handled = models.BigIntegerField(default=0)
+
+    # The most recent queue length and age seen in the period (gauges)
+    queued = models.IntegerField(null=True, blank=True)
+    queue_age = models.FloatField(null=True, blank=True)
+
+    # If queued was too big to count, and is an estimate
+    queued_approximate = models.BooleanField(default=False)
+
+    # Transition durations, in seconds. Each runner reports its own
+    # percentiles; these are their average, weighted by handled count.
+    duration_p50 = models.FloatField(null=True, blank=True)
+    duration_p95 = models.FloatField(null=True, blank=True)
 
-    created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name_plural = "Stats"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["model_label", "granularity", "bucket"],
+                name="stator_stats_unique_bucket",
+            ),
+        ]
 
     @classmethod
-    def get_for_model(cls, model: type[StatorModel]) -> "Stats":
-        instance = cls.objects.filter(model_label=model._meta.label_lower).first()
-        if instance is None:
-            instance = cls(model_label=model._meta.label_lower)
-        if not instance.statistics:
-            instance.statistics = {}
-        # Ensure there are the right keys
-        for key in ["queued", "hourly", "daily", "monthly"]:
-            if key not in instance.statistics:
-                instance.statistics[key] = {}
-        return instance
-
-    def set_queued(self, number: int):
+    def buckets(cls, when: datetime.datetime) -> dict[str, datetime.datetime]:
         """
-        Sets the current queued amount.
-
-        The queue is an instantaneous value (a "gauge") rather than a
-        sum ("counter"). It's mostly used for reporting what things are right
-        now, but basic trend analysis is also used to see if we think the
-        queue is backing up.
-        """
-        self.statistics["queued"][
-            int(timezone.now().replace(second=0, microsecond=0).timestamp())
-        ] = number
-
-    def add_handled(self, number: int):
+        Returns the start of each granularity's bucket that `when` falls into.
         """
-        Adds the "handled" number to the current stats.
-        """
-        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        hour = when.replace(minute=0, second=0, microsecond=0)
         day = hour.replace(hour=0)
-        hour_timestamp = str(int(hour.timestamp()))
-        day_timestamp = str(int(day.timestamp()))
-        month_timestamp = str(int(day.replace(day=1).timestamp()))
-        self.statistics["hourly"][hour_timestamp] = (
-            self.statistics["hourly"].get(hour_timestamp, 0) + number
-        )
-        self.statistics["daily"][day_timestamp] = (
-            self.statistics["daily"].get(day_timestamp, 0) + number
-        )
-        self.statistics["monthly"][month_timestamp] = (
-            self.statistics["monthly"].get(month_timestamp, 0) + number
-        )
+        return {
+            cls.Granularity.hour: hour,
+            cls.Granularity.day: day,
+            cls.Granularity.month: day.replace(day=1),
+        }
 
-    def trim_data(self):
+    @classmethod
+    def record(
+        cls,
+        model_label: str,
+        handled: int,
+        queued: int | None = None,
+        queue_age: float | None = None,
+        durations: list[float] | None = None,
+        queued_approximate: bool = False,
+    ):
         """
-        Removes excessively old data from the field
+        Adds a runner's numbers for a model to the current hour, day and
+        month, in a single statement.
         """
-        queued_horizon = int((timezone.now() - datetime.timedelta(hours=2)).timestamp())
-        hourly_horizon = int(
-            (timezone.now() - datetime.timedelta(hours=50)).timestamp()
-        )
-        daily_horizon = int((timezone.now() - datetime.timedelta(days=62)).timestamp())
-        monthly_horizon = int(
-            (timezone.now() - datetime.timedelta(days=3653)).timestamp()
+        duration_p50 = duration_p95 = None
+        if durations:
+            durations = sorted(durations)
+            duration_p50 = durations[int(len(durations) * 0.5)]
+            duration_p95 = durations[int(len(durations) * 0.95)]
+        now = timezone.now()
+        rows = []
+        params: list = []
+        for granularity, bucket in cls.buckets(now).items():
+            rows.append("(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+            params.extend(
+                [
+                    model_label,
+                    granularity,
+                    bucket,
+                    handled,
+                    queued,
+                    queued_approximate,
+                    queue_age,
+                    duration_p50,
+                    duration_p95,
+                    now,
+                ]
+            )
+        table = connection.ops.quote_name(cls._meta.db_table)
+        # Weighted average of the existing and new percentiles; if either is
+        # missing, we just use the other.
+        merge = (
+            "COALESCE(({table}.{column} * {table}.handled + EXCLUDED.{column} * "
+            "EXCLUDED.handled) / NULLIF({table}.handled + EXCLUDED.handled, 0), "
+            "EXCLUDED.{column}, {table}.{column})"
         )
-        self.statistics["queued"] = {
-            ts: v
-            for ts, v in self.statistics["queued"].items()
-            if int(ts) >= queued_horizon
-        }
-        self.statistics["hourly"] = {
-            ts: v
-            for ts, v in self.statistics["hourly"].items()
-            if int(ts) >= hourly_horizon
-        }
-        self.statistics["daily"] = {
-            ts: v
-            for ts, v in self.statistics["daily"].items()
-            if int(ts) >= daily_horizon
-        }
-        self.statistics["monthly"] = {
-            ts: v
-            for ts, v in self.statistics["monthly"].items()
-            if int(ts) >= monthly_horizon
-        }
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (
+                    model_label, granularity, bucket, handled, queued,
+                    queued_approximate, queue_age, duration_p50,
+                    duration_p95, updated
+                )
+                VALUES {", ".join(rows)}
+                ON CONFLICT (model_label, granularity, bucket) DO UPDATE SET
+                    handled = {table}.handled + EXCLUDED.handled,
+                    queued = COALESCE(EXCLUDED.queued, {table}.queued),
+                    queued_approximate = CASE
+                        WHEN EXCLUDED.queued IS NULL
+                        THEN {table}.queued_approximate
+                        ELSE EXCLUDED.queued_approximate
+                    END,
+                    queue_age = COALESCE(EXCLUDED.queue_age, {table}.queue_age),
+                    duration_p50 = {merge.format(table=table, column="duration_p50")},
+                    duration_p95 = {merge.format(table=table, column="duration_p95")},
+                    updated = EXCLUDED.updated
+                """,
+                params,
+            )
 
-    def most_recent_queued(self) -> int:
+    @classmethod
+    def trim(cls):
         """
-        Returns the most recent number of how many were queued
+        Removes buckets that are older than we keep their granularity for.
         """
-        queued = [(int(ts), v) for ts, v in self.statistics["queued"].items()]
-        queued.sort(reverse=True)
-        if queued:
-            return queued[0][1]
-        else:
-            return 0
+        now = timezone.now()
+        query = models.Q()
+        for granularity, horizon in cls.HORIZONS.items():
+            query |= models.Q(granularity=granularity, bucket__lt=now - horizon)
+        cls.objects.filter(query).delete()
 
-    def most_recent_handled(self) -> tuple[int, int, int]:
+    @classmethod
+    def current(cls) -> dict[str, dict[str, "Stats"]]:
         """
-        Returns the current handling numbers for hour, day, month
+        Returns the current hour, day and month's rows for every model, as
+        {model_label: {granularity: row}}.
         """
-        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
-        day = hour.replace(hour=0)
-        hour_timestamp = str(int(hour.timestamp()))
-        day_timestamp = str(int(day.timestamp()))
-        month_timestamp = str(int(day.replace(day=1).timestamp()))
-        return (
-            self.statistics["hourly"].get(hour_timestamp, 0),
-            self.statistics["daily"].get(day_timestamp, 0),
-            self.statistics["monthly"].get(month_timestamp, 0),
-        )
+        query = models.Q()
+        for granularity, bucket in cls.buckets(timezone.now()).items():
+            query |= models.Q(granularity=granularity, bucket=bucket)
+        result: dict[str, dict[str, Stats]] = {}
+        for row in cls.objects.filter(query):
+            result.setdefault(row.model_label, {})[row.granularity] = row
+        return result
@@ -1,18 +1,24 @@
+import asyncio
 import datetime
 import logging
 import os
+import select
 import signal
+import threading
 import time
 import uuid
 from concurrent.futures import Future, ThreadPoolExecutor
 
 from django.conf import settings
-from django.db import close_old_connections
+from django.db import close_old_connections, connections
 from django.utils import timezone
 
 from core import sentry
+from core.http import aclose_async_client
 from core.models import Config
-from stator.models import StatorModel, Stats
+from stator.metrics import transition_metrics
+from stator.models import NOTIFY_CHANNEL, StatorModel, Stats, run_sync
+from stator.scheduler import FairScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +49,57 @@ class LoopingTimer:
         return False
 
 
+class NotifyListener(threading.Thread):
+    """
+    Waits for new-work notifications from PostgreSQL on its own connection,
+    and calls `callback` (from this thread) when any arrive. Reconnects if
+    the connection drops; `listening` is only set while it is connected.
+    """
+
+    def __init__(self, callback, retry_interval: float = 10):
+        super().__init__(name="stator-listener", daemon=True)
+        self.callback = callback
+        self.retry_interval = retry_interval
+        self.listening = threading.Event()
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                if not self.stopping.is_set():
+                    logger.warning(f"Stator listener disconnected: {e}")
+            self.listening.clear()
+            self.stopping.wait(self.retry_interval)
+
+    def listen(self):
+        wrapper = connections["default"]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        try:
+            conn.autocommit = True
+            conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            self.listening.set()
+            while not self.stopping.is_set():
+                # Wake up every so often to see if we've been stopped
+                readable, _, _ = select.select([conn.fileno()], [], [], 1)
+                if not readable:
+                    continue
+                # Read the notifications straight off the socket, rather
+                # than running a query to get them delivered
+                conn.pgconn.consume_input()
+                notified = False
+                while conn.pgconn.notifies() is not None:
+                    notified = True
+                if notified:
+                    self.callback()
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopping.set()
+
+
 class StatorRunner:
     """
     Runs tasks on models that are looking for state changes.
@@ -61,6 +118,7 @@ class StatorRunner:
         delete_interval: int = 30,
         lock_expiry: int = 300,
         run_for: int = 0,
+        shard: tuple[int, int] | None = None,
     ):
         self.models = models
         self.runner_id = uuid.uuid4().hex
@@ -71,9 +129,26 @@ class StatorRunner:
         self.delete_interval = delete_interval
         self.lock_expiry = lock_expiry
         self.run_for = run_for
+        # If we're one of several processes, the (index, count) of the slice
+        # of rows that's ours; the first process also does the table-wide
+        # chores (deletion, lock cleaning and queue stats) for everyone.
+        self.shard = shard
+        self.primary = shard is None or shard[0] == 0
         self.minimum_loop_delay = 0.5
         self.maximum_loop_delay = 5
+        # When we're being notified of new work, we only poll for the things
+        # that don't send notifications (retries coming due)
+        self.maximum_notified_loop_delay = 30
+        self.listener: NotifyListener | None = None
         self.tasks: dict[tuple[str, str], Future] = {}
+        self.queue_ages: dict[str, float] = {}
+        self.durations: dict[str, list[float]] = {}
+        self.queue_count_limit = getattr(settings, "STATOR_QUEUE_COUNT_LIMIT", 10000)
+        self.scheduler = FairScheduler(
+            models,
+            lanes=getattr(settings, "STATOR_MODEL_LANES", None),
+            weights=getattr(settings, "STATOR_MODEL_WEIGHTS", None),
+        )
         # Set up SIGALRM handler
         signal.signal(signal.SIGALRM, self.alarm_handler)
 
@@ -85,6 +160,8 @@ class StatorRunner:
         self.loop_delay = self.minimum_loop_delay
         self.scheduling_timer = LoopingTimer(self.schedule_interval)
         self.deletion_timer = LoopingTimer(self.delete_interval)
+        self.wakeup = threading.Event()
+        self.start_listener(self.wakeup.set)
         # For the first time period, launch tasks
         logger.info("Running main task loop")
         try:
@@ -113,6 +190,7 @@ class StatorRunner:
                         self.add_deletion_tasks()
 
                     # Fetch and run any new handlers we can fit
+                    self.wakeup.clear()
                     self.add_transition_tasks()
 
                     # Are we in limited run mode?
@@ -122,21 +200,17 @@ class StatorRunner:
                     ):
                         break
 
-                    # Prevent busylooping, but also back off delay if we have
-                    # no tasks
-                    if self.tasks:
-                        self.loop_delay = self.minimum_loop_delay
-                    else:
-                        self.loop_delay = min(
-                            self.loop_delay * 1.5,
-                            self.maximum_loop_delay,
-                        )
-                    time.sleep(self.loop_delay)
+                    # Wait until there's new work, or it's time to poll again
+                    self.wakeup.wait(self.next_loop_delay())
 
                     # Clear the Sentry breadcrumbs and extra for next loop
                     sentry.scope_clear(scope)
         except KeyboardInterrupt:
             pass
+        # Cancel the watchdog timer, as we're exiting under our own steam
+        signal.alarm(0)
+        if self.listener:
+            self.listener.stop()
 
         # Wait for tasks to finish
         logger.info("Waiting for tasks to complete")
@@ -153,6 +227,30 @@ class StatorRunner:
         logger.warning("Watchdog timeout exceeded")
         os._exit(2)
 
+    def start_listener(self, callback):
+        """
+        Starts listening for new work notifications, if they're enabled.
+        """
+        if getattr(settings, "STATOR_NOTIFY", True):
+            self.listener = NotifyListener(callback)
+            self.listener.start()
+
+    def next_loop_delay(self) -> float:
+        """
+        Works out how long to wait before looking for work again. We back
+        off while idle, as far as we can safely go - which is further if
+        we'll get woken up for new work anyway.
+        """
+        if self.tasks:
+            self.loop_delay = self.minimum_loop_delay
+        else:
+            if self.listener and self.listener.listening.is_set():
+                maximum_delay = self.maximum_notified_loop_delay
+            else:
+                maximum_delay = self.maximum_loop_delay
+            self.loop_delay = min(self.loop_delay * 1.5, maximum_delay)
+        return self.loop_delay
+
     def load_config(self):
         """
         Refreshes config from the DB
@@ -172,55 +270,153 @@ class StatorRunner:
                             f"{model._meta.label_lower}: Scheduling ({num} handled)"
                         )
                     self.submit_stats(model)
-                    model.transition_clean_locks()
+                    if self.primary:
+                        model.transition_clean_locks()
+            if self.primary:
+                Stats.trim()
 
     def submit_stats(self, model: type[StatorModel]):
         """
         Pop some statistics into the database from our local info for the given model
         """
-        stats_instance = Stats.get_for_model(model)
-        if stats_instance.model_label in self.handled:
-            stats_instance.add_handled(self.handled[stats_instance.model_label])
-            del self.handled[stats_instance.model_label]
-        stats_instance.set_queued(model.transition_ready_count())
-        stats_instance.trim_data()
-        stats_instance.save()
+        label = model._meta.label_lower
+        # Only one process needs to measure the queue; the others just add
+        # their handled counts and durations to the same rows
+        if not self.primary:
+            self.queue_ages.pop(label, None)
+            Stats.record(
+                label,
+                handled=self.handled.pop(label, 0),
+                durations=self.durations.pop(label, None),
+            )
+            return
+        # Big queues are estimated rather than counted, to keep this fast
+        if self.queue_count_limit:
+            queued, approximate = model.transition_ready_estimate(
+                self.queue_count_limit
+            )
+        else:
+            queued, approximate = model.transition_ready_count(), False
+        # Queue age comes from what we claimed since last time; if we claimed
+        # nothing but there's a queue, it's being starved, so go and look
+        if label in self.queue_ages:
+            queue_age = self.queue_ages.pop(label)
+        elif queued:
+            queue_age = model.transition_ready_age(limit=self.queue_count_limit)
+        else:
+            queue_age = 0
+        Stats.record(
+            label,
+            handled=self.handled.pop(label, 0),
+            queued=queued,
+            queued_approximate=approximate,
+            queue_age=queue_age,
+            durations=self.durations.pop(label, None),
+        )
 
     def add_transition_tasks(self, call_inline=False):
         """
         Adds a transition thread for as many instances as we can, given capacity
         and batch size limits.
         """
-        # Calculate space left for tasks
-        space_remaining = self.concurrency - len(self.tasks)
-        # Fetch new tasks
-        for model in self.models:
-            if space_remaining > 0:
-                for instance in model.transition_get_with_lock(
-                    number=min(space_remaining, self.concurrency_per_model),
-                    lock_expiry=(
-                        timezone.now() + datetime.timedelta(seconds=self.lock_expiry)
-                    ),
-                ):
-                    key = (model._meta.label_lower, instance.pk)
-                    # Don't run two threads for the same thing
-                    if key in self.tasks:
-                        continue
-                    if call_inline:
-                        task_transition(instance, in_thread=False)
-                    else:
-                        self.tasks[key] = self.executor.submit(
-                            task_transition, instance
-                        )
-                    self.handled[model._meta.label_lower] = (
-                        self.handled.get(model._meta.label_lower, 0) + 1
+        for model, key, instances, batch in self.claim_transition_instances():
+            if batch:
+                if call_inline:
+                    task_transition_batch(model, instances, in_thread=False)
+                else:
+                    self.tasks[key] = self.executor.submit(
+                        task_transition_batch, model, instances
+                    )
+            else:
+                if call_inline:
+                    task_transition(instances[0], in_thread=False)
+                else:
+                    self.tasks[key] = self.executor.submit(
+                        task_transition, instances[0]
+                    )
+
+    def claim_transition_instances(
+        self,
+    ) -> list[tuple[type[StatorModel], tuple, list[StatorModel], bool]]:
+        """
+        Locks instances for as many tasks as there is capacity for, skipping
+        any that we're already running a task for.
+
+        Returns (model, task key, instances, is batch) for each task; states
+        with a batch handler get up to their batch_size instances per task.
+        """
+        claimed: list[tuple[type[StatorModel], tuple, list[StatorModel], bool]] = []
+        lock_expiry = timezone.now() + datetime.timedelta(seconds=self.lock_expiry)
+
+        def claim(model: type[StatorModel], number: int) -> int:
+            label = model._meta.label_lower
+            slots = 0
+            # Batch states take one task slot per batch, so claim enough for
+            # all the slots at once and split them up
+            for state in model.state_graph.batch_states:
+                if slots >= number:
+                    break
+                batch_size = state.batch_size
+                instances = model.transition_get_with_lock(
+                    number=(number - slots) * batch_size,
+                    lock_expiry=lock_expiry,
+                    states=[state],
+                    shard=self.shard,
+                )
+                for start in range(0, len(instances), batch_size):
+                    batch = instances[start : start + batch_size]
+                    claimed.append(
+                        (model, (label, f"__batch__{batch[0].pk}"), batch, True)
                     )
-                    space_remaining -= 1
+                    self.record_claimed(label, batch)
+                    slots += 1
+            # Everything else gets a task per instance
+            single_states = (
+                model.state_graph.automatic_states - model.state_graph.batch_states
+            )
+            if slots >= number or not single_states:
+                return slots
+            for instance in model.transition_get_with_lock(
+                number=number - slots,
+                lock_expiry=lock_expiry,
+                states=single_states,
+                shard=self.shard,
+            ):
+                # Counts against the slots either way, so we don't spin on it
+                slots += 1
+                key = (label, instance.pk)
+                # Don't run two tasks for the same thing
+                if key in self.tasks:
+                    continue
+                claimed.append((model, key, [instance], False))
+                self.record_claimed(label, [instance])
+            return slots
+
+        self.scheduler.allocate(
+            space=self.concurrency - len(self.tasks),
+            per_model=self.concurrency_per_model,
+            claim=claim,
+        )
+        return claimed
+
+    def record_claimed(self, label: str, instances: list[StatorModel]):
+        """
+        Counts claimed instances towards the handled stats, and keeps track
+        of the longest any of them had been waiting since it became ready.
+        """
+        self.handled[label] = self.handled.get(label, 0) + len(instances)
+        now = timezone.now()
+        for instance in instances:
+            ready_since = instance.state_next_attempt or instance.state_changed
+            age = max((now - ready_since).total_seconds(), 0)
+            self.queue_ages[label] = max(self.queue_ages.get(label, 0), age)
 
     def add_deletion_tasks(self, call_inline=False):
         """
         Adds a deletion thread for each model
         """
+        if not self.primary:
+            return
         # Yes, this potentially goes over the capacity limit - it's fine.
         for model in self.models:
             if model.state_graph.deletion_states:
@@ -240,9 +436,13 @@ class StatorRunner:
             if task.done():
                 del self.tasks[key]
                 try:
-                    task.result()
+                    duration = task.result()
                 except BaseException as e:
                     logger.exception(e)
+                else:
+                    # Transition tasks return how long they took
+                    if duration is not None:
+                        self.durations.setdefault(key[0], []).append(duration)
 
     def run_single_cycle(self):
         """
@@ -253,34 +453,268 @@ class StatorRunner:
         self.add_transition_tasks(call_inline=True)
 
 
+class AsyncStatorRunner(StatorRunner):
+    """
+    Runs transitions as coroutines on a single event loop.
+
+    Coroutine handlers - which spend most of their time waiting on remote
+    servers - run directly on the loop, so hundreds can be in flight at once.
+    Everything that blocks (sync handlers and the ORM) is sent to a small,
+    bounded thread pool instead, which also caps our database connections.
+    """
+
+    def __init__(
+        self,
+        models: list[type[StatorModel]],
+        concurrency: int = getattr(settings, "STATOR_ASYNC_CONCURRENCY", 500),
+        database_concurrency: int = getattr(
+            settings, "STATOR_ASYNC_DATABASE_CONCURRENCY", 10
+        ),
+        **kwargs,
+    ):
+        super().__init__(models, concurrency=concurrency, **kwargs)
+        self.database_concurrency = database_concurrency
+
+    def run(self):
+        asyncio.run(self.arun())
+
+    async def arun(self):
+        sentry.set_takahe_app("stator")
+        self.handled = {}
+        self.started = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=self.database_concurrency)
+        asyncio.get_running_loop().set_default_executor(self.executor)
+        self.loop_delay = self.minimum_loop_delay
+        self.scheduling_timer = LoopingTimer(self.schedule_interval)
+        self.deletion_timer = LoopingTimer(self.delete_interval)
+        self.wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.start_listener(lambda: loop.call_soon_threadsafe(self.wakeup.set))
+        logger.info("Running main task loop (async)")
+        try:
+            with sentry.configure_scope() as scope:
+                while True:
+                    # See if we need to run cleaning
+                    if self.scheduling_timer.check():
+                        # Set up the watchdog timer (each time we do this the previous one is cancelled)
+                        signal.alarm(self.schedule_interval * 2)
+                        # Write liveness file if configured
+                        if self.liveness_file:
+                            with open(self.liveness_file, "w") as fh:
+                                fh.write(str(int(time.time())))
+                        # Refresh the config
+                        await run_sync(self.load_config)
+                        # Do scheduling (stale lock deletion and stats gathering)
+                        await run_sync(self.run_scheduling)
+
+                    # Clear the cleaning breadcrumbs/extra for the main part of the loop
+                    sentry.scope_clear(scope)
+
+                    self.clean_tasks()
+
+                    # See if we need to add deletion tasks
+                    if self.deletion_timer.check():
+                        self.add_deletion_tasks()
+
+                    # Fetch and run any new handlers we can fit
+                    self.wakeup.clear()
+                    await self.aadd_transition_tasks()
+
+                    # Are we in limited run mode?
+                    if (
+                        self.run_for
+                        and (time.monotonic() - self.started) > self.run_for
+                    ):
+                        break
+
+                    # Wait until there's new work, or it's time to poll again
+                    try:
+                        await asyncio.wait_for(
+                            self.wakeup.wait(), self.next_loop_delay()
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+
+                    # Clear the Sentry breadcrumbs and extra for next loop
+                    sentry.scope_clear(scope)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # asyncio.run cancels us on Ctrl-C, rather than raising in here
+            pass
+        # Cancel the watchdog timer, as we're exiting under our own steam
+        signal.alarm(0)
+        if self.listener:
+            self.listener.stop()
+
+        # Wait for tasks to finish
+        logger.info("Waiting for tasks to complete")
+        if self.tasks:
+            await asyncio.wait(self.tasks.values())
+        await aclose_async_client()
+        self.shutdown_executor()
+
+        # We're done
+        logger.info("Complete")
+
+    def shutdown_executor(self):
+        """
+        Closes the database connection held by each pool thread, then shuts
+        the pool down.
+        """
+        # The barrier ensures each close call lands on a different thread
+        barrier = threading.Barrier(self.database_concurrency)
+
+        def close_connections():
+            barrier.wait(timeout=5)
+            connections.close_all()
+
+        for _ in range(self.database_concurrency):
+            self.executor.submit(close_connections)
+        self.executor.shutdown()
+
+    async def aadd_transition_tasks(self):
+        """
+        Starts a transition coroutine for as many instances as we can fit.
+        """
+        for model, key, instances, batch in await run_sync(
+            self.claim_transition_instances
+        ):
+            if batch:
+                self.tasks[key] = asyncio.create_task(
+                    atask_transition_batch(model, instances)
+                )
+            else:
+                self.tasks[key] = asyncio.create_task(atask_transition(instances[0]))
+
+    def add_deletion_tasks(self, call_inline=False):
+        """
+        Adds a deletion task in the thread pool for each model
+        """
+        if call_inline:
+            return super().add_deletion_tasks(call_inline=True)
+        if not self.primary:
+            return
+        loop = asyncio.get_running_loop()
+        for model in self.models:
+            if model.state_graph.deletion_states:
+                self.tasks[
+                    model._meta.label_lower, "__delete__"
+                ] = asyncio.ensure_future(
+                    loop.run_in_executor(None, task_deletion, model)
+                )
+
+
 def task_transition(instance: StatorModel, in_thread: bool = True):
     """
-    Runs one state transition/action.
+    Runs one state transition/action, returning how long it took.
     """
     task_name = f"stator.task_transition:{instance._meta.label_lower}#{{id}} from {instance.state}"
     started = time.monotonic()
     with sentry.start_transaction(op="task", name=task_name):
-        sentry.set_context(
-            "instance",
-            {
-                "model": instance._meta.label_lower,
-                "pk": instance.pk,
-                "state": instance.state,
-                "state_age": instance.state_age,
-            },
-        )
+        set_instance_context(instance)
         result = instance.transition_attempt()
         duration = time.monotonic() - started
-        if result:
-            logger.info(
-                f"{instance._meta.label_lower}: {instance.pk}: {instance.state} -> {result} ({duration:.2f}s)"
-            )
-        else:
-            logger.info(
-                f"{instance._meta.label_lower}: {instance.pk}: {instance.state} unchanged  ({duration:.2f}s)"
-            )
+        log_transition(instance, result, duration)
+        record_transition(instance, duration)
     if in_thread:
         close_old_connections()
+    return duration
+
+
+async def atask_transition(instance: StatorModel):
+    """
+    Runs one state transition/action as a coroutine, returning how long
+    it took.
+    """
+    task_name = f"stator.task_transition:{instance._meta.label_lower}#{{id}} from {instance.state}"
+    started = time.monotonic()
+    with sentry.start_transaction(op="task", name=task_name):
+        set_instance_context(instance)
+        result = await instance.atransition_attempt()
+        duration = time.monotonic() - started
+        log_transition(instance, result, duration)
+        record_transition(instance, duration)
+    return duration
+
+
+def task_transition_batch(
+    model: type[StatorModel], instances: list[StatorModel], in_thread: bool = True
+):
+    """
+    Runs one batch of state transitions/actions, returning how long it took.
+    """
+    task_name = f"stator.task_transition_batch:{model._meta.label_lower} from {instances[0].state}"
+    started = time.monotonic()
+    with sentry.start_transaction(op="task", name=task_name):
+        results = model.transition_attempt_batch(instances)
+        duration = time.monotonic() - started
+        log_transition_batch(model, instances, results, duration)
+        # Each instance gets its share of the batch's time
+        for instance in instances:
+            record_transition(instance, duration / len(instances))
+    if in_thread:
+        close_old_connections()
+    return duration
+
+
+async def atask_transition_batch(
+    model: type[StatorModel], instances: list[StatorModel]
+):
+    """
+    Runs one batch of state transitions/actions as a coroutine, returning
+    how long it took.
+    """
+    task_name = f"stator.task_transition_batch:{model._meta.label_lower} from {instances[0].state}"
+    started = time.monotonic()
+    with sentry.start_transaction(op="task", name=task_name):
+        results = await model.atransition_attempt_batch(instances)
+        duration = time.monotonic() - started
+        log_transition_batch(model, instances, results, duration)
+        # Each instance gets its share of the batch's time
+        for instance in instances:
+            record_transition(instance, duration / len(instances))
+    return duration
+
+
+def set_instance_context(instance: StatorModel):
+    sentry.set_context(
+        "instance",
+        {
+            "model": instance._meta.label_lower,
+            "pk": instance.pk,
+            "state": instance.state,
+            "state_age": instance.state_age,
+        },
+    )
+
+
+def record_transition(instance: StatorModel, duration: float):
+    if instance.transition_outcome:
+        transition_metrics.observe(
+            instance._meta.label_lower,
+            str(instance.state),
+            instance.transition_outcome,
+            duration,
+        )
+
+
+def log_transition(instance: StatorModel, result, duration: float):
+    if result:
+        logger.info(
+            f"{instance._meta.label_lower}: {instance.pk}: {instance.state} -> {result} ({duration:.2f}s)"
+        )
+    else:
+        logger.info(
+            f"{instance._meta.label_lower}: {instance.pk}: {instance.state} unchanged  ({duration:.2f}s)"
+        )
+
+
+def log_transition_batch(
+    model: type[StatorModel], instances: list[StatorModel], results: dict, duration
+):
+    changed = sum(1 for result in results.values() if result)
+    logger.info(
+        f"{model._meta.label_lower}: batch of {len(instances)} from {instances[0].state}: {changed} changed ({duration:.2f}s)"
+    )
 
 
 def task_deletion(model: type[StatorModel], in_thread: bool = True):
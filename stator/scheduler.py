@@ -0,0 +1,136 @@
+from collections.abc import Callable
+
+from stator.models import StatorModel
+
+LANE_NAMES = {
+    "interactive": StatorModel.LANE_INTERACTIVE,
+    "default": StatorModel.LANE_DEFAULT,
+    "bulk": StatorModel.LANE_BULK,
+}
+
+
+class FairScheduler:
+    """
+    Decides how a runner's free task slots are shared out between models.
+
+    Models are grouped into priority lanes (lower numbers first); a lane only
+    gets the slots that the lanes before it could not use. Inside a lane,
+    slots are shared out by deficit round robin: each visit, a model earns
+    `quantum * weight` credit, and its share grows by as many slots as it has
+    credit for. If a pass runs out of slots partway through a model's turn,
+    the next pass picks up where it left off, so weights hold even when only
+    a slot or two frees up at a time; credit is reset when a model runs out
+    of work.
+
+    The shares are worked out before anything is claimed, so each model
+    claims its whole share at once, rather than a slot at a time.
+    """
+
+    def __init__(
+        self,
+        models: list[type[StatorModel]],
+        lanes: dict[str, int | str] | None = None,
+        weights: dict[str, int] | None = None,
+        quantum: int = 1,
+    ):
+        """
+        `lanes` and `weights` are keyed by model label, and override the
+        model's own stator_lane and stator_weight; lanes may be given by
+        number or by name ("interactive", "default" or "bulk").
+        """
+        lanes = lanes or {}
+        weights = weights or {}
+        self.quantum = quantum
+        self.lanes: dict[int, list[type[StatorModel]]] = {}
+        self.weights: dict[str, int] = {}
+        self.deficits: dict[str, int] = {}
+        # Whose turn it is in each lane, and if they've had their credit yet
+        self.positions: dict[int, int] = {}
+        self.credited: dict[int, bool] = {}
+        for model in models:
+            label = model._meta.label_lower
+            lane = lanes.get(label, model.stator_lane)
+            if isinstance(lane, str):
+                lane = LANE_NAMES[lane]
+            self.lanes.setdefault(lane, []).append(model)
+            self.positions[lane] = 0
+            self.credited[lane] = False
+            self.weights[label] = max(1, weights.get(label, model.stator_weight))
+            self.deficits[label] = 0
+
+    def allocate(
+        self,
+        space: int,
+        per_model: int,
+        claim: Callable[[type[StatorModel], int], int],
+    ) -> int:
+        """
+        Shares out `space` slots, giving each model at most `per_model` of
+        them. `claim(model, number)` should try to start up to `number` tasks
+        for the model and return how many it did.
+
+        Each model is asked to claim once, unless another model in its lane
+        runs out of work and leaves slots over for it.
+        Returns how many slots are left over.
+        """
+        for lane in sorted(self.lanes):
+            models = self.lanes[lane]
+            claimed = {model: 0 for model in models}
+            active = set(models)
+            while space > 0 and active:
+                shares = self.shares(lane, space, per_model, claimed, active)
+                if not any(shares.values()):
+                    break
+                for model in models:
+                    if not shares[model]:
+                        continue
+                    got = claim(model, shares[model])
+                    claimed[model] += got
+                    space -= got
+                    if got < shares[model]:
+                        # It's run out of work; it doesn't get to bank credit
+                        self.deficits[model._meta.label_lower] = 0
+                        active.remove(model)
+                    elif claimed[model] >= per_model:
+                        active.remove(model)
+        return space
+
+    def shares(
+        self,
+        lane: int,
+        space: int,
+        per_model: int,
+        claimed: dict[type[StatorModel], int],
+        active: set[type[StatorModel]],
+    ) -> dict[type[StatorModel], int]:
+        """
+        Works out how many of `space` slots each of a lane's `active` models
+        should get, given they've already `claimed` some this pass.
+        """
+        models = self.lanes[lane]
+        shares = {model: 0 for model in models}
+        wanting = set(active)
+        while space > 0 and wanting:
+            model = models[self.positions[lane]]
+            if model in wanting:
+                label = model._meta.label_lower
+                # Models earn credit once per visit, not once per call
+                if not self.credited[lane]:
+                    self.deficits[label] += self.quantum * self.weights[label]
+                    self.credited[lane] = True
+                share = min(
+                    self.deficits[label],
+                    space,
+                    per_model - claimed[model] - shares[model],
+                )
+                shares[model] += share
+                self.deficits[label] -= share
+                space -= share
+                if claimed[model] + shares[model] >= per_model:
+                    wanting.remove(model)
+                elif self.deficits[label] > 0:
+                    # We ran out of space mid-turn; resume here next time
+                    break
+            self.positions[lane] = (self.positions[lane] + 1) % len(models)
+            self.credited[lane] = False
+        return shares
@@ -0,0 +1,161 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from collections.abc import Callable
+
+from django.db import connections
+
+from stator.runner import StatorRunner
+
+logger = logging.getLogger(__name__)
+
+
+class StatorSupervisor:
+    """
+    Runs several Stator runners as forked child processes, so handlers can
+    use more than one core. Each child gets its own shard of every model's
+    rows, so they never compete for the same ones.
+
+    Children that die are restarted. Each child writes its own liveness file,
+    and we combine them into the main one; it holds the oldest child's
+    timestamp, so it goes stale if any one child does.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        runner_factory: Callable[[tuple[int, int], str | None], StatorRunner],
+        liveness_file: str | None = None,
+        run_for: int = 0,
+        restart_delay: float = 5,
+        check_interval: float = 1,
+    ):
+        if processes < 1:
+            raise ValueError("A supervisor needs at least one process")
+        self.processes = processes
+        self.runner_factory = runner_factory
+        self.liveness_file = liveness_file
+        self.run_for = run_for
+        self.restart_delay = restart_delay
+        self.check_interval = check_interval
+        self.context = multiprocessing.get_context("fork")
+        self.children: dict[int, multiprocessing.process.BaseProcess] = {}
+        self.started_at: dict[int, float] = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.term_handler)
+        logger.info(f"Starting {self.processes} runner processes")
+        for index in range(self.processes):
+            self.start_child(index)
+        try:
+            while not self.stopping:
+                self.check_children()
+                if not self.children:
+                    break
+                self.write_liveness()
+                time.sleep(self.check_interval)
+        except KeyboardInterrupt:
+            pass
+        self.stop_children()
+        logger.info("Complete")
+
+    def term_handler(self, signum, frame):
+        """
+        Shuts down gracefully on SIGTERM, like we do on Ctrl-C.
+        """
+        self.stopping = True
+
+    def child_liveness_file(self, index: int) -> str | None:
+        if not self.liveness_file:
+            return None
+        return f"{self.liveness_file}.{index}"
+
+    def start_child(self, index: int):
+        # Children must not inherit our database connections
+        connections.close_all()
+        process = self.context.Process(
+            target=self.run_child,
+            args=(index,),
+            name=f"stator-{index}",
+        )
+        process.start()
+        self.children[index] = process
+        self.started_at[index] = time.time()
+        logger.info(f"Started runner {index} as pid {process.pid}")
+
+    def run_child(self, index: int):
+        """
+        The entrypoint inside each child process.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        runner = self.runner_factory(
+            (index, self.processes), self.child_liveness_file(index)
+        )
+        try:
+            runner.run()
+        except KeyboardInterrupt:
+            pass
+
+    def check_children(self):
+        """
+        Restarts any children that have died - unless we're on a limited
+        run, in which case they're meant to finish on their own.
+        """
+        for index, process in list(self.children.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            if self.run_for:
+                if process.exitcode:
+                    logger.warning(
+                        f"Runner {index} exited with code {process.exitcode}"
+                    )
+                del self.children[index]
+                continue
+            # Don't restart too fast if it's dying straight away
+            if time.time() - self.started_at[index] < self.restart_delay:
+                continue
+            logger.warning(
+                f"Runner {index} (pid {process.pid}) exited with code "
+                f"{process.exitcode}, restarting"
+            )
+            self.restarts += 1
+            self.start_child(index)
+
+    def write_liveness(self):
+        if not self.liveness_file:
+            return
+        timestamps = []
+        for index in self.children:
+            # Children that haven't written one yet count from when they started
+            timestamp = self.started_at[index]
+            child_file = self.child_liveness_file(index)
+            try:
+                with open(child_file) as fh:
+                    timestamp = max(timestamp, int(fh.read()))
+            except (OSError, ValueError):
+                pass
+            timestamps.append(timestamp)
+        if timestamps:
+            with open(self.liveness_file, "w") as fh:
+                fh.write(str(int(min(timestamps))))
+
+    def stop_children(self, timeout: float = 30):
+        """
+        Asks every child to finish up (as if Ctrl-C had been pressed), then
+        kills any that haven't after `timeout` seconds.
+        """
+        for process in self.children.values():
+            if process.is_alive() and process.pid:
+                os.kill(process.pid, signal.SIGINT)
+        deadline = time.monotonic() + timeout
+        for process in self.children.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Runner pid {process.pid} did not exit, killing")
+                process.kill()
+                process.join()
@@ -1,3 +1,5 @@
+import random
+
 import pytest
 
 from stator.graph import State, StateGraph
@@ -67,3 +69,55 @@ def test_state():
     assert "initial" == TestGraph.initial
     assert TestGraph.initial == "initial"
     assert TestGraph.initial == TestGraph.initial
+
+
+def test_batch_states():
+    """
+    Tests that batch states need a batch handler, but not a single one.
+    """
+
+    class TestGraph(StateGraph):
+        initial = State(try_interval=3600, batch_size=10)
+        second = State()
+
+        initial.transitions_to(second)
+
+        @classmethod
+        def handle_initial_batch(cls, instances):
+            pass
+
+    assert TestGraph.batch_states == {TestGraph.initial}
+    assert TestGraph.automatic_states == {TestGraph.initial}
+    assert TestGraph.initial.batch_handler == TestGraph.handle_initial_batch
+
+    with pytest.raises(ValueError):
+
+        class TestGraph2(StateGraph):
+            initial = State(try_interval=3600, batch_size=10)
+            second = State()
+
+            initial.transitions_to(second)
+
+            @classmethod
+            def handle_initial(cls, instance):
+                pass
+
+
+def test_retry_delay():
+    """
+    Tests exponential backoff, its cap, and that jitter stays in range.
+    """
+    state = State(try_interval=10)
+    assert state.retry_delay(0) == 10
+    assert state.retry_delay(5) == 10
+
+    state = State(try_interval=10, backoff_factor=2, backoff_max=100)
+    assert [state.retry_delay(n) for n in range(5)] == [10, 20, 40, 80, 100]
+    # Huge attempt counts must not overflow
+    assert state.retry_delay(10**6) == 100
+
+    state = State(try_interval=10, backoff_factor=2, backoff_jitter=0.5)
+    random.seed(42)
+    delays = [state.retry_delay(2) for _ in range(100)]
+    assert all(20 <= delay <= 60 for delay in delays)
+    assert len(set(delays)) > 1
@@ -135,6 +135,60 @@ class Settings(BaseSettings):
     #: float or tuple of floats for (connect, read, write, pool)
     REMOTE_TIMEOUT: float | tuple[float, float, float, float] = 5.0
 
+    #: Connections to other servers are pooled and kept alive between
+    #: requests; these limit how many each process can have open in total,
+    #: how many idle ones it keeps, and for how many seconds.
+    REMOTE_POOL_CONNECTIONS: int = 100
+    REMOTE_POOL_KEEPALIVE_CONNECTIONS: int = 20
+    REMOTE_POOL_KEEPALIVE_EXPIRY: float = 30.0
+
+    #: If we should use HTTP/2 with servers that support it (needs the
+    #: "h2" package installed).
+    REMOTE_HTTP2: bool = True
+
+    #: How many seconds to remember the signatures of inbox deliveries we've
+    #: verified, so exact duplicates are dropped without checking them again
+    #: (needs TAKAHE_CACHES_DEFAULT set; 0 turns it off).
+    INBOX_REPLAY_WINDOW: int = 120
+
+    #: How many seconds to remember the IDs of activities in inbox deliveries
+    #: we've verified, so other copies of them (retries, or deliveries to
+    #: several inboxes) are dropped (needs TAKAHE_CACHES_DEFAULT set; 0 turns
+    #: it off).
+    INBOX_DUPLICATE_WINDOW: int = 3600
+
+    #: If inbox deliveries signed by actors whose keys we've recently
+    #: verified should be accepted with only cheap checks, leaving parsing
+    #: the JSON-LD and the rest of the checks to Stator.
+    INBOX_FAST_ACCEPT: bool = False
+
+    #: If inbox deliveries a web process receives at the same time should
+    #: be saved in one INSERT. Only turn this on if your web processes each
+    #: handle several requests at once (e.g. Gunicorn's --threads), as a
+    #: process only combines the deliveries it's handling itself.
+    INBOX_GROUP_COMMIT: bool = False
+
+    #: The most inbox deliveries a web process will save in one INSERT, and
+    #: how many seconds it waits for others to share one with (by default
+    #: only those that arrive while the previous one is being saved do).
+    INBOX_BATCH_SIZE: int = 100
+    INBOX_BATCH_WAIT: float = 0
+
+    #: How many inbox deliveries a second each web process takes from any
+    #: one server or IP address (after a burst of up to INBOX_DOMAIN_BURST)
+    #: before queueing the rest to be processed later, and how many seconds
+    #: later it'll go before turning them away with a 429 instead (rate 0
+    #: turns this off). Deliveries only count against a server once their
+    #: signature shows it sent them.
+    INBOX_DOMAIN_RATE: float = 20
+    INBOX_DOMAIN_BURST: int = 200
+    INBOX_DOMAIN_MAX_DELAY: int = 600
+
+    #: Types of inbox message to throw away unprocessed, to shed load
+    #: (either just the activity type, like "like", or with its object type,
+    #: like "create.note").
+    INBOX_SKIP_TYPES: list[str] = Field(default_factory=list)
+
     #: If search features like full text search should be enabled.
     #: (placeholder setting, no effect)
     SEARCH: bool = True
@@ -150,6 +204,18 @@ class Settings(BaseSettings):
     # Stator tuning
     STATOR_CONCURRENCY: int = 20
     STATOR_CONCURRENCY_PER_MODEL: int = 4
+    STATOR_ASYNC_CONCURRENCY: int = 500
+    STATOR_ASYNC_DATABASE_CONCURRENCY: int = 10
+    # If Stator uses PostgreSQL LISTEN/NOTIFY to pick up new work immediately
+    # (turn off if your connection pooler does not support it)
+    STATOR_NOTIFY: bool = True
+    # Queues longer than this are estimated rather than counted for stats
+    # (0 to always count exactly)
+    STATOR_QUEUE_COUNT_LIMIT: int = 10000
+    # Per-model overrides (by label, like "activities.fanout") of the
+    # scheduling lane and weight; see docs/tuning.rst
+    STATOR_MODEL_LANES: dict[str, int | str] = Field(default_factory=dict)
+    STATOR_MODEL_WEIGHTS: dict[str, int] = Field(default_factory=dict)
 
     # If user migration is allowed (off by default until outbound is done)
     ALLOW_USER_MIGRATION: bool = False
@@ -338,6 +404,12 @@ AUTO_ADMIN_EMAIL = SETUP.AUTO_ADMIN_EMAIL
 STATOR_TOKEN = SETUP.STATOR_TOKEN
 STATOR_CONCURRENCY = SETUP.STATOR_CONCURRENCY
 STATOR_CONCURRENCY_PER_MODEL = SETUP.STATOR_CONCURRENCY_PER_MODEL
+STATOR_ASYNC_CONCURRENCY = SETUP.STATOR_ASYNC_CONCURRENCY
+STATOR_ASYNC_DATABASE_CONCURRENCY = SETUP.STATOR_ASYNC_DATABASE_CONCURRENCY
+STATOR_NOTIFY = SETUP.STATOR_NOTIFY
+STATOR_QUEUE_COUNT_LIMIT = SETUP.STATOR_QUEUE_COUNT_LIMIT
+STATOR_MODEL_LANES = SETUP.STATOR_MODEL_LANES
+STATOR_MODEL_WEIGHTS = SETUP.STATOR_MODEL_WEIGHTS
 
 ROBOTS_TXT_DISALLOWED_USER_AGENTS = SETUP.ROBOTS_TXT_DISALLOWED_USER_AGENTS
 
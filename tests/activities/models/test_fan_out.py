@@ -0,0 +1,296 @@
+import asyncio
+import datetime
+import threading
+from urllib.parse import urlparse
+
+import httpx
+import pytest
+from django.utils import timezone
+from pytest_httpx import HTTPXMock
+
+from activities.models import FanOut, FanOutStates, Post
+from activities.models import fan_out as fan_out_module
+from stator.exceptions import TryAgainLater
+from stator.metrics import OUTCOME_EXCEPTION, OUTCOME_TRY_AGAIN_LATER
+from stator.runner import AsyncStatorRunner
+from users.models import Domain, Identity
+
+
+@pytest.mark.django_db
+def test_batch_groups_by_inbox(
+    httpx_mock: HTTPXMock,
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+    remote_identity2: Identity,
+):
+    """
+    Tests that a batch of fan-outs is sent grouped by destination inbox,
+    whatever order they were claimed in.
+    """
+    remote_identity2.inbox_uri = "https://remote2.test/@test/inbox/"
+    remote_identity2.save()
+    httpx_mock.add_response()
+    post = Post.create_local(author=identity, content="Hello")
+    fan_outs = [
+        FanOut.objects.create(
+            identity=target, type=FanOut.Types.post, subject_post=post
+        )
+        for target in [
+            remote_identity2,
+            remote_identity,
+            remote_identity2,
+            remote_identity,
+        ]
+    ]
+    results = FanOutStates.handle_new_batch(fan_outs)
+    assert set(results.values()) == {FanOutStates.sent}
+    assert [str(request.url) for request in httpx_mock.get_requests()] == [
+        "https://remote.test/@test/inbox/",
+        "https://remote.test/@test/inbox/",
+        "https://remote2.test/@test/inbox/",
+        "https://remote2.test/@test/inbox/",
+    ]
+
+
+@pytest.mark.django_db
+def test_claim_groups_by_server(
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+    remote_identity2: Identity,
+):
+    """
+    Tests that claims take the fan-outs going to the oldest due one's server
+    first, rather than whatever rows come to hand.
+    """
+    post = Post.create_local(author=identity, content="Hello")
+    fan_outs = [
+        FanOut.objects.create(
+            identity=target, type=FanOut.Types.post, subject_post=post
+        )
+        for target in [remote_identity2, remote_identity] * 3
+    ]
+    lock_expiry = timezone.now() + datetime.timedelta(minutes=5)
+    claimed = FanOut.transition_get_with_lock(3, lock_expiry)
+    assert {fan_out.identity_id for fan_out in claimed} == {remote_identity2.pk}
+    # Then the next server's, once the first's have all gone
+    claimed = FanOut.transition_get_with_lock(4, lock_expiry)
+    assert [fan_out.identity_id for fan_out in claimed] == [remote_identity.pk] * 3
+    assert {fan_out.pk for fan_out in fan_outs} == set(
+        FanOut.objects.filter(state_locked_until=lock_expiry).values_list(
+            "pk", flat=True
+        )
+    )
+
+
+@pytest.mark.django_db
+def test_batch_pauses_down_host(
+    httpx_mock: HTTPXMock,
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+):
+    """
+    Tests that once a server has failed enough times in a row, its circuit
+    opens and the rest of the batch to it is put off without being sent.
+    """
+    httpx_mock.add_exception(httpx.ConnectError("Connection refused"))
+    post = Post.create_local(author=identity, content="Hello")
+    fan_outs = [
+        FanOut.objects.create(
+            identity=remote_identity, type=FanOut.Types.post, subject_post=post
+        )
+        for _ in range(5)
+    ]
+    results = FanOutStates.handle_new_batch(fan_outs)
+    tried = [fan_out.pk for fan_out in fan_outs[:3]]
+    assert [results[pk] for pk in tried] == [None, None, None]
+    for fan_out in fan_outs[3:]:
+        assert isinstance(results[fan_out.pk], TryAgainLater)
+        assert results[fan_out.pk].retry_after > 0
+    assert len(httpx_mock.get_requests()) == 3
+    domain = Domain.objects.get(pk="remote.test")
+    assert domain.circuit_state == Domain.CircuitStates.open
+    assert domain.circuit_failures == 3
+
+    # If it's been down for days, we stop queueing things for it
+    Domain.objects.filter(pk="remote.test").update(
+        circuit_opened=timezone.now() - datetime.timedelta(days=4)
+    )
+    results = FanOutStates.handle_new_batch(fan_outs[3:])
+    assert set(results.values()) == {FanOutStates.failed}
+
+
+@pytest.mark.django_db
+def test_outbound_body_cached(
+    httpx_mock: HTTPXMock,
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+    monkeypatch,
+):
+    """
+    Tests that a post is only canonicalised once however many inboxes it's
+    going to, and again once it's been edited.
+    """
+    fan_out_module.body_cache.clear()
+    calls = []
+
+    def canonicalise(data):
+        calls.append(data["type"])
+        return data
+
+    monkeypatch.setattr(fan_out_module, "canonicalise", canonicalise)
+    httpx_mock.add_response()
+    post = Post.create_local(author=identity, content="Hello")
+    fan_outs = [
+        FanOut.objects.create(
+            identity=remote_identity, type=FanOut.Types.post, subject_post=post
+        )
+        for _ in range(3)
+    ]
+    results = FanOutStates.handle_new_batch(fan_outs)
+    assert set(results.values()) == {FanOutStates.sent}
+    assert calls == ["Create"]
+    bodies = {request.content for request in httpx_mock.get_requests()}
+    assert len(bodies) == 1
+
+    post.edit_local(content="Hello again")
+    FanOutStates.handle_new_batch(
+        [
+            FanOut.objects.create(
+                identity=remote_identity,
+                type=FanOut.Types.post_edited,
+                subject_post=post,
+            )
+            for _ in range(2)
+        ]
+    )
+    assert calls == ["Create", "Update"]
+
+
+@pytest.mark.django_db
+def test_create_for_targets_restartable(
+    config_system,
+    identity: Identity,
+    other_identity: Identity,
+    remote_identity: Identity,
+    monkeypatch,
+):
+    """
+    Tests that fan-outs are created in chunks, and that running it again
+    after an interruption only creates the ones that are missing.
+    """
+    monkeypatch.setattr(FanOut, "CREATE_CHUNK_SIZE", 1)
+    post = Post.create_local(author=identity, content="Hello")
+    targets = [identity.pk, other_identity.pk, remote_identity.pk]
+
+    def interrupted():
+        yield from targets[:2]
+        raise RuntimeError("Interrupted")
+
+    with pytest.raises(RuntimeError):
+        FanOut.create_for_targets(
+            interrupted(),
+            FanOut.Types.post,
+            since=post.state_changed,
+            subject_post=post,
+        )
+    assert FanOut.objects.filter(subject_post=post).count() == 2
+
+    created = FanOut.create_for_targets(
+        targets, FanOut.Types.post, since=post.state_changed, subject_post=post
+    )
+    assert created == 1
+    assert sorted(
+        FanOut.objects.filter(subject_post=post).values_list("identity_id", flat=True)
+    ) == sorted(targets)
+
+
+@pytest.mark.django_db
+def test_transition_attempt_failed_delivery(
+    httpx_mock: HTTPXMock,
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+):
+    """
+    Tests that a fan-out whose delivery fails, when transitioned on its own
+    rather than as part of a batch, is retried rather than blowing up.
+    """
+    post = Post.create_local(author=identity, content="Hello")
+    fan_out = FanOut.objects.create(
+        identity=remote_identity, type=FanOut.Types.post, subject_post=post
+    )
+
+    # The server doesn't like what we sent
+    httpx_mock.add_response(status_code=400)
+    assert fan_out.transition_attempt() is None
+    assert fan_out.transition_outcome == OUTCOME_EXCEPTION
+    fan_out.refresh_from_db()
+    assert fan_out.state == FanOutStates.new
+    assert fan_out.state_attempts == 1
+
+    # The server asks us to come back later
+    httpx_mock.add_response(status_code=429, headers={"Retry-After": "120"})
+    started = timezone.now()
+    assert fan_out.transition_attempt() is None
+    assert fan_out.transition_outcome == OUTCOME_TRY_AGAIN_LATER
+    fan_out.refresh_from_db()
+    assert fan_out.state == FanOutStates.new
+    assert 120 <= (fan_out.state_next_attempt - started).total_seconds() < 130
+
+    # And then it works
+    httpx_mock.add_response()
+    assert fan_out.transition_attempt() == FanOutStates.sent
+    fan_out.refresh_from_db()
+    assert fan_out.state == FanOutStates.sent
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_delivers_concurrently(
+    config_system,
+    identity: Identity,
+    remote_identity: Identity,
+    remote_identity2: Identity,
+    monkeypatch,
+):
+    """
+    Tests that the async runner sends a batch's fan-outs to different servers
+    at once on its event loop, while each server's still go one at a time.
+    """
+    remote_identity2.inbox_uri = "https://remote2.test/@test/inbox/"
+    remote_identity2.save()
+    in_flight: dict[str, int] = {}
+    most_in_flight = {"total": 0, "per_host": 0}
+    threads = set()
+
+    async def asigned_request(self, method, uri, body=None):
+        host = urlparse(uri).hostname
+        in_flight[host] = in_flight.get(host, 0) + 1
+        most_in_flight["total"] = max(most_in_flight["total"], sum(in_flight.values()))
+        most_in_flight["per_host"] = max(most_in_flight["per_host"], in_flight[host])
+        threads.add(threading.current_thread())
+        await asyncio.sleep(0.2)
+        in_flight[host] -= 1
+
+    def signed_request(self, method, uri, body=None):
+        raise AssertionError("Sent without the event loop")
+
+    monkeypatch.setattr(Identity, "asigned_request", asigned_request)
+    monkeypatch.setattr(Identity, "signed_request", signed_request)
+    post = Post.create_local(author=identity, content="Hello")
+    fan_outs = [
+        FanOut.objects.create(
+            identity=target, type=FanOut.Types.post, subject_post=post
+        )
+        for target in [remote_identity, remote_identity2] * 2
+    ]
+    AsyncStatorRunner([FanOut], run_for=1).run()
+
+    for fan_out in fan_outs:
+        fan_out.refresh_from_db()
+        assert fan_out.state == FanOutStates.sent
+    assert most_in_flight == {"total": 2, "per_host": 1}
+    assert threads == {threading.main_thread()}
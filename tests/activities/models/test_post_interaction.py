@@ -439,3 +439,26 @@ def test_handle_remove_ap(remote_identity: Identity, config_system):
 
     # Remove activity on unknown post is a no-op
     PostInteraction.handle_remove_ap(data=remove_ap | {"object": "unknown-post"})
+
+
+@pytest.mark.django_db
+def test_handle_new_batch(identity: Identity, remote_identity: Identity, config_system):
+    """
+    Tests that a batch of new interactions is fanned out together, and that
+    one that fails doesn't stop the rest.
+    """
+    post = Post.create_local(author=identity, content="Hello")
+    like = PostInteraction.objects.create(
+        type=PostInteraction.Types.like, identity=remote_identity, post=post
+    )
+    broken = PostInteraction.objects.create(
+        type="unknown", identity=remote_identity, post=post
+    )
+    outcomes = PostInteraction.transition_attempt_batch([like, broken])
+    assert outcomes == {like.pk: PostInteractionStates.fanned_out, broken.pk: None}
+    like.refresh_from_db()
+    broken.refresh_from_db()
+    assert like.state == str(PostInteractionStates.fanned_out)
+    assert like.fan_outs.count() == 1
+    assert broken.state == str(PostInteractionStates.new)
+    assert broken.state_attempts == 1
@@ -1,7 +1,7 @@
 import pytest
 
-from activities.models import Post
-from users.models import Block, Domain, Follow, Identity
+from activities.models import Hashtag, Post, PostInteraction
+from users.models import Block, Domain, Follow, FollowStates, HashtagFollow, Identity
 
 
 @pytest.mark.django_db
@@ -179,3 +179,178 @@ def test_post_blocked(identity, other_identity, remote_identity):
     # The muted block should be in targets, the full block should not
     targets = post.get_targets()
     assert targets == {identity, other_identity}
+
+
+@pytest.mark.django_db
+def test_post_targets_interactions_hashtags(identity, other_identity, remote_identity):
+    """
+    Tests that people who interacted with a public post, and people who follow
+    its hashtags, are targeted (but neither is for mentions-only posts).
+    """
+    Hashtag.objects.create(hashtag="takahe")
+    HashtagFollow.objects.create(identity=other_identity, hashtag_id="takahe")
+    post = Post.objects.create(
+        content="<p>Hello #takahe</p>",
+        author=identity,
+        local=True,
+        hashtags=["takahe"],
+    )
+    PostInteraction.objects.create(
+        type=PostInteraction.Types.like,
+        identity=remote_identity,
+        post=post,
+    )
+    assert post.get_targets() == {identity, other_identity, remote_identity}
+
+    post.visibility = Post.Visibilities.mentioned
+    post.save()
+    assert post.get_targets() == {identity}
+
+
+@pytest.mark.django_db
+def test_post_targets_reply_to_local(
+    config_system, identity, other_identity, remote_identity
+):
+    """
+    Tests that a remote reply to a local post goes to the local author's
+    followers, and that the author's blocks still apply.
+    """
+    Follow.objects.create(
+        source=other_identity, target=identity, state=FollowStates.accepted
+    )
+    post = Post.create_local(author=identity, content="Hello")
+    reply = Post.objects.create(
+        content="<p>Reply</p>",
+        author=remote_identity,
+        local=False,
+        in_reply_to=post.object_uri,
+    )
+    assert reply.in_reply_to_post() == post
+    assert reply.get_targets() == {identity, other_identity}
+    assert sorted(reply.get_target_ids()) == sorted([identity.pk, other_identity.pk])
+
+    Block.objects.create(source=remote_identity, target=other_identity, mute=False)
+    assert reply.get_targets() == {identity}
+
+
+def python_targets(post: Post) -> set[Identity]:
+    """
+    The targets as get_targets used to work them out, one query per relation
+    and filtered in Python. When several share an inbox, it keeps the one
+    with the lowest ID, as the query does.
+    """
+    targets = set(post.mentions.all())
+    if post.visibility in [Post.Visibilities.public, Post.Visibilities.unlisted]:
+        targets.update(interaction.identity for interaction in post.interactions.all())
+    if post.visibility != Post.Visibilities.mentioned:
+        for follow in post.author.inbound_follows.filter(
+            state__in=FollowStates.group_active()
+        ):
+            targets.add(follow.source)
+        if post.hashtags:
+            for follow in HashtagFollow.objects.by_hashtags(post.hashtags):
+                targets.add(follow.identity)
+    reply_post = post.in_reply_to_post()
+    if reply_post:
+        targets.add(reply_post.author)
+        if reply_post.author.local:
+            for follow in reply_post.author.inbound_follows.filter(
+                state__in=FollowStates.group_active()
+            ):
+                targets.add(follow.source)
+    if not post.local or post.visibility == Post.Visibilities.local_only:
+        targets = {target for target in targets if target.local}
+    if post.local:
+        targets.add(post.author)
+    for block in post.author.outbound_blocks.active().filter(mute=False):
+        targets.discard(block.target)
+    deduped_targets = set()
+    shared_inboxes = set()
+    for target in sorted(targets, key=lambda target: target.pk):
+        if target.local or not target.shared_inbox_uri:
+            deduped_targets.add(target)
+        elif target.shared_inbox_uri not in shared_inboxes:
+            shared_inboxes.add(target.shared_inbox_uri)
+            deduped_targets.add(target)
+    return deduped_targets
+
+
+@pytest.mark.django_db
+def test_post_targets_match_python(
+    config_system, identity, other_identity, remote_identity, remote_identity2
+):
+    """
+    Tests that the set-based query picks exactly the same targets as the
+    per-relation Python version did, across mentions, followers, hashtags,
+    interactions, blocks, shared inboxes and replies.
+    """
+    remote_identity.shared_inbox_uri = "https://remote.test/inbox/"
+    remote_identity.save()
+    remote_friend = Identity.objects.create(
+        actor_uri="https://remote.test/friend-actor/",
+        inbox_uri="https://remote.test/@friend/inbox/",
+        shared_inbox_uri="https://remote.test/inbox/",
+        username="friend",
+        domain=remote_identity.domain,
+        local=False,
+    )
+    third_identity = Identity.objects.create(
+        actor_uri="https://example.com/@third@example.com/",
+        username="third",
+        domain=identity.domain,
+        local=True,
+    )
+    for source, target, state in [
+        (other_identity, identity, FollowStates.accepted),
+        (remote_identity, identity, FollowStates.accepted),
+        (remote_friend, identity, FollowStates.unrequested),
+        (remote_identity2, identity, FollowStates.accepted),
+        (third_identity, identity, FollowStates.undone),
+        (third_identity, remote_identity, FollowStates.accepted),
+        (other_identity, remote_friend, FollowStates.accepted),
+    ]:
+        Follow.objects.create(source=source, target=target, state=state)
+    Block.create_local_block(identity, remote_identity2)
+    Block.create_local_mute(identity, other_identity)
+    Hashtag.objects.create(hashtag="takahe")
+    HashtagFollow.objects.create(identity=third_identity, hashtag_id="takahe")
+
+    posts = []
+    for visibility in Post.Visibilities:
+        post = Post.create_local(
+            author=identity, content="Hello #takahe", visibility=visibility
+        )
+        post.mentions.add(remote_identity2, remote_friend)
+        PostInteraction.objects.create(
+            type=PostInteraction.Types.like, identity=third_identity, post=post
+        )
+        posts.append(post)
+        # A remote reply to it, mentioning someone we have locally
+        reply = Post.objects.create(
+            content="<p>Reply</p>",
+            author=remote_identity,
+            local=False,
+            visibility=visibility,
+            in_reply_to=post.object_uri,
+        )
+        reply.mentions.add(third_identity)
+        posts.append(reply)
+    # A remote post, and a local reply to it
+    remote_post = Post.objects.create(
+        content="<p>Remote</p>",
+        author=remote_friend,
+        local=False,
+        object_uri="https://remote.test/posts/1/",
+        hashtags=["takahe"],
+    )
+    posts.append(remote_post)
+    posts.append(
+        Post.create_local(author=other_identity, content="Hi", reply_to=remote_post)
+    )
+
+    for post in posts:
+        targets = python_targets(post)
+        assert post.get_targets() == targets
+        assert post.get_target_locality() == {
+            target.pk: target.local for target in targets
+        }
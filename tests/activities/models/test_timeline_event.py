@@ -330,3 +330,51 @@ def test_hashtag_followed(
         ).first()
         assert event
         assert "Hello from " in event.subject_post.content
+
+
+@pytest.mark.django_db
+def test_add_post_for_identities(
+    identity: Identity,
+    other_identity: Identity,
+    remote_identity: Identity,
+    config_system,
+):
+    """
+    Tests that adding a post to many timelines at once follows the reply
+    rules, and doesn't add anything twice if it's run again.
+    """
+    post = Post.create_local(author=other_identity, content="Hello")
+    reply = Post.objects.create(
+        author=other_identity,
+        content="<p>Reply</p>",
+        local=True,
+        in_reply_to="https://remote.test/posts/1/",
+    )
+    reply.mentions.add(remote_identity)
+    recipients = [identity.pk, other_identity.pk]
+
+    # Not following the author, so nobody sees the post or the reply
+    TimelineEvent.add_post_for_identities(recipients, reply)
+    assert not TimelineEvent.objects.filter(subject_post=reply).exists()
+
+    # Following the author but not whoever the reply is to still isn't enough
+    Follow.objects.create(source=identity, target=other_identity)
+    TimelineEvent.add_post_for_identities(recipients, reply)
+    assert not TimelineEvent.objects.filter(subject_post=reply).exists()
+
+    # Following both is
+    Follow.objects.create(source=identity, target=remote_identity)
+    TimelineEvent.add_post_for_identities(recipients, reply)
+    TimelineEvent.add_post_for_identities(recipients, reply)
+    assert list(
+        TimelineEvent.objects.filter(subject_post=reply).values_list("identity", "type")
+    ) == [(identity.pk, TimelineEvent.Types.post)]
+
+    # Top-level posts go to everyone who hasn't muted the author
+    Block.create_local_mute(identity, other_identity)
+    TimelineEvent.add_post_for_identities(recipients, post)
+    assert list(
+        TimelineEvent.objects.filter(subject_post=post).values_list(
+            "identity", flat=True
+        )
+    ) == [other_identity.pk]
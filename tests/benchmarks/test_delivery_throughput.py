@@ -0,0 +1,173 @@
+import datetime
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from activities.models import FanOut, FanOutStates, Post, PostStates
+from activities.models import fan_out as fan_out_module
+from users.models import Domain, Follow, Identity
+
+BATCH = 50
+
+
+class FakeInbox:
+    """
+    A stand-in ActivityPub inbox server on localhost, which accepts every
+    POST after `latency` seconds, except for an `error_rate` fraction of
+    them where it drops the connection instead.
+
+    Records when each delivery arrived, and for which path.
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.received: list[tuple[float, str]] = []
+        self.errors = 0
+        self.lock = threading.Lock()
+        inbox = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if inbox.latency:
+                    time.sleep(inbox.latency)
+                if random.random() < inbox.error_rate:
+                    with inbox.lock:
+                        inbox.errors += 1
+                    self.close_connection = True
+                    return
+                with inbox.lock:
+                    inbox.received.append((time.monotonic(), self.path))
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_followers(target: Identity, inbox: FakeInbox, followers: int, domains: int):
+    """
+    Creates `followers` remote identities spread over `domains` fake servers
+    (each with one shared inbox), all following `target`.
+    """
+    domain_objects = Domain.objects.bulk_create(
+        [
+            Domain(domain=f"remote{i}.test", local=False, state="updated")
+            for i in range(domains)
+        ]
+    )
+    sources = Identity.objects.bulk_create(
+        [
+            Identity(
+                actor_uri=f"https://remote{i % domains}.test/users/{i}/",
+                inbox_uri=f"{inbox.url}/remote{i % domains}/users/{i}/inbox/",
+                shared_inbox_uri=f"{inbox.url}/remote{i % domains}/inbox/",
+                username=f"user{i}",
+                domain=domain_objects[i % domains],
+                local=False,
+                state="updated",
+            )
+            for i in range(followers)
+        ]
+    )
+    Follow.objects.bulk_create(
+        [Follow(source=source, target=target, state="accepted") for source in sources]
+    )
+
+
+def run_fan_outs() -> int:
+    """
+    Runs the FanOut part of the Stator loop until nothing is ready, returning
+    how many fan-outs were attempted.
+    """
+    attempted = 0
+    while True:
+        instances = FanOut.transition_get_with_lock(
+            BATCH,
+            timezone.now() + datetime.timedelta(minutes=5),
+            states=[FanOutStates.new],
+        )
+        if not instances:
+            return attempted
+        FanOut.transition_attempt_batch(instances)
+        attempted += len(instances)
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    ["followers", "domains", "latency", "error_rate"],
+    [
+        (100, 100, 0, 0),
+        (1000, 1000, 0, 0),
+        (1000, 1000, 0.02, 0),
+        (1000, 1000, 0, 0.05),
+        (1000, 10, 0, 0),
+    ],
+)
+def test_delivery_throughput(identity, followers, domains, latency, error_rate):
+    """
+    Fans out one post from an account with remote followers on fake servers,
+    and reports how fast it reached them, and what each delivery cost us.
+
+    Servers share an inbox per domain, so fewer domains means fewer
+    deliveries for the same number of followers.
+    """
+    fan_out_module.body_cache.clear()
+    with FakeInbox(latency=latency, error_rate=error_rate) as inbox:
+        make_followers(identity, inbox, followers, domains)
+        post = Post.create_local(author=identity, content="Hello")
+
+        started = time.monotonic()
+        cpu_started = time.thread_time()
+        with CaptureQueriesContext(connection) as queries:
+            PostStates.handle_new(post)
+            attempted = run_fan_outs()
+        duration = time.monotonic() - started
+        cpu = time.thread_time() - cpu_started
+
+    delivered = len(inbox.received)
+    # Failed deliveries are retried later, so each was attempted just once
+    assert delivered + inbox.errors == attempted
+    assert delivered == len({path for _, path in inbox.received})
+    if not error_rate:
+        assert delivered == domains
+    latencies = sorted(arrived - started for arrived, _ in inbox.received)
+    quantiles = statistics.quantiles(latencies, n=100) if delivered > 1 else latencies
+    print(
+        f"\n{followers} follower(s) on {domains} server(s), "
+        f"{latency * 1000:.0f}ms latency, {error_rate:.0%} errors: "
+        f"{delivered} delivered, {inbox.errors} failed, in {duration:.2f}s "
+        f"({delivered / duration:.0f} deliveries/s); "
+        f"latency p50 {quantiles[len(quantiles) // 2]:.2f}s "
+        f"p99 {quantiles[-1]:.2f}s; "
+        f"{len(queries) / max(delivered, 1):.1f} queries and "
+        f"{cpu * 1000 / max(delivered, 1):.2f}ms CPU per delivery"
+    )
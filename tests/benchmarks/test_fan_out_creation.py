@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from activities.models import FanOut, Post, PostStates
+from core.snowflake import Snowflake
+from users.models import Domain, Follow, Identity
+
+
+def sequential_ids(first: int, count: int) -> list[int]:
+    """
+    Returns `count` distinct IDs of the same type as the snowflake `first`;
+    generating this many in one millisecond can otherwise clash.
+    """
+    return [first + (i << 3) for i in range(count)]
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize("followers", [100, 1000, 10000, 20000])
+def test_fan_out_creation(identity, followers):
+    """
+    Times creating the fan-outs for one new post from an account with N
+    remote followers, and reports the rate.
+    """
+    domain = Domain.objects.create(domain="remote.test", local=False, state="updated")
+    identity_ids = sequential_ids(Snowflake.generate_identity(), followers)
+    sources = Identity.objects.bulk_create(
+        [
+            Identity(
+                id=identity_ids[i],
+                actor_uri=f"https://remote.test/users/{i}/",
+                inbox_uri=f"https://remote.test/users/{i}/inbox/",
+                username=f"user{i}",
+                domain=domain,
+                local=False,
+                state="updated",
+            )
+            for i in range(followers)
+        ]
+    )
+    follow_ids = sequential_ids(Snowflake.generate_follow(), followers)
+    Follow.objects.bulk_create(
+        [
+            Follow(id=follow_id, source=source, target=identity, state="accepted")
+            for follow_id, source in zip(follow_ids, sources)
+        ]
+    )
+    post = Post.create_local(author=identity, content="Hello")
+
+    started = time.monotonic()
+    PostStates.targets_fan_out(post, FanOut.Types.post)
+    duration = time.monotonic() - started
+
+    # Every follower; the author's own timeline doesn't need a fan-out
+    assert FanOut.objects.filter(subject_post=post).count() == followers
+    print(
+        f"\n{followers} follower(s): created fan-outs in {duration:.2f}s "
+        f"({followers / duration:.0f} fan-outs/s)"
+    )
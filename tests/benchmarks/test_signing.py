@@ -0,0 +1,35 @@
+import time
+
+import pytest
+from pytest_httpx import HTTPXMock
+
+from core import signatures
+from core.signatures import HttpSignature
+
+REQUESTS = 500
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("cached", [False, True])
+def test_signed_request_throughput(httpx_mock: HTTPXMock, keypair, cached):
+    """
+    Times sending signed requests to a mocked inbox, with the private key
+    parsed every time (as before it was cached) or only once.
+    """
+    httpx_mock.add_response()
+    signatures.private_key_cache.clear()
+    started = time.monotonic()
+    for _ in range(REQUESTS):
+        if not cached:
+            signatures.private_key_cache.clear()
+        HttpSignature.signed_request(
+            uri="https://example.com/inbox",
+            body=b'{"type": "Create"}',
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+    duration = time.monotonic() - started
+    print(
+        f"\n{'cached' if cached else 'uncached'} keys: {REQUESTS} signed requests "
+        f"in {duration:.2f}s ({REQUESTS / duration:.0f} requests/s)"
+    )
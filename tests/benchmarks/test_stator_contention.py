@@ -0,0 +1,60 @@
+import datetime
+import threading
+import time
+
+import pytest
+from django.db import connections
+from django.utils import timezone
+
+from users.models import InboxMessage
+
+ROWS = 5000
+BATCH = 15
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("runners", [1, 2, 4, 8])
+def test_claim_contention(runners):
+    """
+    Runs N concurrent "runners" that do nothing but claim rows from one table
+    until it is drained, and reports claim throughput.
+
+    Also checks that no row is ever handed to two runners at once.
+    """
+    InboxMessage.objects.bulk_create(
+        [InboxMessage(message={"type": "Like", "id": i}) for i in range(ROWS)]
+    )
+    claimed: list[list[int]] = [[] for _ in range(runners)]
+    start = threading.Barrier(runners)
+
+    def runner(index: int):
+        start.wait()
+        try:
+            while True:
+                instances = InboxMessage.transition_get_with_lock(
+                    BATCH, timezone.now() + datetime.timedelta(minutes=5)
+                )
+                if not instances:
+                    break
+                claimed[index].extend(instance.pk for instance in instances)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=runner, args=(i,)) for i in range(runners)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - started
+
+    all_claimed = [pk for runner_claimed in claimed for pk in runner_claimed]
+    assert len(all_claimed) == ROWS
+    assert len(set(all_claimed)) == ROWS
+    print(
+        f"\n{runners} runner(s): claimed {ROWS} rows in {duration:.2f}s "
+        f"({ROWS / duration:.0f} rows/s; per runner: "
+        + ", ".join(str(len(c)) for c in claimed)
+        + ")"
+    )
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from core.batching import GroupCommitBuffer
+
+
+def test_group_commit():
+    """
+    Tests that items added while a flush is running share the next one,
+    and that nobody returns before their item is flushed.
+    """
+    flushed: list[list[int]] = []
+    first_flush_started = threading.Event()
+    release_first_flush = threading.Event()
+
+    def flush(items):
+        if not flushed:
+            first_flush_started.set()
+            release_first_flush.wait()
+        flushed.append(items)
+
+    buffer = GroupCommitBuffer(flush, max_batch=3)
+    returned = []
+
+    def add(item):
+        buffer.add(item)
+        returned.append(item)
+
+    first = threading.Thread(target=add, args=[0])
+    first.start()
+    first_flush_started.wait()
+    others = [threading.Thread(target=add, args=[i]) for i in range(1, 6)]
+    for thread in others:
+        thread.start()
+    while len(buffer.pending) < 5:
+        threading.Event().wait(0.01)
+    assert returned == []
+    release_first_flush.set()
+    for thread in [first, *others]:
+        thread.join()
+
+    assert flushed[0] == [0]
+    assert [len(batch) for batch in flushed[1:]] == [3, 2]
+    assert sorted(sum(flushed, [])) == sorted(returned) == list(range(6))
+    assert not buffer.flushing
+
+
+def test_group_commit_error():
+    """
+    Tests that everyone in a failed flush gets the error.
+    """
+
+    def flush(items):
+        raise ValueError("Database is sad")
+
+    buffer = GroupCommitBuffer(flush)
+    with pytest.raises(ValueError):
+        buffer.add(1)
+    assert not buffer.flushing
+
+
+def test_group_commit_hand_off():
+    """
+    Tests that each batch is flushed by the thread whose item is first in
+    it, so the first flusher isn't kept flushing everyone else's items.
+    """
+    flushed: list[tuple[str, list[int]]] = []
+    first_flush_started = threading.Event()
+    release_first_flush = threading.Event()
+
+    def flush(items):
+        flushed.append((threading.current_thread().name, items))
+        if len(flushed) == 1:
+            first_flush_started.set()
+            release_first_flush.wait()
+
+    buffer = GroupCommitBuffer(flush, max_batch=2)
+    threads = [
+        threading.Thread(target=buffer.add, args=[i], name=str(i)) for i in range(5)
+    ]
+    threads[0].start()
+    first_flush_started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    while len(buffer.pending) < 4:
+        threading.Event().wait(0.01)
+    release_first_flush.set()
+    for thread in threads:
+        thread.join()
+
+    assert [len(items) for _, items in flushed] == [1, 2, 2]
+    assert all(name == str(items[0]) for name, items in flushed)
+    assert not buffer.flushing
@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+from pytest_httpx import HTTPXMock
+
+from core import http
+from core.signatures import HttpSignature
+
+
+def test_client_shared(httpx_mock: HTTPXMock, keypair):
+    """
+    Tests that signed requests share one client, and that it's replaced
+    in forked children.
+    """
+    http.reset_client()
+    httpx_mock.add_response()
+    httpx_mock.add_response()
+    for _ in range(2):
+        HttpSignature.signed_request(
+            uri="https://example.com/inbox",
+            body={"type": "Create"},
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+    client = http.get_client()
+    assert http.get_client() is client
+    assert client.headers["User-Agent"]
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_fd, b"1" if http.get_client() is client else b"0")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b"0"
+    assert http.get_client() is client
+
+
+def test_async_client_per_loop(httpx_mock: HTTPXMock, keypair):
+    """
+    Tests that async signed requests share one client per event loop, and
+    are signed the same way as sync ones.
+    """
+    http.reset_client()
+    httpx_mock.add_response()
+    httpx_mock.add_response()
+
+    async def send_two():
+        for _ in range(2):
+            await HttpSignature.asigned_request(
+                uri="https://example.com/inbox",
+                body={"type": "Create"},
+                private_key=keypair["private_key"],
+                key_id=keypair["public_key_id"],
+            )
+        return http.get_async_client()
+
+    async def get_async_client():
+        return http.get_async_client()
+
+    client = asyncio.run(send_two())
+    assert client.headers["User-Agent"]
+    assert asyncio.run(get_async_client()) is not client
+    for request in httpx_mock.get_requests():
+        assert request.method == "POST"
+        assert keypair["public_key_id"] in request.headers["Signature"]
+        assert request.headers["Digest"].startswith("SHA-256=")
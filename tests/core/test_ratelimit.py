@@ -0,0 +1,23 @@
+from core import ratelimit
+from core.ratelimit import TokenBuckets
+
+
+def test_token_buckets(monkeypatch):
+    """
+    Tests that a bucket allows a burst, then spaces things out at its rate,
+    then refuses things that would be too far off.
+    """
+    now = 1000.0
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now)
+    buckets = TokenBuckets(rate=2, burst=3)
+    assert [buckets.take("a.test", 1) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a.test", 1) == 0.5
+    assert buckets.take("a.test", 1) == 1
+    # Too far off, so not taken (and the next one gets the same answer)
+    assert buckets.take("a.test", 1) == 1.5
+    assert buckets.take("a.test", 1) == 1.5
+    # Other keys are separate
+    assert buckets.take("b.test", 1) == 0
+    # And it refills over time, but only to the burst size
+    now += 60
+    assert [buckets.take("a.test", 0) for _ in range(4)] == [0, 0, 0, 0.5]
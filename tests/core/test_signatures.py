@@ -1,8 +1,17 @@
+import asyncio
+
 import pytest
 from django.test.client import RequestFactory
 from pytest_httpx import HTTPXMock
 
-from core.signatures import HttpSignature, LDSignature, VerificationError
+from core import signatures
+from core.signatures import (
+    HttpSignature,
+    LDSignature,
+    RateLimited,
+    RsaKeys,
+    VerificationError,
+)
 
 
 def test_sign_ld(keypair):
@@ -99,6 +108,49 @@ def test_sign_http(httpx_mock: HTTPXMock, keypair):
     HttpSignature.verify_request(fake_request, keypair["public_key"])
 
 
+def test_sign_http_async(httpx_mock: HTTPXMock, keypair):
+    """
+    Tests that async signed requests are signed the same way as sync ones
+    """
+    httpx_mock.add_response()
+    asyncio.run(
+        HttpSignature.asigned_request(
+            uri="https://example.com/test-actor",
+            body={"type": "Create"},
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+    )
+    outbound_request = httpx_mock.get_request()
+    fake_request = RequestFactory().post(
+        path="/test-actor",
+        data=outbound_request.content,
+        content_type=outbound_request.headers["content-type"],
+        HTTP_HOST="example.com",
+        HTTP_DATE=outbound_request.headers["date"],
+        HTTP_SIGNATURE=outbound_request.headers["signature"],
+        HTTP_DIGEST=outbound_request.headers["digest"],
+    )
+    HttpSignature.verify_request(fake_request, keypair["public_key"])
+
+
+def test_sign_http_rate_limited(httpx_mock: HTTPXMock, keypair):
+    """
+    Tests that a 429 on a POST raises RateLimited with the Retry-After hint
+    """
+    httpx_mock.add_response(status_code=429, headers={"Retry-After": "120"})
+    httpx_mock.add_response(status_code=429)
+    for retry_after in [120, None]:
+        with pytest.raises(RateLimited) as excinfo:
+            HttpSignature.signed_request(
+                uri="https://example.com/inbox",
+                body={"type": "Create"},
+                private_key=keypair["private_key"],
+                key_id=keypair["public_key_id"],
+            )
+        assert excinfo.value.retry_after == retry_after
+
+
 def test_verify_http(keypair):
     """
     Tests verifying HTTP requests against a known good example
@@ -136,3 +188,57 @@ def test_verify_http_bad_signature(keypair):
         HttpSignature.verify_request(
             fake_request, keypair["public_key"], skip_date=True
         )
+
+
+def test_private_key_cache(keypair, monkeypatch):
+    """
+    Tests that private keys are only parsed once, and again after they're
+    rotated.
+    """
+    signatures.private_key_cache.clear()
+    loads = []
+    load_pem_private_key = signatures.serialization.load_pem_private_key
+
+    def counting_load(data, password):
+        loads.append(data)
+        return load_pem_private_key(data, password)
+
+    monkeypatch.setattr(signatures.serialization, "load_pem_private_key", counting_load)
+    key_id = keypair["public_key_id"]
+    first = RsaKeys.load_private_key(keypair["private_key"], key_id)
+    assert RsaKeys.load_private_key(keypair["private_key"], key_id) is first
+    LDSignature.create_signature({"type": "Note"}, keypair["private_key"], key_id)
+    assert len(loads) == 1
+
+    RsaKeys.forget_private_keys(key_id)
+    assert RsaKeys.load_private_key(keypair["private_key"], key_id) is not first
+    assert len(loads) == 2
+
+    # A new PEM under the same key ID is never confused with the old one
+    new_private_key, _ = RsaKeys.generate_keypair()
+    assert RsaKeys.load_private_key(new_private_key, key_id) is not first
+    assert len(loads) == 3
+
+
+def test_public_key_cache(keypair, monkeypatch):
+    """
+    Tests that public keys are only parsed once when verifying, however
+    many messages they sign.
+    """
+    signatures.public_key_cache.clear()
+    loads = []
+    load_pem_public_key = signatures.serialization.load_pem_public_key
+
+    def counting_load(data):
+        loads.append(data)
+        return load_pem_public_key(data)
+
+    monkeypatch.setattr(signatures.serialization, "load_pem_public_key", counting_load)
+    for _ in range(3):
+        signature_section = LDSignature.create_signature(
+            {"type": "Note"}, keypair["private_key"], keypair["public_key_id"]
+        )
+        LDSignature.verify_signature(
+            {"type": "Note", "signature": signature_section}, keypair["public_key"]
+        )
+    assert len(loads) == 1
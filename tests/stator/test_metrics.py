@@ -0,0 +1,77 @@
+import httpx
+import pytest
+
+from stator.exceptions import TryAgainLater
+from stator.metrics import TransitionMetrics, serve_metrics, transition_metrics
+from stator.runner import task_transition
+from users.models import InboxMessage, InboxMessageStates
+
+
+def test_render():
+    """
+    Tests the histograms come out in the Prometheus text format.
+    """
+    metrics = TransitionMetrics()
+    metrics.observe("users.follow", "unrequested", "success", 0.2)
+    metrics.observe("users.follow", "unrequested", "success", 3)
+    metrics.observe("users.follow", "unrequested", "success", 100)
+    lines = metrics.render().splitlines()
+    labels = 'model="users.follow",state="unrequested",outcome="success"'
+    name = "stator_transition_duration_seconds"
+    assert f"# TYPE {name} histogram" in lines
+    assert f'{name}_bucket{{{labels},le="0.1"}} 0' in lines
+    assert f'{name}_bucket{{{labels},le="0.25"}} 1' in lines
+    assert f'{name}_bucket{{{labels},le="5"}} 2' in lines
+    assert f'{name}_bucket{{{labels},le="+Inf"}} 3' in lines
+    assert f"{name}_sum{{{labels}}} 103.2" in lines
+    assert f"{name}_count{{{labels}}} 3" in lines
+
+
+@pytest.mark.django_db
+def test_transition_outcomes(monkeypatch):
+    """
+    Tests that running transitions records what happened to them.
+    """
+    transition_metrics.reset()
+    outcomes = iter([InboxMessageStates.processed, None, TryAgainLater(), KeyError()])
+
+    def handle_received(cls, instance):
+        outcome = next(outcomes)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(
+        InboxMessageStates, "handle_received", classmethod(handle_received)
+    )
+    for _ in range(4):
+        task_transition(
+            InboxMessage.objects.create(message={"type": "Like"}), in_thread=False
+        )
+    counts = {
+        outcome: sum(histogram[:-1])
+        for (_, _, outcome), histogram in transition_metrics.histograms.items()
+    }
+    assert counts == {
+        "success": 1,
+        "unchanged": 1,
+        "try_again_later": 1,
+        "exception": 1,
+    }
+
+
+def test_serve_metrics():
+    """
+    Tests the runner's metrics server.
+    """
+    transition_metrics.reset()
+    transition_metrics.observe("users.follow", "unrequested", "success", 1)
+    server = serve_metrics(0, host="127.0.0.1")
+    try:
+        base = f"http://127.0.0.1:{server.server_port}"
+        response = httpx.get(f"{base}/metrics")
+        assert response.status_code == 200
+        assert 'model="users.follow"' in response.text
+        assert httpx.get(f"{base}/other").status_code == 404
+    finally:
+        server.shutdown()
@@ -0,0 +1,235 @@
+import datetime
+
+import pytest
+from django.utils import timezone
+
+from activities.models import Hashtag, HashtagStates
+from stator.exceptions import TryAgainLater
+from stator.models import Stats
+from users.models import InboxMessage, InboxMessageStates
+
+
+@pytest.mark.django_db
+def test_transition_get_with_lock():
+    """
+    Tests that claiming rows locks them, and that locked or not-yet-due rows
+    are not handed out again.
+    """
+    for i in range(5):
+        InboxMessage.objects.create(message={"type": "Like", "id": i})
+    InboxMessage.objects.create(
+        message={"type": "Like", "id": "later"},
+        state_next_attempt=timezone.now() + datetime.timedelta(hours=1),
+    )
+    lock_expiry = timezone.now() + datetime.timedelta(minutes=5)
+
+    claimed = InboxMessage.transition_get_with_lock(3, lock_expiry)
+    assert len(claimed) == 3
+    # The returned instances are full model instances with the new lock
+    assert all(isinstance(instance, InboxMessage) for instance in claimed)
+    assert all(instance.state_locked_until == lock_expiry for instance in claimed)
+    assert all(instance.message["type"] == "Like" for instance in claimed)
+
+    # The next claim only gets what's left and due
+    remaining = InboxMessage.transition_get_with_lock(10, lock_expiry)
+    assert len(remaining) == 2
+    assert {i.pk for i in claimed}.isdisjoint({i.pk for i in remaining})
+    assert InboxMessage.transition_get_with_lock(10, lock_expiry) == []
+
+
+@pytest.mark.django_db
+def test_transition_attempt_batch(monkeypatch):
+    """
+    Tests that batch handlers get many instances at once, and that their
+    per-instance results are applied.
+    """
+    hashtags = [
+        Hashtag.objects.create(hashtag=f"batch{i}", state=HashtagStates.outdated)
+        for i in range(4)
+    ]
+    calls = []
+
+    def handle_outdated_batch(cls, instances):
+        calls.append(len(instances))
+        # Leave the first one alone
+        return {instance.pk: cls.updated for instance in instances[1:]}
+
+    monkeypatch.setattr(
+        HashtagStates, "handle_outdated_batch", classmethod(handle_outdated_batch)
+    )
+    claimed = Hashtag.transition_get_with_lock(
+        10,
+        timezone.now() + datetime.timedelta(minutes=5),
+        states=[HashtagStates.outdated],
+    )
+    results = Hashtag.transition_attempt_batch(claimed)
+    assert calls == [4]
+    assert sorted(results.values(), key=bool) == [None] + [HashtagStates.updated] * 3
+
+    states = dict(Hashtag.objects.values_list("pk", "state"))
+    assert sorted(states.values()) == ["outdated", "updated", "updated", "updated"]
+    # The unchanged one is unlocked and pushed back by its try_interval
+    unchanged = Hashtag.objects.get(state=HashtagStates.outdated)
+    assert unchanged.state_locked_until is None
+    assert unchanged.state_next_attempt > timezone.now()
+    assert {h.pk for h in hashtags} == set(states)
+
+
+@pytest.mark.django_db
+def test_hashtag_batch_error(monkeypatch):
+    """
+    Tests that one hashtag failing doesn't stop the rest of its batch.
+    """
+    for i in range(3):
+        Hashtag.objects.create(hashtag=f"error{i}", state=HashtagStates.outdated)
+    hashtags = list(Hashtag.objects.order_by("hashtag"))
+
+    def handle_outdated(cls, instance):
+        if instance.hashtag == "error1":
+            raise ValueError("Broken")
+        return cls.updated
+
+    monkeypatch.setattr(HashtagStates, "handle_outdated", classmethod(handle_outdated))
+    results = Hashtag.transition_attempt_batch(hashtags)
+    assert results == {
+        hashtags[0].pk: HashtagStates.updated,
+        hashtags[1].pk: None,
+        hashtags[2].pk: HashtagStates.updated,
+    }
+    assert hashtags[1].transition_outcome == "exception"
+
+
+@pytest.mark.django_db
+def test_transition_ready_age():
+    """
+    Tests that queue age is measured from when the oldest instance became
+    ready, ignoring ones that aren't due yet.
+    """
+    assert InboxMessage.transition_ready_age() == 0
+    InboxMessage.objects.create(
+        message={"type": "Like"},
+        state_next_attempt=timezone.now() - datetime.timedelta(minutes=10),
+    )
+    InboxMessage.objects.create(
+        message={"type": "Like"},
+        state_next_attempt=timezone.now() - datetime.timedelta(hours=2),
+        state_locked_until=timezone.now() + datetime.timedelta(minutes=5),
+    )
+    InboxMessage.objects.create(
+        message={"type": "Like"},
+        state_next_attempt=timezone.now() + datetime.timedelta(hours=1),
+    )
+    assert 600 <= InboxMessage.transition_ready_age() < 660
+
+
+@pytest.mark.django_db
+def test_stats_record():
+    """
+    Tests that stats from several runners add up in each bucket, and that
+    old buckets get trimmed.
+    """
+    Stats.record("users.follow", handled=3, queued=10, durations=[1.0, 2.0, 3.0])
+    Stats.record("users.follow", handled=1, queued=4, durations=[6.0])
+    current = Stats.current()["users.follow"]
+    assert set(current) == {"hour", "day", "month"}
+    for row in current.values():
+        assert row.handled == 4
+        assert row.queued == 4
+        # (2.0 * 3 + 6.0 * 1) / 4
+        assert row.duration_p50 == pytest.approx(3.0)
+
+    old = timezone.now() - datetime.timedelta(days=3)
+    Stats.objects.create(
+        model_label="users.follow", granularity="hour", bucket=old, handled=1
+    )
+    Stats.objects.create(
+        model_label="users.follow", granularity="day", bucket=old, handled=1
+    )
+    Stats.trim()
+    assert not Stats.objects.filter(granularity="hour", bucket=old).exists()
+    assert Stats.objects.filter(granularity="day", bucket=old).exists()
+
+
+@pytest.mark.django_db
+def test_transition_ready_estimate():
+    """
+    Tests that short queues are counted exactly, and long ones are only
+    counted as far as the limit before being estimated.
+    """
+    for i in range(5):
+        InboxMessage.objects.create(message={"type": "Like", "id": i})
+    assert InboxMessage.transition_ready_estimate(10) == (5, False)
+    assert InboxMessage.transition_ready_estimate(5) == (5, False)
+    count, approximate = InboxMessage.transition_ready_estimate(3)
+    assert approximate
+    assert count >= 3
+
+
+@pytest.mark.django_db
+def test_transition_backoff(monkeypatch):
+    """
+    Tests that failed attempts are counted and back off, that retry_after
+    hints override the backoff, and that moving on resets the count.
+    """
+    results = iter(
+        [None, None, TryAgainLater(retry_after=5), InboxMessageStates.processed]
+    )
+
+    def handle_received(cls, instance):
+        result = next(results)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    monkeypatch.setattr(
+        InboxMessageStates, "handle_received", classmethod(handle_received)
+    )
+    monkeypatch.setattr(InboxMessageStates.received, "backoff_jitter", 0)
+    message = InboxMessage.objects.create(message={"type": "Like"})
+
+    delays = []
+    for _ in range(3):
+        started = timezone.now()
+        message.transition_attempt()
+        message.refresh_from_db()
+        delays.append((message.state_next_attempt - started).total_seconds())
+    assert message.state_attempts == 3
+    assert 300 <= delays[0] < 310
+    assert 600 <= delays[1] < 610
+    assert 5 <= delays[2] < 15
+
+    message.transition_attempt()
+    message.refresh_from_db()
+    assert message.state == InboxMessageStates.processed
+    assert message.state_attempts == 0
+
+
+@pytest.mark.django_db
+def test_transition_get_with_lock_shard():
+    """
+    Tests that shards split up the rows between them with no overlap.
+    """
+    messages = [
+        InboxMessage.objects.create(message={"type": "Like", "id": i})
+        for i in range(20)
+    ]
+    lock_expiry = timezone.now() + datetime.timedelta(minutes=5)
+    shards = [
+        {
+            instance.pk
+            for instance in InboxMessage.transition_get_with_lock(
+                100, lock_expiry, shard=(index, 3)
+            )
+        }
+        for index in range(3)
+    ]
+    assert sum(len(shard) for shard in shards) == 20
+    assert set().union(*shards) == {message.pk for message in messages}
+    # Hashtags have string primary keys, which shard just the same
+    for i in range(6):
+        Hashtag.objects.create(hashtag=f"shard{i}", state=HashtagStates.outdated)
+    claimed = [
+        len(Hashtag.transition_get_with_lock(100, lock_expiry, shard=(index, 2)))
+        for index in range(2)
+    ]
+    assert sum(claimed) == 6
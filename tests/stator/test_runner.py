@@ -0,0 +1,116 @@
+import asyncio
+import signal
+import threading
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from activities.models import Hashtag, HashtagStates
+from core import http
+from stator.runner import AsyncStatorRunner, NotifyListener, StatorRunner
+from users.models import InboxMessage, InboxMessageStates
+
+
+@pytest.mark.django_db
+def test_claim_once_per_model():
+    """
+    Tests that each model's share of the slots is claimed with one query,
+    with batch states splitting theirs up into batches afterwards.
+    """
+    for i in range(30):
+        InboxMessage.objects.create(message={"type": "Like", "id": i})
+    for i in range(100):
+        Hashtag.objects.create(hashtag=f"claim{i}", state=HashtagStates.outdated)
+    runner = StatorRunner(
+        [InboxMessage, Hashtag], concurrency=10, concurrency_per_model=5
+    )
+    runner.handled = {}
+    with CaptureQueriesContext(connection) as queries:
+        claimed = runner.claim_transition_instances()
+    claims = [query["sql"] for query in queries if "SKIP LOCKED" in query["sql"]]
+    assert len([sql for sql in claims if "users_inboxmessage" in sql]) == 1
+    assert len([sql for sql in claims if "activities_hashtag" in sql]) == 1
+    assert len(claimed) == 10
+    batches = [instances for model, _, instances, batch in claimed if batch]
+    assert [len(instances) for instances in batches] == [20] * 5
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_sync_handler(config_system):
+    """
+    Tests that the async runner pushes sync handlers through its thread pool.
+    """
+    messages = [
+        InboxMessage.objects.create(message={"type": "Move", "object": "x"})
+        for _ in range(3)
+    ]
+    AsyncStatorRunner([InboxMessage], run_for=1, database_concurrency=2).run()
+    for message in messages:
+        message.refresh_from_db()
+        assert message.state == InboxMessageStates.processed
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_coroutine_handler(config_system, monkeypatch):
+    """
+    Tests that coroutine handlers are run directly on the runner's event loop
+    rather than getting their own thread and loop.
+    """
+    handler_threads = []
+
+    async def handle_received(cls, instance):
+        handler_threads.append(threading.current_thread())
+        return cls.processed
+
+    monkeypatch.setattr(
+        InboxMessageStates, "handle_received", classmethod(handle_received)
+    )
+    message = InboxMessage.objects.create(message={"type": "Move", "object": "x"})
+    AsyncStatorRunner([InboxMessage], run_for=1).run()
+    message.refresh_from_db()
+    assert message.state == InboxMessageStates.processed
+    assert handler_threads == [threading.main_thread()]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_runner_cancelled(config_system):
+    """
+    Tests that the async runner still shuts down properly when it's cancelled,
+    which is what asyncio.run does to it on Ctrl-C, and closes its HTTP client.
+    """
+    runner = AsyncStatorRunner([InboxMessage])
+    clients = []
+
+    async def run_and_cancel():
+        task = asyncio.create_task(runner.arun())
+        await asyncio.sleep(0.5)
+        clients.append(http.get_async_client())
+        task.cancel()
+        await task
+
+    asyncio.run(run_and_cancel())
+    # The watchdog alarm is turned off, and the client closed
+    assert signal.alarm(0) == 0
+    assert clients[0].is_closed
+
+
+@pytest.mark.django_db(transaction=True)
+def test_notify_listener():
+    """
+    Tests that creating ready instances wakes up listeners, and that moving
+    things into states nobody needs to run does not.
+    """
+    woken = threading.Event()
+    listener = NotifyListener(woken.set)
+    listener.start()
+    try:
+        assert listener.listening.wait(5)
+        message = InboxMessage.objects.create(message={"type": "Move"})
+        assert woken.wait(5)
+        woken.clear()
+        message.transition_perform(InboxMessageStates.processed)
+        assert not woken.wait(0.5)
+    finally:
+        listener.stop()
+        listener.join()
@@ -0,0 +1,96 @@
+from activities.models import FanOut, Hashtag
+from stator.scheduler import FairScheduler
+from users.models import Follow, InboxMessage
+
+
+def make_claim(queues: dict, log: list):
+    """
+    Returns a claim function that takes from fake per-model queue lengths
+    """
+
+    def claim(model, number):
+        got = min(number, queues[model])
+        queues[model] -= got
+        log.extend([model] * got)
+        return got
+
+    return claim
+
+
+def test_lanes():
+    """
+    Tests that interactive work gets capacity before default and bulk work,
+    and that lower lanes get whatever is left over.
+    """
+    scheduler = FairScheduler([FanOut, Hashtag, Follow])
+    queues = {FanOut: 100, Hashtag: 100, Follow: 3}
+    log: list = []
+    left = scheduler.allocate(10, per_model=10, claim=make_claim(queues, log))
+    assert left == 0
+    assert log[:3] == [Follow] * 3
+    assert log.count(FanOut) == 7
+    assert log.count(Hashtag) == 0
+
+    # Lanes can be overridden by label, by name or number
+    scheduler = FairScheduler(
+        [FanOut, Follow],
+        lanes={"activities.fanout": "interactive", "users.follow": 2},
+    )
+    log = []
+    scheduler.allocate(
+        5, per_model=10, claim=make_claim({FanOut: 100, Follow: 100}, log)
+    )
+    assert log == [FanOut] * 5
+
+
+def test_weights_and_fairness():
+    """
+    Tests that models in a lane share capacity by weight, that the per-model
+    limit holds, and that the first pick rotates between passes.
+    """
+    scheduler = FairScheduler(
+        [InboxMessage, Follow],
+        weights={"users.inboxmessage": 3},
+    )
+    queues = {InboxMessage: 100, Follow: 100}
+    log: list = []
+    scheduler.allocate(8, per_model=10, claim=make_claim(queues, log))
+    assert log.count(InboxMessage) == 6
+    assert log.count(Follow) == 2
+
+    log = []
+    scheduler.allocate(8, per_model=3, claim=make_claim(queues, log))
+    assert log.count(InboxMessage) == 3
+    assert log.count(Follow) == 3
+
+    # With one slot a pass, Follow still gets its turn
+    log = []
+    for _ in range(8):
+        scheduler.allocate(1, per_model=10, claim=make_claim(queues, log))
+    assert log.count(InboxMessage) == 6
+    assert log.count(Follow) == 2
+
+
+def test_one_claim_per_model():
+    """
+    Tests that each model claims its whole share in one go, and only claims
+    again if another model runs out of work and leaves it more space.
+    """
+    scheduler = FairScheduler([InboxMessage, Follow], weights={"users.inboxmessage": 1})
+    calls: list = []
+    queues = {InboxMessage: 100, Follow: 100}
+
+    def claim(model, number):
+        calls.append((model, number))
+        return make_claim(queues, [])(model, number)
+
+    scheduler.allocate(10, per_model=10, claim=claim)
+    assert sorted(calls, key=str) == sorted([(InboxMessage, 5), (Follow, 5)], key=str)
+
+    # Follow only has 2 to do, so InboxMessage gets the rest in a second claim
+    calls = []
+    queues = {InboxMessage: 100, Follow: 2}
+    left = scheduler.allocate(10, per_model=10, claim=claim)
+    assert left == 0
+    assert calls.count((Follow, 5)) == 1
+    assert calls[-1] == (InboxMessage, 3)
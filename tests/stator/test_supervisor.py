@@ -0,0 +1,72 @@
+import os
+import time
+
+from stator.supervisor import StatorSupervisor
+
+
+class FakeRunner:
+    """
+    Stands in for a runner: records that it ran, and which shard it had.
+    """
+
+    def __init__(self, shard, liveness_file, record_file, crash=False):
+        self.shard = shard
+        self.liveness_file = liveness_file
+        self.record_file = record_file
+        self.crash = crash
+
+    def run(self):
+        with open(self.record_file, "a") as fh:
+            fh.write(f"{self.shard[0]}/{self.shard[1]}\n")
+        with open(self.liveness_file, "w") as fh:
+            fh.write(str(int(time.time())))
+        if self.crash:
+            os._exit(1)
+
+
+def test_supervisor_shards(tmp_path):
+    """
+    Tests that each child gets its own shard, and their liveness files are
+    combined into the main one.
+    """
+    record_file = tmp_path / "record"
+    liveness_file = tmp_path / "liveness"
+    supervisor = StatorSupervisor(
+        3,
+        runner_factory=lambda shard, liveness: FakeRunner(shard, liveness, record_file),
+        liveness_file=str(liveness_file),
+        run_for=1,
+        check_interval=0.1,
+    )
+    supervisor.run()
+    assert sorted(record_file.read_text().split()) == ["0/3", "1/3", "2/3"]
+    # The main liveness file holds the oldest child's timestamp
+    supervisor.children = {0: None, 1: None, 2: None}  # type: ignore
+    supervisor.started_at = {0: 0, 1: 0, 2: 0}
+    (tmp_path / "liveness.1").write_text("1000")
+    supervisor.write_liveness()
+    assert liveness_file.read_text() == "1000"
+
+
+def test_supervisor_restarts(tmp_path):
+    """
+    Tests that children that crash get restarted.
+    """
+    record_file = tmp_path / "record"
+    supervisor = StatorSupervisor(
+        1,
+        runner_factory=lambda shard, liveness: FakeRunner(
+            shard, str(tmp_path / "liveness.0"), record_file, crash=True
+        ),
+        restart_delay=0,
+        check_interval=0.1,
+    )
+    for index in range(supervisor.processes):
+        supervisor.start_child(index)
+    deadline = time.monotonic() + 10
+    while supervisor.restarts < 2 and time.monotonic() < deadline:
+        supervisor.check_children()
+        time.sleep(0.05)
+    supervisor.stop_children()
+    assert supervisor.restarts >= 2
+    assert len(record_file.read_text().split()) >= 3
@@ -1,4 +1,7 @@
+import datetime
+
 import pytest
+from django.utils import timezone
 
 from users.models import Domain
 
@@ -51,3 +54,46 @@ def test_recursive_block():
 
     # An unrelated domain should not be blocked
     assert not Domain.get_remote_domain("example.com").recursively_blocked()
+
+
+@pytest.mark.django_db
+def test_circuit_breaker():
+    """
+    Tests a domain's circuit opens after enough failures, for longer each
+    time, lets one probe through when it's due, and closes on a success.
+    """
+    domain = Domain.objects.create(domain="down.test", local=False)
+    for _ in range(Domain.CIRCUIT_FAILURE_THRESHOLD - 1):
+        domain.circuit_record_failure()
+    assert domain.circuit_retry_after() == 0
+    domain.circuit_record_failure()
+    first_pause = domain.circuit_retry_after()
+    assert 0 < first_pause <= Domain.CIRCUIT_OPEN_MINIMUM
+    domain.circuit_record_failure()
+    assert domain.circuit_retry_after() > first_pause
+
+    # Other processes see the same thing
+    domain = Domain.objects.get(pk="down.test")
+    assert domain.circuit_state == Domain.CircuitStates.open
+    assert domain.circuit_retry_after() > first_pause
+    assert not domain.circuit_dead
+
+    # When the probe is due, only one caller gets to make it
+    Domain.objects.filter(pk="down.test").update(
+        circuit_next_probe=timezone.now(),
+        circuit_opened=timezone.now() - datetime.timedelta(days=4),
+    )
+    domain = Domain.objects.get(pk="down.test")
+    other = Domain.objects.get(pk="down.test")
+    assert domain.circuit_retry_after() == 0
+    assert domain.circuit_state == Domain.CircuitStates.half_open
+    assert other.circuit_retry_after() > 0
+    assert other.circuit_dead
+
+    domain.circuit_record_success()
+    domain = Domain.objects.get(pk="down.test")
+    assert domain.circuit_state == Domain.CircuitStates.closed
+    assert domain.circuit_failures == 0
+    assert domain.circuit_last_success is not None
+    assert domain.circuit_retry_after() == 0
+    assert not domain.circuit_dead
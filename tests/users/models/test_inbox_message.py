@@ -0,0 +1,174 @@
+import datetime
+import threading
+
+import pytest
+from django.db import connection
+from django.utils import timezone
+
+from activities.models import Post
+from users.models import InboxMessage, InboxMessageStates, inbox_message
+
+
+@pytest.mark.django_db
+def test_undone_in_queue(remote_identity):
+    """
+    Tests that a Create with a Delete for it still queued is skipped, and
+    that a Delete or Undo marks what it undoes as processed.
+    """
+    note = {
+        "id": "https://remote.test/test-actor/posts/1/",
+        "type": "Note",
+        "attributedTo": remote_identity.actor_uri,
+        "content": "Hello",
+        "to": "as:Public",
+    }
+    create = InboxMessage.objects.create(
+        message={
+            "id": "https://remote.test/test-actor/posts/1/create/",
+            "type": "Create",
+            "actor": remote_identity.actor_uri,
+            "object": note,
+        }
+    )
+    delete = InboxMessage.objects.create(
+        message={
+            "id": "https://remote.test/test-actor/posts/1/delete/",
+            "type": "Delete",
+            "actor": remote_identity.actor_uri,
+            "object": {"id": note["id"], "type": "Tombstone"},
+        }
+    )
+    # Someone else deleting it doesn't count
+    InboxMessage.objects.create(
+        message={
+            "id": "https://remote2.test/test-actor/delete/",
+            "type": "Delete",
+            "actor": "https://remote2.test/test-actor/",
+            "object": note["id"],
+        }
+    )
+    assert create.undone_in_queue()
+    assert InboxMessageStates.handle_received(create) == InboxMessageStates.processed
+    assert not Post.objects.filter(object_uri=note["id"]).exists()
+    assert not delete.undone_in_queue()
+
+    like = InboxMessage.objects.create(
+        message={
+            "id": "https://remote.test/test-actor/likes/1/",
+            "type": "Like",
+            "actor": remote_identity.actor_uri,
+            "object": "https://example.com/@test@example.com/posts/1/",
+        }
+    )
+    undo = InboxMessage.objects.create(
+        message={
+            "id": "https://remote.test/test-actor/likes/1/undo/",
+            "type": "Undo",
+            "actor": remote_identity.actor_uri,
+            "object": like.message,
+        }
+    )
+    assert InboxMessageStates.handle_received(undo) == InboxMessageStates.processed
+    like.refresh_from_db()
+    assert like.state == InboxMessageStates.processed
+
+
+@pytest.mark.django_db
+def test_classify_and_priority():
+    """
+    Tests that messages are classified when saved, and relationship ones
+    are claimed before content, before reactions.
+    """
+    like = InboxMessage.objects.create(
+        message={
+            "type": "Like",
+            "actor": "https://Remote.test/test-actor/",
+            "object": "https://example.com/@test@example.com/posts/1/",
+        }
+    )
+    create = InboxMessage.objects.create(
+        message={
+            "type": "Create",
+            "actor": "https://remote.test/test-actor/",
+            "object": {
+                "id": "https://remote.test/test-actor/posts/1/",
+                "type": "Note",
+                "content": "Hello",
+            },
+        }
+    )
+    follow = InboxMessage.objects.create(
+        message={
+            "type": "Follow",
+            "actor": "https://remote.test/test-actor/",
+            "object": "https://example.com/@test@example.com/",
+        }
+    )
+    assert (like.message_type, like.message_object_type) == ("like", None)
+    assert like.message_object_uri == "https://example.com/@test@example.com/posts/1/"
+    assert like.actor_domain == "remote.test"
+    assert not like.message_object_has_content
+    assert create.message_type_full == "create.note"
+    assert create.message_object_uri == "https://remote.test/test-actor/posts/1/"
+    assert create.message_object_has_content
+
+    lock_expiry = timezone.now() + datetime.timedelta(minutes=1)
+    claimed = [
+        InboxMessage.transition_get_with_lock(1, lock_expiry)[0].pk for _ in range(3)
+    ]
+    assert claimed == [follow.pk, create.pk, like.pk]
+
+
+@pytest.mark.django_db
+def test_skip_types(settings, monkeypatch):
+    """
+    Tests that message types we've been told to skip aren't processed.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_SKIP_TYPES", ["create.note"])
+    create = InboxMessage.objects.create(
+        message={
+            "type": "Create",
+            "actor": "https://remote.test/test-actor/",
+            "object": {
+                "id": "https://remote.test/test-actor/posts/1/",
+                "type": "Note",
+                "content": "Hello",
+            },
+        }
+    )
+    assert InboxMessageStates.handle_received(create) == InboxMessageStates.processed
+    assert not Post.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_create_batched_concurrent(settings, monkeypatch):
+    """
+    Tests that with group commit on, deliveries being saved by several
+    threads at once share INSERTs.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_GROUP_COMMIT", True)
+    monkeypatch.setattr(inbox_message.inbox_buffer, "max_wait", 0.5)
+    batches = []
+
+    def flush(instances):
+        batches.append(len(instances))
+        InboxMessage.bulk_insert(instances)
+
+    monkeypatch.setattr(inbox_message.inbox_buffer, "flush", flush)
+
+    def deliver(number):
+        try:
+            InboxMessage.create_batched(
+                {"type": "Like", "id": f"https://remote.test/likes/{number}"}
+            )
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=deliver, args=[i]) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert InboxMessage.objects.count() == 8
+    assert sum(batches) == 8
+    assert max(batches) > 1
@@ -1,6 +1,9 @@
 import pytest
+from pytest_httpx import HTTPXMock
 
-from users.models import InboxMessage
+from core.signatures import HttpSignature
+from users.models import Domain, InboxMessage, InboxMessageStates
+from users.views import activitypub
 
 
 @pytest.mark.django_db
@@ -112,3 +115,287 @@ def test_ignore_lemmy(client, identity):
     )
     assert num_inbox_messages == InboxMessage.objects.count()
     assert resp.status_code == 202
+
+
+@pytest.mark.django_db
+def test_inbox_replay(
+    client,
+    settings,
+    monkeypatch,
+    httpx_mock: HTTPXMock,
+    identity,
+    remote_identity,
+    keypair,
+):
+    """
+    Tests that an exact copy of a signed delivery we've accepted is dropped,
+    but a freshly signed one isn't.
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    monkeypatch.setattr(settings.SETUP, "INBOX_DUPLICATE_WINDOW", 0)
+    remote_identity.public_key = keypair["public_key"]
+    remote_identity.public_key_id = keypair["public_key_id"]
+    remote_identity.save()
+    document = {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://remote.test/test-actor/likes/1",
+        "type": "Like",
+        "actor": remote_identity.actor_uri,
+        "object": "https://example.com/@test@example.com/posts/1/",
+    }
+
+    def sign():
+        httpx_mock.add_response()
+        HttpSignature.signed_request(
+            uri="https://example.com/inbox/",
+            body=document,
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+        return httpx_mock.get_requests()[-1]
+
+    def deliver(request):
+        return client.post(
+            "https://example.com/inbox/",
+            data=request.content,
+            content_type=request.headers["content-type"],
+            HTTP_HOST="example.com",
+            HTTP_DATE=request.headers["date"],
+            HTTP_DIGEST=request.headers["digest"],
+            HTTP_SIGNATURE=request.headers["signature"],
+        )
+
+    num_inbox_messages = InboxMessage.objects.count()
+    signed = sign()
+    assert deliver(signed).status_code == 202
+    assert deliver(signed).status_code == 202
+    assert InboxMessage.objects.count() == num_inbox_messages + 1
+
+    # A tampered copy isn't mistaken for a replay
+    document["object"] = "https://example.com/@test@example.com/posts/2/"
+    tampered = client.post(
+        "https://example.com/inbox/",
+        data=document,
+        content_type=signed.headers["content-type"],
+        HTTP_HOST="example.com",
+        HTTP_DATE=signed.headers["date"],
+        HTTP_DIGEST=signed.headers["digest"],
+        HTTP_SIGNATURE=signed.headers["signature"],
+    )
+    assert tampered.status_code == 202
+    assert InboxMessage.objects.count() == num_inbox_messages + 2
+
+
+@pytest.mark.django_db
+def test_inbox_fast_accept(
+    client, settings, monkeypatch, httpx_mock: HTTPXMock, remote_identity, keypair
+):
+    """
+    Tests that with fast accept on, a delivery from an actor whose key we've
+    verified is stored as delivered, and checked later by Stator.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_FAST_ACCEPT", True)
+    monkeypatch.setattr(settings.SETUP, "INBOX_REPLAY_WINDOW", 0)
+    activitypub.actor_key_cache.clear()
+    Domain.blocked_domains.cache_clear()
+    remote_identity.public_key = keypair["public_key"]
+    remote_identity.public_key_id = keypair["public_key_id"]
+    remote_identity.save()
+
+    def deliver(number):
+        document = {
+            "@context": "https://www.w3.org/ns/activitystreams",
+            "id": f"https://remote.test/test-actor/moves/{number}",
+            "type": "Move",
+            "actor": remote_identity.actor_uri,
+            "object": remote_identity.actor_uri,
+        }
+        httpx_mock.add_response()
+        HttpSignature.signed_request(
+            uri="https://example.com/inbox/",
+            body=document,
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+        request = httpx_mock.get_requests()[-1]
+        return client.post(
+            "https://example.com/inbox/",
+            data=request.content,
+            content_type=request.headers["content-type"],
+            HTTP_HOST="example.com",
+            HTTP_DATE=request.headers["date"],
+            HTTP_DIGEST=request.headers["digest"],
+            HTTP_SIGNATURE=request.headers["signature"],
+        )
+
+    # The first one gets the full checks, and then we know their key
+    assert deliver(1).status_code == 202
+    assert not InboxMessage.objects.get().raw
+    assert deliver(2).status_code == 202
+    message = InboxMessage.objects.get(raw=True)
+    assert message.message["id"] == "https://remote.test/test-actor/moves/2"
+    assert InboxMessageStates.handle_received(message) == InboxMessageStates.processed
+    # The canonicalised message is saved, along with what it was classified as
+    message.refresh_from_db()
+    assert not message.raw
+    assert message.message_type == "move"
+    assert message.actor_domain == "remote.test"
+
+    # Blocked domains are dropped without a lookup, and if they get blocked
+    # after we take the message, Stator drops it instead
+    assert deliver(3).status_code == 202
+    remote_identity.domain.blocked = True
+    remote_identity.domain.save()
+    message = InboxMessage.objects.get(raw=True, message__id__endswith="/3")
+    assert not message.check_raw()
+    Domain.blocked_domains.cache_clear()
+    assert deliver(4).status_code == 202
+    assert InboxMessage.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_inbox_duplicate(
+    client, settings, httpx_mock: HTTPXMock, remote_identity, keypair
+):
+    """
+    Tests that a separately signed copy of an activity we've accepted (like
+    one sent to another inbox here) is dropped.
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    remote_identity.public_key = keypair["public_key"]
+    remote_identity.public_key_id = keypair["public_key_id"]
+    remote_identity.save()
+    document = {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://remote.test/test-actor/moves/1",
+        "type": "Move",
+        "actor": remote_identity.actor_uri,
+        "object": remote_identity.actor_uri,
+    }
+
+    def deliver(inbox):
+        httpx_mock.add_response()
+        HttpSignature.signed_request(
+            uri=f"https://example.com{inbox}",
+            body=document,
+            private_key=keypair["private_key"],
+            key_id=keypair["public_key_id"],
+        )
+        request = httpx_mock.get_requests()[-1]
+        return client.post(
+            inbox,
+            data=request.content,
+            content_type=request.headers["content-type"],
+            HTTP_HOST="example.com",
+            HTTP_DATE=request.headers["date"],
+            HTTP_DIGEST=request.headers["digest"],
+            HTTP_SIGNATURE=request.headers["signature"],
+        )
+
+    assert deliver("/inbox/").status_code == 202
+    assert deliver("/@test@example.com/inbox/").status_code == 202
+    assert InboxMessage.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_inbox_rate_limit(client, settings, monkeypatch, remote_identity):
+    """
+    Tests that deliveries from an address over its rate are queued for
+    later, and then turned away once they'd be too far off.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_RATE", 1)
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_BURST", 1)
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_MAX_DELAY", 1)
+    monkeypatch.setattr(activitypub, "_inbox_rate_limiter", None)
+
+    def deliver(number):
+        return client.post(
+            "/inbox/",
+            data={
+                "@context": "https://www.w3.org/ns/activitystreams",
+                "id": f"https://remote.test/test-actor/moves/{number}",
+                "type": "Move",
+                "actor": remote_identity.actor_uri,
+                "object": remote_identity.actor_uri,
+            },
+            content_type="application/activity+json",
+            HTTP_HOST="example.com",
+        )
+
+    assert deliver(1).status_code == 202
+    assert deliver(2).status_code == 202
+    response = deliver(3)
+    assert response.status_code == 429
+    assert response["Retry-After"] == "1"
+    first, second = InboxMessage.objects.order_by("pk")
+    assert first.actor_domain == second.actor_domain == "remote.test"
+    assert first.state_next_attempt is None
+    assert second.state_next_attempt > first.created
+
+
+@pytest.mark.django_db
+def test_inbox_rate_limit_forged(
+    client, settings, monkeypatch, httpx_mock: HTTPXMock, remote_identity, keypair
+):
+    """
+    Tests that deliveries claiming to be from a server, but not signed by it,
+    don't use up that server's rate limit.
+    """
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_RATE", 1)
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_BURST", 1)
+    monkeypatch.setattr(settings.SETUP, "INBOX_DOMAIN_MAX_DELAY", 1)
+    monkeypatch.setattr(settings.SETUP, "INBOX_REPLAY_WINDOW", 0)
+    monkeypatch.setattr(activitypub, "_inbox_rate_limiter", None)
+    remote_identity.public_key = keypair["public_key"]
+    remote_identity.public_key_id = keypair["public_key_id"]
+    remote_identity.save()
+
+    def document(number):
+        return {
+            "@context": "https://www.w3.org/ns/activitystreams",
+            "id": f"https://remote.test/test-actor/moves/{number}",
+            "type": "Move",
+            "actor": remote_identity.actor_uri,
+            "object": remote_identity.actor_uri,
+        }
+
+    # Someone else sends unsigned deliveries in remote.test's name until
+    # they're turned away
+    statuses = [
+        client.post(
+            "/inbox/",
+            data=document(number),
+            content_type="application/activity+json",
+            HTTP_HOST="example.com",
+            REMOTE_ADDR="192.0.2.1",
+        ).status_code
+        for number in range(3)
+    ]
+    assert statuses == [202, 202, 429]
+
+    # The real remote.test still has its whole budget
+    httpx_mock.add_response()
+    HttpSignature.signed_request(
+        uri="https://example.com/inbox/",
+        body=document(3),
+        private_key=keypair["private_key"],
+        key_id=keypair["public_key_id"],
+    )
+    request = httpx_mock.get_requests()[-1]
+    response = client.post(
+        "https://example.com/inbox/",
+        data=request.content,
+        content_type=request.headers["content-type"],
+        HTTP_HOST="example.com",
+        HTTP_DATE=request.headers["date"],
+        HTTP_DIGEST=request.headers["digest"],
+        HTTP_SIGNATURE=request.headers["signature"],
+        REMOTE_ADDR="198.51.100.1",
+    )
+    assert response.status_code == 202
+    real = InboxMessage.objects.get(message__id__endswith="/3")
+    assert real.state_next_attempt is None
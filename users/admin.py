@@ -193,7 +193,7 @@ class InboxMessageAdmin(admin.ModelAdmin):
         "message_type_full",
         "message_actor",
     ]
-    list_filter = ("state",)
+    list_filter = ("state", "message_type", "priority")
     search_fields = ["message"]
     actions = ["reset_state"]
     readonly_fields = ["state_changed"]
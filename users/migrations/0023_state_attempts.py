@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-16 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0022_follow_request"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="block",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="follow",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="identity",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="passwordreset",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="report",
+            name="state_attempts",
+            field=models.IntegerField(default=0),
+        ),
+    ]
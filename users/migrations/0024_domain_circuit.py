@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0023_state_attempts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="domain",
+            name="circuit_failures",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="circuit_last_success",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="circuit_next_probe",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="circuit_opened",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="circuit_state",
+            field=models.CharField(
+                choices=[
+                    ("closed", "Closed"),
+                    ("open", "Open"),
+                    ("half_open", "Half Open"),
+                ],
+                default="closed",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0024_domain_circuit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="raw",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0025_inboxmessage_raw"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="actor_domain",
+            field=models.CharField(blank=True, max_length=250, null=True),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="created",
+            field=models.DateTimeField(
+                auto_now_add=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name="inboxmessage",
+            index=models.Index(
+                fields=["actor_domain", "created"],
+                name="users_inbox_actor_d_1e8daf_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:40
+
+from django.db import migrations, models
+
+# Classifies messages that are still waiting to be processed, as
+# InboxMessage.classify would (the rest don't need it)
+CLASSIFY_RECEIVED = """
+UPDATE users_inboxmessage SET
+    message_type = lower(message->>'type'),
+    message_object_type = CASE
+        WHEN jsonb_typeof(message->'object') = 'object'
+        THEN lower(message->'object'->>'type')
+    END,
+    message_object_has_content = COALESCE(
+        jsonb_typeof(message->'object') = 'object' AND (
+            jsonb_exists(message->'object', 'content')
+            OR jsonb_exists(message->'object', 'contentMap')
+        ),
+        false
+    ),
+    message_object_uri = CASE jsonb_typeof(message->'object')
+        WHEN 'string' THEN message->>'object'
+        WHEN 'object' THEN message->'object'->>'id'
+    END,
+    actor_domain = lower(
+        substring(message->>'actor' from '^[^:/]+://(?:[^@/]*@)?([^/:?#]+)')
+    ),
+    priority = CASE lower(message->>'type')
+        WHEN 'follow' THEN 0
+        WHEN 'accept' THEN 0
+        WHEN 'reject' THEN 0
+        WHEN 'block' THEN 0
+        WHEN 'flag' THEN 0
+        WHEN 'like' THEN 2
+        WHEN 'announce' THEN 2
+        WHEN 'http://litepub.social/ns#emojireact' THEN 2
+        ELSE 1
+    END
+WHERE state = 'received'
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0026_inboxmessage_actor_domain"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="message_object_has_content",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="message_object_type",
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="message_object_uri",
+            field=models.CharField(blank=True, max_length=2048, null=True),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="message_type",
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name="inboxmessage",
+            name="priority",
+            field=models.SmallIntegerField(default=1),
+        ),
+        migrations.RunSQL(CLASSIFY_RECEIVED, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name="inboxmessage",
+            index=models.Index(
+                fields=["message_type", "message_object_type"],
+                name="users_inbox_message_a0015b_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="inboxmessage",
+            index=models.Index(
+                fields=["message_object_uri"], name="users_inbox_message_2ebf6a_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="inboxmessage",
+            index=models.Index(
+                condition=models.Q(("state", "received")),
+                fields=["priority", "id"],
+                name="users_inboxmessage_claim",
+            ),
+        ),
+    ]
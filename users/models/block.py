@@ -102,6 +102,7 @@ class Block(StatorModel):
     """
 
     state = StateField(BlockStates)
+    stator_lane = StatorModel.LANE_INTERACTIVE
 
     source = models.ForeignKey(
         "users.Identity",
@@ -1,17 +1,21 @@
+import datetime
 import json
 import logging
 import re
 import ssl
+import threading
 from functools import cached_property
 from typing import Optional
 
 import httpx
 import pydantic
 import urlman
-from django.conf import settings
+from cachetools import TTLCache, cached
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
+from core.http import get_client
 from core.models import Config
 from stator.models import State, StateField, StateGraph, StatorModel
 from users.schemas import NodeInfo
@@ -81,6 +85,22 @@ class Domain(StatorModel):
     display domains for now, until we start doing better probing.
     """
 
+    class CircuitStates(models.TextChoices):
+        closed = "closed"  # Working normally
+        open = "open"  # Down; waiting until circuit_next_probe to try again
+        half_open = "half_open"  # One request is checking if it's back
+
+    # After this many connection failures in a row, we stop talking to a
+    # server for CIRCUIT_OPEN_MINIMUM seconds, doubling each time it fails
+    # again up to CIRCUIT_OPEN_MAXIMUM
+    CIRCUIT_FAILURE_THRESHOLD = 3
+    CIRCUIT_OPEN_MINIMUM = 60
+    CIRCUIT_OPEN_MAXIMUM = 3600
+    # How long a half-open probe gets before someone else can try one
+    CIRCUIT_PROBE_TIMEOUT = 60
+    # Once it's been down this long, we give up on deliveries to it
+    CIRCUIT_DEAD_AFTER = 86400 * 3
+
     domain = models.CharField(
         max_length=250, primary_key=True, validators=[_domain_validator]
     )
@@ -93,6 +113,7 @@ class Domain(StatorModel):
     )
 
     state = StateField(DomainStates)
+    stator_lane = StatorModel.LANE_BULK
 
     # nodeinfo 2.0 detail about the remote server
     nodeinfo = models.JSONField(null=True, blank=True)
@@ -117,6 +138,17 @@ class Domain(StatorModel):
     # Free-form notes field for admins
     notes = models.TextField(blank=True, null=True)
 
+    # Circuit breaker for talking to this server (see circuit_retry_after)
+    circuit_state = models.CharField(
+        max_length=20,
+        choices=CircuitStates.choices,
+        default=CircuitStates.closed,
+    )
+    circuit_failures = models.IntegerField(default=0)
+    circuit_opened = models.DateTimeField(blank=True, null=True)
+    circuit_next_probe = models.DateTimeField(blank=True, null=True)
+    circuit_last_success = models.DateTimeField(blank=True, null=True)
+
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -196,71 +228,68 @@ class Domain(StatorModel):
         """
         nodeinfo20_url = f"https://{self.domain}/nodeinfo/2.0"
 
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
+        client = get_client()
+        try:
+            response = client.get(
+                f"https://{self.domain}/.well-known/nodeinfo",
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+        except httpx.HTTPError:
+            pass
+        except (ssl.SSLCertVerificationError, ssl.SSLError):
+            return None
+        else:
             try:
-                response = client.get(
-                    f"https://{self.domain}/.well-known/nodeinfo",
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
-                )
-            except httpx.HTTPError:
+                for link in response.json().get("links", []):
+                    if (
+                        link.get("rel")
+                        == "http://nodeinfo.diaspora.software/ns/schema/2.0"
+                    ):
+                        nodeinfo20_url = link.get("href", nodeinfo20_url)
+                        break
+            except json.JSONDecodeError:
                 pass
-            except (ssl.SSLCertVerificationError, ssl.SSLError):
-                return None
-            else:
-                try:
-                    for link in response.json().get("links", []):
-                        if (
-                            link.get("rel")
-                            == "http://nodeinfo.diaspora.software/ns/schema/2.0"
-                        ):
-                            nodeinfo20_url = link.get("href", nodeinfo20_url)
-                            break
-                except json.JSONDecodeError:
-                    pass
 
-            try:
-                response = client.get(
-                    nodeinfo20_url,
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
-                )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [401, 403, 404, 406, 410]
-                ):
-                    logger.warning(
-                        "Client error fetching nodeinfo: %d %s %s",
-                        response.status_code,
-                        nodeinfo20_url,
-                        ex,
-                        extra={
-                            "content": response.content,
-                            "domain": self.domain,
-                        },
-                    )
-                return None
-
-            try:
-                info = NodeInfo(**response.json())
-            except (json.JSONDecodeError, pydantic.ValidationError) as ex:
+        try:
+            response = client.get(
+                nodeinfo20_url,
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            response = getattr(ex, "response", None)
+            if (
+                response
+                and response.status_code < 500
+                and response.status_code not in [401, 403, 404, 406, 410]
+            ):
                 logger.warning(
-                    "Client error decoding nodeinfo: %s %s",
+                    "Client error fetching nodeinfo: %d %s %s",
+                    response.status_code,
                     nodeinfo20_url,
                     ex,
                     extra={
+                        "content": response.content,
                         "domain": self.domain,
                     },
                 )
-                return None
-            return info
+            return None
+
+        try:
+            info = NodeInfo(**response.json())
+        except (json.JSONDecodeError, pydantic.ValidationError) as ex:
+            logger.warning(
+                "Client error decoding nodeinfo: %s %s",
+                nodeinfo20_url,
+                ex,
+                extra={
+                    "domain": self.domain,
+                },
+            )
+            return None
+        return info
 
     @property
     def software(self):
@@ -289,6 +318,137 @@ class Domain(StatorModel):
         # See if any of those are blocked
         return Domain.objects.filter(domain__in=domain_parts, blocked=True).exists()
 
+    @classmethod
+    @cached(cache=TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
+    def blocked_domains(cls) -> frozenset[str]:
+        """
+        Returns the names of all blocked domains, as of up to a minute ago.
+        """
+        return frozenset(
+            cls.objects.filter(blocked=True).values_list("domain", flat=True)
+        )
+
+    @classmethod
+    def hostname_blocked(cls, hostname: str) -> bool:
+        """
+        Like recursively_blocked, but for a bare hostname and against the
+        in-memory blocklist, so it doesn't need the database.
+        """
+        blocked = cls.blocked_domains()
+        hostname = hostname.lower()
+        while True:
+            if hostname in blocked:
+                return True
+            if "." not in hostname:
+                return False
+            hostname = hostname.split(".", 1)[1]
+
+    ### Circuit breaker ###
+
+    def circuit_retry_after(self) -> float:
+        """
+        Returns how many seconds to wait before talking to this server, or 0
+        if we can go ahead now.
+
+        Once an open circuit's probe time comes round, the first caller
+        claims the probe (the circuit goes half-open) and is let through;
+        everyone else waits to see how that goes.
+        """
+        if self.circuit_state == self.CircuitStates.closed:
+            return 0
+        now = timezone.now()
+        if self.circuit_next_probe is None or self.circuit_next_probe <= now:
+            next_probe = now + datetime.timedelta(seconds=self.CIRCUIT_PROBE_TIMEOUT)
+            claimed = (
+                Domain.objects.filter(pk=self.pk, circuit_state=self.circuit_state)
+                .filter(
+                    models.Q(circuit_next_probe__isnull=True)
+                    | models.Q(circuit_next_probe__lte=now)
+                )
+                .update(
+                    circuit_state=self.CircuitStates.half_open,
+                    circuit_next_probe=next_probe,
+                )
+            )
+            self.circuit_state = self.CircuitStates.half_open
+            self.circuit_next_probe = next_probe
+            if claimed:
+                return 0
+        return max((self.circuit_next_probe - now).total_seconds(), 1)
+
+    @property
+    def circuit_dead(self) -> bool:
+        """
+        If the server has been unreachable for so long that there's no point
+        queueing anything else for it.
+        """
+        return (
+            self.circuit_state != self.CircuitStates.closed
+            and self.circuit_opened is not None
+            and (timezone.now() - self.circuit_opened).total_seconds()
+            >= self.CIRCUIT_DEAD_AFTER
+        )
+
+    def circuit_record_success(self):
+        """
+        Records that the server answered us (with anything at all).
+        """
+        now = timezone.now()
+        # Only write to the database when something's changed, or every
+        # minute to keep circuit_last_success roughly right
+        if (
+            self.circuit_state == self.CircuitStates.closed
+            and not self.circuit_failures
+            and self.circuit_last_success
+            and (now - self.circuit_last_success).total_seconds() < 60
+        ):
+            return
+        self.circuit_state = self.CircuitStates.closed
+        self.circuit_failures = 0
+        self.circuit_opened = None
+        self.circuit_next_probe = None
+        self.circuit_last_success = now
+        Domain.objects.filter(pk=self.pk).update(
+            circuit_state=self.circuit_state,
+            circuit_failures=0,
+            circuit_opened=None,
+            circuit_next_probe=None,
+            circuit_last_success=now,
+        )
+
+    def circuit_record_failure(self):
+        """
+        Records that we couldn't connect to the server (or it timed out), and
+        opens the circuit if that's happened enough times in a row.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            current = (
+                Domain.objects.select_for_update()
+                .filter(pk=self.pk)
+                .values("circuit_failures", "circuit_opened")
+                .first()
+            )
+            if current is None:
+                return
+            self.circuit_failures = current["circuit_failures"] + 1
+            self.circuit_opened = current["circuit_opened"]
+            overage = self.circuit_failures - self.CIRCUIT_FAILURE_THRESHOLD
+            if overage >= 0:
+                pause = min(
+                    self.CIRCUIT_OPEN_MINIMUM * 2 ** min(overage, 32),
+                    self.CIRCUIT_OPEN_MAXIMUM,
+                )
+                self.circuit_state = self.CircuitStates.open
+                self.circuit_opened = self.circuit_opened or now
+                self.circuit_next_probe = now + datetime.timedelta(seconds=pause)
+            Domain.objects.filter(pk=self.pk).update(
+                circuit_state=self.circuit_state,
+                circuit_failures=self.circuit_failures,
+                circuit_opened=self.circuit_opened,
+                circuit_next_probe=self.circuit_next_probe,
+            )
+
     ### Config ###
 
     @cached_property
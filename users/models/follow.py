@@ -197,6 +197,7 @@ class Follow(StatorModel):
     note = models.TextField(blank=True, null=True)
 
     state = StateField(FollowStates)
+    stator_lane = StatorModel.LANE_INTERACTIVE
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -6,7 +6,6 @@ from urllib.parse import urlparse
 
 import httpx
 import urlman
-from django.conf import settings
 from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from django.utils.functional import lazy
@@ -14,6 +13,7 @@ from lxml import etree
 
 from core.exceptions import ActorMismatchError
 from core.html import ContentRenderer, FediverseHtmlParser
+from core.http import get_client
 from core.json import json_from_response
 from core.ld import (
     canonicalise,
@@ -732,29 +732,26 @@ class Identity(StatorModel):
         Given a domain (hostname), returns the correct webfinger URL to use
         based on probing host-meta.
         """
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
-            try:
-                response = client.get(
-                    f"https://{domain}/.well-known/host-meta",
-                    follow_redirects=True,
-                    headers={"Accept": "application/xml"},
-                )
+        client = get_client()
+        try:
+            response = client.get(
+                f"https://{domain}/.well-known/host-meta",
+                follow_redirects=True,
+                headers={"Accept": "application/xml"},
+            )
 
-                # In the case of anything other than a success, we'll still try
-                # hitting the webfinger URL on the domain we were given to handle
-                # incorrectly setup servers.
-                if response.status_code == 200 and response.content.strip():
-                    tree = etree.fromstring(response.content)
-                    template = tree.xpath(
-                        "string(.//*[local-name() = 'Link' and @rel='lrdd' and (not(@type) or @type='application/jrd+json')]/@template)"
-                    )
-                    if template:
-                        return template
-            except (httpx.RequestError, etree.ParseError):
-                pass
+            # In the case of anything other than a success, we'll still try
+            # hitting the webfinger URL on the domain we were given to handle
+            # incorrectly setup servers.
+            if response.status_code == 200 and response.content.strip():
+                tree = etree.fromstring(response.content)
+                template = tree.xpath(
+                    "string(.//*[local-name() = 'Link' and @rel='lrdd' and (not(@type) or @type='application/jrd+json')]/@template)"
+                )
+                if template:
+                    return template
+        except (httpx.RequestError, etree.ParseError):
+            pass
 
         return f"https://{domain}/.well-known/webfinger?resource={{uri}}"
 
@@ -771,33 +768,30 @@ class Identity(StatorModel):
             return None, None
 
         # Go make a Webfinger request
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
-            try:
-                response = client.get(
-                    webfinger_url.format(uri=f"acct:{handle}"),
-                    follow_redirects=True,
-                    headers={"Accept": "application/json"},
+        client = get_client()
+        try:
+            response = client.get(
+                webfinger_url.format(uri=f"acct:{handle}"),
+                follow_redirects=True,
+                headers={"Accept": "application/json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            response = getattr(ex, "response", None)
+            if isinstance(ex, httpx.TimeoutException) or (
+                response and response.status_code in [408, 429, 504]
+            ):
+                raise TryAgainLater() from ex
+            elif (
+                response
+                and response.status_code < 500
+                and response.status_code not in [400, 401, 403, 404, 406, 410]
+            ):
+                raise ValueError(
+                    f"Client error fetching webfinger: {response.status_code}",
+                    response.content,
                 )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if isinstance(ex, httpx.TimeoutException) or (
-                    response and response.status_code in [408, 429, 504]
-                ):
-                    raise TryAgainLater() from ex
-                elif (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [400, 401, 403, 404, 406, 410]
-                ):
-                    raise ValueError(
-                        f"Client error fetching webfinger: {response.status_code}",
-                        response.content,
-                    )
-                return None, None
+            return None, None
 
         try:
             data = response.json()
@@ -828,33 +822,30 @@ class Identity(StatorModel):
         """
         Fetch an identity's featured collection.
         """
-        with httpx.Client(
-            timeout=settings.SETUP.REMOTE_TIMEOUT,
-            headers={"User-Agent": settings.TAKAHE_USER_AGENT},
-        ) as client:
-            try:
-                response = client.get(
-                    uri,
-                    follow_redirects=True,
-                    headers={"Accept": "application/activity+json"},
+        client = get_client()
+        try:
+            response = client.get(
+                uri,
+                follow_redirects=True,
+                headers={"Accept": "application/activity+json"},
+            )
+            response.raise_for_status()
+        except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
+            response = getattr(ex, "response", None)
+            if isinstance(ex, httpx.TimeoutException) or (
+                response and response.status_code in [408, 429, 504]
+            ):
+                raise TryAgainLater() from ex
+            elif (
+                response
+                and response.status_code < 500
+                and response.status_code not in [401, 403, 404, 406, 410]
+            ):
+                raise ValueError(
+                    f"Client error fetching featured collection: {response.status_code}",
+                    response.content,
                 )
-                response.raise_for_status()
-            except (httpx.HTTPError, ssl.SSLCertVerificationError) as ex:
-                response = getattr(ex, "response", None)
-                if isinstance(ex, httpx.TimeoutException) or (
-                    response and response.status_code in [408, 429, 504]
-                ):
-                    raise TryAgainLater() from ex
-                elif (
-                    response
-                    and response.status_code < 500
-                    and response.status_code not in [401, 403, 404, 406, 410]
-                ):
-                    raise ValueError(
-                        f"Client error fetching featured collection: {response.status_code}",
-                        response.content,
-                    )
-                return []
+            return []
 
         try:
             data = canonicalise(response.json(), include_security=True)
@@ -892,15 +883,27 @@ class Identity(StatorModel):
 
         if self.local:
             raise ValueError("Cannot fetch local identities")
+        # Don't wait on servers that are down (see Domain.circuit_retry_after)
+        domain = self.domain if self.domain_id else None
+        if domain and (retry_after := domain.circuit_retry_after()):
+            raise TryAgainLater(retry_after=retry_after)
         try:
             response = SystemActor().signed_request(
                 method="get",
                 uri=self.actor_uri,
             )
         except httpx.TimeoutException:
+            if domain:
+                domain.circuit_record_failure()
             raise TryAgainLater()
-        except (httpx.RequestError, ssl.SSLCertVerificationError):
+        except httpx.RequestError:
+            if domain:
+                domain.circuit_record_failure()
+            return False
+        except ssl.SSLCertVerificationError:
             return False
+        if domain:
+            domain.circuit_record_success()
         content_type = response.headers.get("content-type")
         if content_type and "html" in content_type:
             # Some servers don't properly handle "application/activity+json"
@@ -1144,7 +1147,7 @@ class Identity(StatorModel):
         self,
         method: Literal["get", "post"],
         uri: str,
-        body: dict | None = None,
+        body: dict | bytes | None = None,
     ):
         """
         Performs a signed request on behalf of the System Actor.
@@ -1157,9 +1160,28 @@ class Identity(StatorModel):
             key_id=self.public_key_id,
         )
 
+    async def asigned_request(
+        self,
+        method: Literal["get", "post"],
+        uri: str,
+        body: dict | bytes | None = None,
+    ):
+        """
+        Async version of signed_request.
+        """
+        return await HttpSignature.asigned_request(
+            method=method,
+            uri=uri,
+            body=body,
+            private_key=self.private_key,
+            key_id=self.public_key_id,
+        )
+
     def generate_keypair(self):
         if not self.local:
             raise ValueError("Cannot generate keypair for remote user")
+        if self.public_key_id:
+            RsaKeys.forget_private_keys(self.public_key_id)
         self.private_key, self.public_key = RsaKeys.generate_keypair()
         self.public_key_id = self.actor_uri + "#main-key"
         self.save()
@@ -1,12 +1,31 @@
-from django.db import models
+import datetime
+import hashlib
+import logging
+import os
+from urllib.parse import urldefrag, urlparse
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
 from pyld.jsonld import JsonLdError
 
+from core.batching import GroupCommitBuffer
 from core.exceptions import ActivityPubError
+from core.ld import canonicalise, get_str_or_id
+from core.signatures import LDSignature, VerificationError, VerificationFormatError
 from stator.models import State, StateField, StateGraph, StatorModel
 
+logger = logging.getLogger(__name__)
+
 
 class InboxMessageStates(StateGraph):
-    received = State(try_interval=300, delete_after=86400 * 3)
+    received = State(
+        try_interval=300,
+        delete_after=86400 * 3,
+        backoff_factor=2,
+        backoff_max=3600,
+        backoff_jitter=0.2,
+    )
     processed = State(externally_progressed=True, delete_after=86400)
     errored = State(externally_progressed=True, delete_after=86400)
 
@@ -19,7 +38,22 @@ class InboxMessageStates(StateGraph):
         from users.models import Block, Follow, Identity, Report
         from users.services import IdentityService
 
+        # Drop any types we've been told to, before doing anything else
+        skip_types = settings.SETUP.INBOX_SKIP_TYPES
+        if skip_types and (
+            instance.message_type in skip_types
+            or instance.message_type_full in skip_types
+        ):
+            return cls.processed
         try:
+            # Messages the inbox accepted in a hurry still need checking
+            if instance.raw and not instance.check_raw():
+                return cls.processed
+            # Don't do things that are undone by something else in the queue,
+            # and don't leave things in the queue that this undoes
+            if instance.undone_in_queue():
+                return cls.processed
+            instance.undo_in_queue()
             match instance.message_type:
                 case "follow":
                     Follow.handle_request_ap(instance.message)
@@ -167,8 +201,225 @@ class InboxMessage(StatorModel):
     """
 
     message = models.JSONField()
+    # If the message is as it was delivered, and has only been through the
+    # inbox's fast checks (see check_raw)
+    raw = models.BooleanField(default=False)
+
+    # What the message is, pulled out of it when it's saved (see classify)
+    message_type = models.CharField(max_length=100, blank=True, null=True)
+    message_object_type = models.CharField(max_length=100, blank=True, null=True)
+    message_object_has_content = models.BooleanField(default=False)
+    message_object_uri = models.CharField(max_length=2048, blank=True, null=True)
+
+    # The hostname of the actor that sent it, for per-server stats
+    actor_domain = models.CharField(max_length=250, blank=True, null=True)
+
+    # Lower numbers are processed first (see PRIORITIES)
+    priority = models.SmallIntegerField(default=1)
+
+    created = models.DateTimeField(auto_now_add=True)
 
     state = StateField(InboxMessageStates)
+    stator_lane = StatorModel.LANE_INTERACTIVE
+    stator_weight = 2
+    stator_claim_order = ["priority", "pk"]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["actor_domain", "created"]),
+            models.Index(fields=["message_type", "message_object_type"]),
+            models.Index(fields=["message_object_uri"]),
+            models.Index(
+                fields=["priority", "id"],
+                condition=models.Q(state="received"),
+                name="users_inboxmessage_claim",
+            ),
+        ]
+
+    # How soon each type of message gets processed, if there's a queue;
+    # relationships first, then content, then reactions to it
+    PRIORITIES = {
+        "follow": 0,
+        "accept": 0,
+        "reject": 0,
+        "block": 0,
+        "flag": 0,
+        "like": 2,
+        "announce": 2,
+        "http://litepub.social/ns#emojireact": 2,
+    }
+
+    # Announces of these we can't do anything with (Lemmy sends them to
+    # pass on likes and other activities in communities), so aren't kept
+    IGNORED_ANNOUNCE_TYPES = ["Like", "Dislike", "Create", "Undo", "Update"]
+
+    # Which activity types undo which others (that is, a Delete or Undo
+    # whose object is their ID - or for Creates, their object's ID)
+    UNDONE_BY = {"create": "delete", "like": "undo", "announce": "undo"}
+
+    @classmethod
+    def create_batched(cls, message: dict, raw: bool = False, delay: float = 0):
+        """
+        Saves a message from the inbox, sharing the INSERT (and commit) with
+        any other threads in this process saving one at the same time if
+        INBOX_GROUP_COMMIT is on. Returns once it's committed.
+
+        If `delay` is given, it won't be processed until that many seconds
+        from now (see Inbox.post).
+        """
+        instance = cls(
+            message=message,
+            raw=raw,
+            state_next_attempt=(
+                timezone.now() + datetime.timedelta(seconds=delay) if delay else None
+            ),
+        )
+        if connection.in_atomic_block:
+            # It wouldn't be committed when we return, so there's no point
+            instance.save()
+        elif settings.SETUP.INBOX_GROUP_COMMIT:
+            inbox_buffer.add(instance)
+        else:
+            cls.bulk_insert([instance])
+
+    @classmethod
+    def bulk_insert(cls, instances: list["InboxMessage"]):
+        """
+        Saves a batch of messages in one INSERT and transaction, leaving out
+        any copies of the same activity.
+        """
+        seen = set()
+        unique = []
+        for instance in instances:
+            key = cls.duplicate_key(instance.message)
+            if key is None or key not in seen:
+                seen.add(key)
+                instance.classify()
+                unique.append(instance)
+        with transaction.atomic():
+            cls.objects.bulk_create(unique)
+            cls.transition_notify()
+
+    @classmethod
+    def actor_domain_of(cls, message: dict) -> str | None:
+        """
+        Returns the lowercased hostname of the message's actor, if it has one.
+        """
+        if not isinstance(message, dict):
+            return None
+        actor = get_str_or_id(message.get("actor"))
+        if not isinstance(actor, str):
+            return None
+        try:
+            hostname = urlparse(actor).hostname
+        except ValueError:
+            return None
+        return hostname[:250] if hostname else None
+
+    @classmethod
+    def duplicate_key(cls, message: dict) -> str | None:
+        """
+        Returns a key that's the same for every copy of an activity (by its
+        actor and ID), if it has an ID.
+        """
+        if not isinstance(message, dict):
+            return None
+        actor = message.get("actor")
+        activity_id = message.get("id")
+        if not isinstance(actor, str) or not isinstance(activity_id, str):
+            return None
+        digest = hashlib.sha256(f"{actor} {activity_id}".encode("utf8"))
+        return f"inbox_activity:{digest.hexdigest()}"
+
+    def save(self, *args, **kwargs):
+        self.classify()
+        super().save(*args, **kwargs)
+
+    def classify(self):
+        """
+        Fills in the fields describing the message from its contents, so we
+        can dispatch and filter on them without reading the JSON.
+        """
+        message = self.message if isinstance(self.message, dict) else {}
+        message_type = message.get("type")
+        object = message.get("object")
+        object_type = object.get("type") if isinstance(object, dict) else None
+        object_uri = get_str_or_id(object)
+        self.message_type = (
+            message_type.lower()[:100] if isinstance(message_type, str) else None
+        )
+        self.message_object_type = (
+            object_type.lower()[:100] if isinstance(object_type, str) else None
+        )
+        self.message_object_has_content = isinstance(object, dict) and (
+            "content" in object or "contentMap" in object
+        )
+        self.message_object_uri = (
+            object_uri[:2048] if isinstance(object_uri, str) else None
+        )
+        self.actor_domain = self.actor_domain_of(message)
+        self.priority = self.PRIORITIES.get(self.message_type or "", 1)
+
+    @property
+    def undo_target(self) -> str | None:
+        """
+        The ID a Delete or Undo of this message would have as its object.
+        """
+        match self.message_type:
+            case "create":
+                return self.message_object_uri
+            case "like" | "announce":
+                return get_str_or_id(self.message)
+        return None
+
+    def queued_with_actor(self) -> models.QuerySet:
+        """
+        Returns other messages from the same actor that are waiting to be
+        processed.
+        """
+        return InboxMessage.objects.filter(
+            state=InboxMessageStates.received,
+            actor_domain=self.actor_domain,
+            message__actor=self.message.get("actor"),
+        ).exclude(pk=self.pk)
+
+    def undone_in_queue(self) -> bool:
+        """
+        Returns if this message is undone by another that's also waiting to
+        be processed, and so there's no point processing it.
+        """
+        target = self.undo_target
+        if not target:
+            return False
+        return (
+            self.queued_with_actor()
+            .filter(
+                message_type=self.UNDONE_BY[self.message_type],
+                message_object_uri=target,
+            )
+            .exists()
+        )
+
+    def undo_in_queue(self):
+        """
+        If this is a Delete or Undo, marks any messages it undoes that are
+        still waiting to be processed as processed.
+        """
+        target = self.message_object_uri
+        if not target:
+            return
+        match self.message_type:
+            case "delete":
+                undone = self.queued_with_actor().filter(
+                    message_type="create", message_object_uri=target
+                )
+            case "undo":
+                undone = self.queued_with_actor().filter(
+                    message_type__in=["like", "announce"], message__id=target
+                )
+            case _:
+                return
+        InboxMessage.transition_perform_queryset(undone, InboxMessageStates.processed)
 
     @classmethod
     def create_internal(cls, payload):
@@ -182,20 +433,98 @@ class InboxMessage(StatorModel):
             }
         )
 
-    @property
-    def message_type(self):
-        return self.message["type"].lower()
+    def check_raw(self) -> bool:
+        """
+        Canonicalises a message the inbox stored as it was delivered, and
+        runs the checks the inbox would otherwise have done before storing
+        it. Returns False if the message should be thrown away.
+        """
+        from users.models import Domain, Identity
 
-    @property
-    def message_object_type(self) -> str | None:
-        if isinstance(self.message["object"], dict):
-            return self.message["object"]["type"].lower()
-        else:
-            return None
+        document = canonicalise(self.message, include_security=True)
+        if "actor" not in document or document["type"].startswith("__"):
+            logger.warning("Inbox: Discarded raw message %s", self.pk)
+            return False
+        # See if it's from a blocked user or domain
+        identity = Identity.by_actor_uri(document["actor"], create=True, transient=True)
+        domain = identity.domain or Domain.get_remote_domain(
+            urlparse(document["actor"]).hostname
+        )
+        if identity.blocked or domain.recursively_blocked():
+            logger.info("Inbox: Discarded message from blocked %s", identity.actor_uri)
+            return False
+        # Ignore the same Announces as the inbox does
+        if document["type"] == "Announce" and isinstance(document.get("object"), dict):
+            if document["object"].get("type") in self.IGNORED_ANNOUNCE_TYPES:
+                return False
+        try:
+            self.check_ld_signature(document)
+        except VerificationFormatError as e:
+            logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
+            return False
+        self.message = document
+        self.raw = False
+        # Saving classifies it again, from the canonicalised message
+        self.save(
+            update_fields=[
+                "message",
+                "raw",
+                "message_type",
+                "message_object_type",
+                "message_object_has_content",
+                "message_object_uri",
+                "actor_domain",
+                "priority",
+            ]
+        )
+        return True
+
+    @classmethod
+    def check_ld_signature(cls, document: dict):
+        """
+        Verifies the document's LD signature, if it has one, and removes it
+        if it can't be verified. Raises VerificationFormatError if it's
+        malformed.
+
+        Mastodon advises not implementing LD Signatures, but they're widely
+        deployed today, so we validate them if they exist.
+        https://docs.joinmastodon.org/spec/security/#ld
+        """
+        from users.models import Identity
+
+        if "signature" not in document:
+            return
+        # signatures are identified by the signature block
+        creator = urldefrag(document["signature"]["creator"]).url
+        creator_identity = Identity.by_actor_uri(creator, create=True, transient=True)
+        if not creator_identity.public_key:
+            logger.info("Inbox: New actor, no key available: %s", creator)
+            # if we can't verify it, we don't keep it
+            document.pop("signature")
+            return
+        try:
+            LDSignature.verify_signature(document, creator_identity.public_key)
+            logger.debug(
+                "Inbox: %s from %s has good LD signature",
+                document["type"],
+                creator_identity,
+            )
+        except VerificationFormatError:
+            raise
+        except VerificationError:
+            # An invalid LD Signature might also indicate nothing but
+            # a syntactical difference between implementations.
+            # Strip it out if we can't verify it.
+            document.pop("signature", None)
+            logger.info(
+                "Inbox: Stripping invalid LD signature from %s %s",
+                creator_identity,
+                document["id"],
+            )
 
     @property
     def message_type_full(self):
-        if isinstance(self.message.get("object"), dict):
+        if self.message_object_type:
             return f"{self.message_type}.{self.message_object_type}"
         else:
             return f"{self.message_type}"
@@ -204,7 +533,11 @@ class InboxMessage(StatorModel):
     def message_actor(self):
         return self.message.get("actor")
 
-    @property
-    def message_object_has_content(self):
-        object = self.message.get("object", {})
-        return "content" in object or "contentMap" in object
+
+# Inbox deliveries being saved by this process's threads
+inbox_buffer: GroupCommitBuffer[InboxMessage] = GroupCommitBuffer(
+    InboxMessage.bulk_insert,
+    max_batch=settings.SETUP.INBOX_BATCH_SIZE,
+    max_wait=settings.SETUP.INBOX_BATCH_WAIT,
+)
+os.register_at_fork(after_in_child=inbox_buffer.reset)
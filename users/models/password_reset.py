@@ -74,6 +74,7 @@ class PasswordReset(StatorModel):
     """
 
     state = StateField(PasswordResetStates)
+    stator_lane = StatorModel.LANE_INTERACTIVE
 
     user = models.ForeignKey(
         "users.user",
@@ -27,6 +27,7 @@ class SystemActor:
         return self.profile_uri
 
     def generate_keys(self):
+        RsaKeys.forget_private_keys(self.public_key_id)
         self.private_key, self.public_key = RsaKeys.generate_keypair()
         Config.set_system("system_actor_private_key", self.private_key)
         Config.set_system("system_actor_public_key", self.public_key)
@@ -83,7 +84,7 @@ class SystemActor:
         self,
         method: Literal["get", "post"],
         uri: str,
-        body: dict | None = None,
+        body: dict | bytes | None = None,
     ):
         """
         Performs a signed request on behalf of the System Actor.
@@ -95,3 +96,20 @@ class SystemActor:
             private_key=self.private_key,
             key_id=self.public_key_id,
         )
+
+    async def asigned_request(
+        self,
+        method: Literal["get", "post"],
+        uri: str,
+        body: dict | bytes | None = None,
+    ):
+        """
+        Async version of signed_request.
+        """
+        return await HttpSignature.asigned_request(
+            method=method,
+            uri=uri,
+            body=body,
+            private_key=self.private_key,
+            key_id=self.public_key_id,
+        )
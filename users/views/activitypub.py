@@ -1,8 +1,13 @@
+import hashlib
 import json
 import logging
-from urllib.parse import urldefrag, urlparse
+import math
+import threading
+from urllib.parse import urlparse
 
+from cachetools import TTLCache
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_control
@@ -14,12 +19,8 @@ from activities.services import TimelineService
 from core.decorators import cache_page
 from core.ld import canonicalise
 from core.models import Config
-from core.signatures import (
-    HttpSignature,
-    LDSignature,
-    VerificationError,
-    VerificationFormatError,
-)
+from core.ratelimit import TokenBuckets
+from core.signatures import HttpSignature, VerificationError, VerificationFormatError
 from core.views import StaticContentView
 from takahe import __version__
 from users.models import Identity, InboxMessage, SystemActor
@@ -28,6 +29,27 @@ from users.shortcuts import by_handle_or_404
 
 logger = logging.getLogger(__name__)
 
+# The public keys of actors whose HTTP signatures we've recently verified, by
+# actor URI, for the inbox's fast path
+actor_key_cache: TTLCache = TTLCache(maxsize=10000, ttl=300)
+actor_key_cache_lock = threading.Lock()
+
+_inbox_rate_limiter: TokenBuckets | None = None
+
+
+def inbox_rate_limiter() -> TokenBuckets:
+    """
+    Returns this process's token buckets for inbox deliveries, by address
+    and by server.
+    """
+    global _inbox_rate_limiter
+    if _inbox_rate_limiter is None:
+        _inbox_rate_limiter = TokenBuckets(
+            rate=settings.SETUP.INBOX_DOMAIN_RATE,
+            burst=settings.SETUP.INBOX_DOMAIN_BURST,
+        )
+    return _inbox_rate_limiter
+
 
 class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
@@ -138,8 +160,35 @@ class Inbox(View):
         # Reject bodies that are unfeasibly big
         if len(request.body) > settings.JSONLD_MAX_SIZE:
             return HttpResponseBadRequest("Payload size too large")
+        # Drop exact copies of signed deliveries we've already accepted
+        replay_key = self.replay_key(request)
+        if replay_key and cache.get(replay_key):
+            logger.debug("Inbox: Dropped duplicate delivery")
+            return HttpResponse(status=202)
+        try:
+            document = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid JSON")
+        # Put off (or turn away) deliveries from anyone sending more than
+        # their share, so they can't crowd out everyone else. Until we've
+        # checked the signature, we only know where it came from, not which
+        # server sent it, so that's all it's charged to for now.
+        peer = self.peer_address(request)
+        delay = self.rate_limit_delay(f"peer:{peer}")
+        if delay > settings.SETUP.INBOX_DOMAIN_MAX_DELAY:
+            return self.too_many_deliveries(delay, peer)
+        # Take deliveries from actors we know with just cheap checks, if we can
+        if settings.SETUP.INBOX_FAST_ACCEPT:
+            response = self.fast_accept(request, document, replay_key, delay)
+            if response:
+                return response
+        # Drop copies of activities we've already accepted
+        duplicate_key = InboxMessage.duplicate_key(document)
+        if duplicate_key and cache.get(duplicate_key):
+            logger.debug("Inbox: Dropped duplicate of %s", document.get("id"))
+            return HttpResponse(status=202)
         # Load the LD
-        document = canonicalise(json.loads(request.body), include_security=True)
+        document = canonicalise(document, include_security=True)
         document_type = document["type"]
         document_subtype = None
         if isinstance(document.get("object"), dict):
@@ -178,13 +227,10 @@ class Inbox(View):
 
         # See if it's a type of message we know we want to ignore right now
         # (e.g. Lemmy likes/dislikes, which we can't process anyway)
-        if document_type == "Announce" and document_subtype in [
-            "Like",
-            "Dislike",
-            "Create",
-            "Undo",
-            "Update",
-        ]:
+        if (
+            document_type == "Announce"
+            and document_subtype in InboxMessage.IGNORED_ANNOUNCE_TYPES
+        ):
             return HttpResponse(status=202)
 
         # authenticate HTTP signature first, if one is present and the actor
@@ -215,41 +261,12 @@ class Inbox(View):
                 logger.warning("Inbox error: Bad HTTP signature from %s", identity)
                 return HttpResponseUnauthorized("Bad signature")
 
-        # Mastodon advices not implementing LD Signatures, but
-        # they're widely deployed today. Validate it if one exists.
-        # https://docs.joinmastodon.org/spec/security/#ld
-        if "signature" in document:
-            try:
-                # signatures are identified by the signature block
-                creator = urldefrag(document["signature"]["creator"]).url
-                creator_identity = Identity.by_actor_uri(
-                    creator, create=True, transient=True
-                )
-                if not creator_identity.public_key:
-                    logger.info("Inbox: New actor, no key available: %s", creator)
-                    # if we can't verify it, we don't keep it
-                    document.pop("signature")
-                else:
-                    LDSignature.verify_signature(document, creator_identity.public_key)
-                    logger.debug(
-                        "Inbox: %s from %s has good LD signature",
-                        document["type"],
-                        creator_identity,
-                    )
-            except VerificationFormatError as e:
-                logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
-                return HttpResponseBadRequest(e.args[0])
-            except VerificationError:
-                # An invalid LD Signature might also indicate nothing but
-                # a syntactical difference between implementations.
-                # Strip it out if we can't verify it.
-                if "signature" in document:
-                    document.pop("signature")
-                logger.info(
-                    "Inbox: Stripping invalid LD signature from %s %s",
-                    creator_identity,
-                    document["id"],
-                )
+        # Validate (or strip) any LD signature
+        try:
+            InboxMessage.check_ld_signature(document)
+        except VerificationFormatError as e:
+            logger.warning("Inbox error: Bad LD signature format: %s", e.args[0])
+            return HttpResponseBadRequest(e.args[0])
 
         if not ("signature" in request or "signature" in document):
             logger.debug(
@@ -262,10 +279,151 @@ class Inbox(View):
         if document["type"].startswith("__"):
             return HttpResponseUnauthorized("Bad type")
 
-        # Hand off the item to be processed by the queue
-        InboxMessage.objects.create(message=document)
+        # Now we know which server it's really from, if the HTTP signature is
+        # good, charge it to that server too
+        verified = bool(
+            "signature" in request.headers
+            and identity.public_key
+            and self.signature_valid(request, identity.public_key)
+        )
+        if verified:
+            delay = max(delay, self.rate_limit_delay(f"domain:{domain.domain}"))
+            if delay > settings.SETUP.INBOX_DOMAIN_MAX_DELAY:
+                return self.too_many_deliveries(delay, domain.domain)
+
+        # Hand off the item to be processed by the queue, remembering it if
+        # its HTTP signature is good
+        InboxMessage.create_batched(document, delay=delay)
+        if verified:
+            self.remember(replay_key, duplicate_key)
+            with actor_key_cache_lock:
+                actor_key_cache[identity.actor_uri] = identity.public_key
         return HttpResponse(status=202)
 
+    def fast_accept(
+        self, request, document, replay_key: str | None, delay: float
+    ) -> HttpResponse | None:
+        """
+        Accepts a delivery with an HTTP signature from an actor whose key we
+        saw recently, with only a structural parse and checks that don't need
+        the database, storing it as delivered; Stator then canonicalises it
+        and does the rest (see InboxMessage.check_raw).
+
+        Returns None if the delivery needs the full checks instead.
+        """
+        if "signature" not in request.headers or not isinstance(document, dict):
+            return None
+        actor = document.get("actor")
+        document_type = document.get("type")
+        if not isinstance(actor, str) or not isinstance(document_type, str):
+            return None
+        hostname = urlparse(actor).hostname
+        if not hostname:
+            return None
+        # Don't allow injection of internal messages
+        if document_type.startswith("__"):
+            return HttpResponseUnauthorized("Bad type")
+        duplicate_key = InboxMessage.duplicate_key(document)
+        if duplicate_key and cache.get(duplicate_key):
+            logger.debug("Inbox: Dropped duplicate of %s", document.get("id"))
+            return HttpResponse(status=202)
+        if Domain.hostname_blocked(hostname):
+            logger.info("Inbox: Discarded message from blocked domain %s", actor)
+            return HttpResponse(status=202)
+        with actor_key_cache_lock:
+            public_key = actor_key_cache.get(actor)
+        if not public_key:
+            return None
+        if not self.signature_valid(request, public_key):
+            # They may have changed key since we saw it; look again
+            return None
+        delay = max(delay, self.rate_limit_delay(f"domain:{hostname}"))
+        if delay > settings.SETUP.INBOX_DOMAIN_MAX_DELAY:
+            return self.too_many_deliveries(delay, hostname)
+        InboxMessage.create_batched(document, raw=True, delay=delay)
+        self.remember(replay_key, duplicate_key)
+        return HttpResponse(status=202)
+
+    @classmethod
+    def peer_address(cls, request) -> str:
+        """
+        Returns the address a delivery came from; if we're behind a proxy,
+        that's the last one in X-Forwarded-For, as the proxy added it.
+        """
+        if settings.SETUP.USE_PROXY_HEADERS:
+            forwarded = request.META.get("HTTP_X_FORWARDED_FOR")
+            if forwarded:
+                return forwarded.split(",")[-1].strip()
+        return request.META.get("REMOTE_ADDR", "")
+
+    @classmethod
+    def rate_limit_delay(cls, key: str) -> float:
+        """
+        Takes a delivery from `key` (an address or a server) out of its rate
+        limit, returning how many seconds to put it off by; if that's more
+        than INBOX_DOMAIN_MAX_DELAY, it should be turned away instead.
+        """
+        if not settings.SETUP.INBOX_DOMAIN_RATE:
+            return 0.0
+        return inbox_rate_limiter().take(key, settings.SETUP.INBOX_DOMAIN_MAX_DELAY)
+
+    @classmethod
+    def too_many_deliveries(cls, delay: float, source: str) -> HttpResponse:
+        """
+        Returns the response turning away a delivery that's over its rate
+        limit, saying when to try again.
+        """
+        logger.info("Inbox: Rate limited delivery from %s", source)
+        response = HttpResponse("Too many deliveries", status=429)
+        response["Retry-After"] = str(
+            math.ceil(delay - settings.SETUP.INBOX_DOMAIN_MAX_DELAY)
+        )
+        return response
+
+    @classmethod
+    def remember(cls, replay_key: str | None, duplicate_key: str | None):
+        """
+        Notes that we've accepted a delivery we verified the signature of,
+        so that copies of it (or of the activity in it) can be dropped.
+        We only do this once it's verified, so nobody else can use an
+        activity's ID to get the real one dropped.
+        """
+        if replay_key:
+            cache.add(replay_key, True, settings.SETUP.INBOX_REPLAY_WINDOW)
+        if duplicate_key and settings.SETUP.INBOX_DUPLICATE_WINDOW:
+            cache.add(duplicate_key, True, settings.SETUP.INBOX_DUPLICATE_WINDOW)
+
+    @classmethod
+    def signature_valid(cls, request, public_key: str) -> bool:
+        """
+        Returns whether the request's HTTP signature checks out against the
+        given public key, without rejecting it if it doesn't.
+        """
+        try:
+            HttpSignature.verify_request(request, public_key)
+        except (VerificationError, ValueError):
+            return False
+        return True
+
+    @classmethod
+    def replay_key(cls, request) -> str | None:
+        """
+        Returns the cache key recording that we've seen this delivery's
+        (keyId, signature) pair, if it's signed and replay checks are on.
+        The signature covers the Date header, so a genuine retry gets a new
+        one, and the body is included too, so only exact copies match.
+        """
+        if not settings.SETUP.INBOX_REPLAY_WINDOW or "signature" not in request.headers:
+            return None
+        try:
+            details = HttpSignature.parse_signature(request.headers["signature"])
+        except (VerificationError, ValueError):
+            return None
+        digest = hashlib.sha256(details["keyid"].encode("utf8"))
+        digest.update(details["signature"])
+        digest.update(request.body)
+        return f"inbox_replay:{digest.hexdigest()}"
+
 
 class Outbox(View):
     """
@@ -1,15 +1,18 @@
 import csv
+import datetime
 
 from django import forms
 from django.contrib import messages
 from django.core.validators import FileExtensionValidator, ValidationError
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.generic import FormView, ListView
 
 from users.decorators import admin_required
-from users.models import Domain
+from users.models import Domain, InboxMessage
 from users.services import DomainService
 from users.views.admin.domains import DomainValidator
 
@@ -28,9 +31,23 @@ class FederationRoot(ListView):
         return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
+        # How many deliveries each server has sent us in the last hour
+        recent_messages = (
+            InboxMessage.objects.filter(
+                actor_domain=models.OuterRef("domain"),
+                created__gte=timezone.now() - datetime.timedelta(hours=1),
+            )
+            .order_by()
+            .values("actor_domain")
+            .annotate(count=models.Count("*"))
+            .values("count")
+        )
         domains = (
             Domain.objects.filter(local=False)
-            .annotate(num_users=models.Count("identities"))
+            .annotate(
+                num_users=models.Count("identities"),
+                num_messages=Coalesce(models.Subquery(recent_messages), 0),
+            )
             .order_by("domain")
         )
         if self.query:
@@ -10,10 +10,17 @@ class Stator(TemplateView):
     template_name = "admin/stator.html"
 
     def get_context_data(self):
+        current = Stats.current()
+        # Exact counts can be slow on big queues, so are only done on request
+        exact = bool(self.request.GET.get("exact"))
         return {
             "model_stats": {
-                model._meta.verbose_name_plural.title(): Stats.get_for_model(model)
+                model._meta.verbose_name_plural.title(): {
+                    **current.get(model._meta.label_lower, {}),
+                    "exact_queued": (model.transition_ready_count() if exact else None),
+                }
                 for model in StatorModel.subclasses
             },
+            "exact": exact,
             "section": "stator",
         }